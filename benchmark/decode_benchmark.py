@@ -0,0 +1,54 @@
+"""
+Measures the CPU time spent decoding and converting frames from a video for each of the
+decode modes supported by get_frames.  With visionalert installed, run for example:
+
+    python benchmark/decode_benchmark.py test/fixtures/sample.mp4 --fps 3
+"""
+import argparse
+import time
+
+import av
+
+from visionalert.video import DECODE_MODES, get_frames
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark per camera decode CPU usage")
+    parser.add_argument("location", help="video file or stream URL to decode")
+    parser.add_argument("--fps", type=float, default=3, help="requested frames per second")
+    parser.add_argument(
+        "--seconds", type=float, default=None, help="stop after this much video"
+    )
+    return parser.parse_args()
+
+
+def video_duration(location, seconds=None):
+    with av.open(location) as container:
+        duration = container.duration / av.time_base
+    return min(duration, seconds) if seconds else duration
+
+
+def measure(location, fps, decode, seconds=None):
+    """Returns (frames, CPU seconds) for decoding location in the given decode mode"""
+    frames = 0
+    cpu_start = time.process_time()
+    for frame in get_frames(location, fps=fps, decode=decode):
+        if seconds and frame.time is not None and frame.time >= seconds:
+            break
+        frame.to_ndarray(format="rgb24")  # Camera does this for every frame it keeps
+        frames += 1
+    return frames, time.process_time() - cpu_start
+
+
+def main():
+    args = parse_args()
+    duration = video_duration(args.location, args.seconds)
+    print(f"{duration:.1f}s of video at {args.fps} fps")
+    print(f"{'mode':<10} {'frames':>8} {'cpu s':>8} {'cpu % of one core':>18}")
+    for decode in DECODE_MODES:
+        frames, cpu = measure(args.location, args.fps, decode, args.seconds)
+        print(f"{decode:<10} {frames:>8} {cpu:>8.3f} {cpu / duration * 100:>17.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Compares encoding alert images the way visionalert used to, scaling them with PIL's
+antialiasing thumbnail, with scaling them with OpenCV's area interpolation as it does now, at
+several camera resolutions.  Both encode with Pillow, which takes the RGB frames as they are.
+With visionalert installed, run:
+
+    python benchmark/jpeg_benchmark.py --number 20
+"""
+import argparse
+from io import BytesIO
+import timeit
+
+import numpy
+from PIL import Image
+
+from visionalert.alert import frame_to_jpeg, frame_to_jpegs
+
+RESOLUTIONS = {"720p": (720, 1280), "1080p": (1080, 1920), "4K": (2160, 3840)}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark alert image encoding")
+    parser.add_argument("--number", type=int, default=20, help="frames to encode")
+    parser.add_argument("--size", type=int, default=1024, help="maximum image size")
+    parser.add_argument("--quality", type=int, default=75, help="JPEG quality")
+    return parser.parse_args()
+
+
+def camera_frame(height, width, seed=0):
+    """A noisy gradient, which compresses more like a real scene than a blank frame"""
+    random = numpy.random.default_rng(seed)
+    gradient = numpy.linspace(0, 200, width, dtype=numpy.float32)
+    frame = gradient[numpy.newaxis, :, numpy.newaxis] + random.normal(
+        0, 20, (height, width, 3)
+    )
+    return numpy.clip(frame, 0, 255).astype(numpy.uint8)
+
+
+def legacy(frame, size, quality):
+    """Thumbnail with PIL's antialiasing filter and save with PIL"""
+    image_bytes = BytesIO()
+    image = Image.fromarray(frame)
+    image.thumbnail((size, size), Image.LANCZOS)
+    image.save(image_bytes, format="JPEG", quality=quality)
+    image_bytes.seek(0)
+    return image_bytes
+
+
+def main():
+    args = parse_args()
+    print(f"{'resolution':<12}{'legacy':>12}{'current':>12}{'+ full':>12}")
+    for name, (height, width) in RESOLUTIONS.items():
+        frame = camera_frame(height, width)
+        timings = [
+            timeit.timeit(function, number=args.number) / args.number * 1000
+            for function in (
+                lambda: legacy(frame, args.size, args.quality),
+                lambda: frame_to_jpeg(frame, args.size, args.quality),
+                lambda: frame_to_jpegs(frame, [args.size, None], args.quality),
+            )
+        ]
+        print(f"{name:<12}" + "".join(f"{timing:>10.1f}ms" for timing in timings))
+
+
+if __name__ == "__main__":
+    main()
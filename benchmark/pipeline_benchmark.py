@@ -0,0 +1,367 @@
+"""
+Measures the throughput of the whole pipeline, from decoding video through object detection
+to alerting, without any cameras, S3 or Gotify.  Each scenario, a number of cameras all
+playing the same video, runs in its own process: video is decoded by Cameras, queued by a
+FrameScheduler, analyzed by a Dispatcher with a stub or real TensorFlow Lite detector and
+alerts go to a stub Notifier that only counts them.  Synthetic videos of each resolution are
+generated unless recorded clips are given.  With visionalert installed, run for example:
+
+    python benchmark/pipeline_benchmark.py --cameras 1 4 --resolutions 1280x720 1920x1080
+    python benchmark/pipeline_benchmark.py --video driveway.mp4 --model detect.tflite \\
+        --labels labelmap.txt --json results.json
+
+Frames are decoded as fast as possible rather than at the video's frame rate, so pass --fps
+to have each camera sample like it would a live stream.  CPU time includes every thread of
+the scenario's process but not capture processes.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import av
+import cv2
+import numpy
+
+from visionalert import metrics
+from visionalert.app import FrameScheduler
+from visionalert.detection import Detections, Dispatcher, Interest
+from visionalert.video import Camera, ProcessCamera
+
+INTERESTS = {"person": Interest("person", 0.6, 0, 2 ** 62)}
+QUANTILES = (0.5, 0.95, 0.99)
+
+DETECT_SECONDS = metrics.histogram(
+    "visionalert_benchmark_detect_seconds", "Time the stub detector spent on each frame"
+)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the visionalert pipeline")
+    parser.add_argument(
+        "--cameras", type=int, nargs="+", default=[1, 4], help="numbers of cameras to run"
+    )
+    parser.add_argument(
+        "--resolutions",
+        nargs="+",
+        default=["1280x720", "1920x1080"],
+        help="WIDTHxHEIGHT of the synthetic videos to generate",
+    )
+    parser.add_argument(
+        "--video", nargs="+", default=[], help="recorded clips to use instead of synthetic video"
+    )
+    parser.add_argument(
+        "--video-dir",
+        default=os.path.join(tempfile.gettempdir(), "visionalert-benchmark"),
+        help="where synthetic videos are kept between runs",
+    )
+    parser.add_argument("--video-fps", type=int, default=15, help="synthetic video frame rate")
+    parser.add_argument(
+        "--video-seconds", type=int, default=10, help="synthetic video length, it's looped"
+    )
+    parser.add_argument(
+        "--keyframe-interval", type=int, default=30, help="synthetic video frames per keyframe"
+    )
+    parser.add_argument("--seconds", type=float, default=15, help="time measured per scenario")
+    parser.add_argument("--warmup", type=float, default=3, help="time run before measuring")
+    parser.add_argument("--fps", type=float, default=None, help="frames each camera samples")
+    parser.add_argument("--decode", default="all", help="camera decode mode")
+    parser.add_argument(
+        "--capture-process", action="store_true", help="decode each camera in its own process"
+    )
+    parser.add_argument("--queue-frames", type=int, default=1, help="frames queued per camera")
+    parser.add_argument("--batch-size", type=int, default=1, help="detection batch size")
+    parser.add_argument("--detectors", type=int, default=1, help="detector pool size")
+    parser.add_argument(
+        "--detector-latency",
+        type=float,
+        default=0.02,
+        help="seconds the stub detector takes per frame",
+    )
+    parser.add_argument("--input-size", default="300x300", help="stub detector WIDTHxHEIGHT")
+    parser.add_argument("--model", help="TensorFlow Lite model to use instead of the stub")
+    parser.add_argument("--labels", help="label map for --model")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--scenario", help=argparse.SUPPRESS)  # Runs a single scenario
+    return parser.parse_args(argv)
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def synthetic_video(directory, width, height, fps, seconds, keyframe_interval):
+    """
+    Path of an H.264 video of a textured scene with a box moving across it, generated the
+    first time it's needed.  The same arguments always produce the same video.
+    """
+    path = os.path.join(
+        directory, f"synthetic-{width}x{height}-{fps}fps-{seconds}s-g{keyframe_interval}.mp4"
+    )
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(directory, exist_ok=True)
+    random = numpy.random.default_rng(0)
+    noise = random.integers(0, 255, (height, width, 3), dtype=numpy.uint8)
+    scene = cv2.GaussianBlur(noise, (0, 0), 3)
+    box_width, box_height = width // 8, height // 3
+
+    partial = path + ".partial"
+    with av.open(partial, mode="w", format="mp4") as container:
+        stream = container.add_stream("libx264", rate=fps)
+        stream.width, stream.height = width, height
+        stream.pix_fmt = "yuv420p"
+        stream.options = {"preset": "veryfast", "g": str(keyframe_interval)}
+        frames = fps * seconds
+        for index in range(frames):
+            image = scene.copy()
+            x = int((width - box_width) * index / frames)
+            y = height // 2 - box_height // 2
+            cv2.rectangle(image, (x, y), (x + box_width, y + box_height), (200, 60, 40), -1)
+            frame = av.VideoFrame.from_ndarray(image, format="rgb24")
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+    os.replace(partial, path)
+    return path
+
+
+class StubDetector:
+    """
+    Stands in for a TensorFlow Lite Detector.  Each call takes latency seconds, sleeping so
+    the GIL is released as it is while a model is invoked, and reports a person in the frame.
+    """
+
+    labels = ["person"]
+
+    def __init__(self, latency, input_size):
+        self.latency = latency
+        self.input_size = input_size
+
+    def __call__(self, image, shape=None, region=None):
+        with DETECT_SECONDS.time():
+            time.sleep(self.latency)
+            height, width = (shape or image.shape)[:2]
+            return Detections(
+                self.labels,
+                numpy.zeros(1, dtype=numpy.int64),
+                numpy.full(1, 0.9, dtype=numpy.float32),
+                numpy.array([[width // 4, height // 4, width // 2, height // 2]]),
+            )
+
+
+class StubNotifier:
+    """Stands in for the Notifier, counting the alerts it would have sent"""
+
+    def __init__(self):
+        self.alerts = 0
+        self._lock = threading.Lock()
+
+    def submit_detections(self, data):
+        with self._lock:
+            self.alerts += 1
+
+
+def create_detectors(scenario):
+    if scenario["model"]:
+        from visionalert import tensorflow
+
+        return tensorflow.create_detector_pool(
+            scenario["model"], scenario["labels"], size=scenario["detectors"]
+        )
+    input_size = parse_size(scenario["input_size"])
+    return [
+        StubDetector(scenario["detector_latency"], input_size)
+        for _ in range(scenario["detectors"])
+    ]
+
+
+def snapshot():
+    """
+    Counter values, and the sum, bucket counts and bucket bounds of histograms, of every
+    metric summed over cameras
+    """
+    values = {}
+    for metric in metrics.registered():
+        for labels, child in metric.children():
+            labels.pop("camera", None)
+            key = " ".join([metric.name] + [f"{name}={value}" for name, value in labels.items()])
+            if isinstance(metric, metrics.Histogram):
+                counts = numpy.diff(
+                    [0] + [value for suffix, _, value in child.samples() if suffix == "_bucket"]
+                )
+                total, previous_counts, _ = values.get(key, (0.0, 0, None))
+                values[key] = (total + child.sum, previous_counts + counts, child.buckets)
+            elif isinstance(metric, metrics.Counter):
+                values[key] = values.get(key, 0) + child.value
+    return values
+
+
+def latency_summary(total, counts, buckets):
+    """Mean and quantiles, in milliseconds, of a histogram's observations"""
+    count = int(counts.sum())
+    summary = {"count": count, "mean_ms": total / count * 1000 if count else 0.0}
+    cumulative = numpy.cumsum(counts)
+    for quantile in QUANTILES:
+        index = int(numpy.searchsorted(cumulative, quantile * count)) if count else 0
+        bound = (buckets + (float("inf"),))[min(index, len(buckets))]
+        summary[f"p{round(quantile * 100)}_ms"] = bound * 1000 if count else 0.0
+    return summary
+
+
+def run_scenario(scenario):
+    """Runs the pipeline described by scenario and returns its measurements"""
+    input_queue = FrameScheduler(scenario["queue_frames"])
+    detectors = create_detectors(scenario)
+    notifier = StubNotifier()
+
+    camera_class = ProcessCamera if scenario["capture_process"] else Camera
+    cameras = {}
+    for index in range(scenario["cameras"]):
+        camera = camera_class(
+            f"camera-{index}",
+            scenario["video"],
+            input_queue.put,
+            fps=scenario["fps"],
+            decode=scenario["decode"],
+            input_size=detectors[0].input_size,
+            interests=INTERESTS,
+        )
+        camera.retry_wait = 0  # Loop the video
+        cameras[camera.name] = camera
+
+    dispatcher = Dispatcher(
+        input_queue.get,
+        detectors,
+        notifier.submit_detections,
+        cameras,
+        batch_size=scenario["batch_size"],
+        batch_timeout=0.01,
+    )
+    dispatcher.start()
+    for camera in cameras.values():
+        camera.start()
+
+    time.sleep(scenario["warmup"])
+    before, alerts_before = snapshot(), notifier.alerts
+    cpu_before, start = time.process_time(), time.perf_counter()
+    time.sleep(scenario["seconds"])
+    after, alerts_after = snapshot(), notifier.alerts
+    cpu, elapsed = time.process_time() - cpu_before, time.perf_counter() - start
+
+    def delta(name):
+        return after.get(name, 0) - before.get(name, 0)
+
+    stages = {}
+    for key, value in after.items():
+        if isinstance(value, tuple):
+            total, counts, buckets = value
+            previous_total, previous_counts, _ = before.get(key, (0.0, 0, None))
+            stages[key] = latency_summary(total - previous_total, counts - previous_counts, buckets)
+
+    return {
+        "scenario": scenario,
+        "seconds": elapsed,
+        "frames_captured_per_second": delta("visionalert_frames_captured") / elapsed,
+        "frames_analyzed_per_second": delta("visionalert_frames_analyzed") / elapsed,
+        "frames_dropped_per_second": delta("visionalert_frames_dropped") / elapsed,
+        "alerts_per_second": (alerts_after - alerts_before) / elapsed,
+        "cpu_seconds": cpu,
+        "cpu_percent_of_one_core": cpu / elapsed * 100,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": stages,
+    }
+
+
+def scenarios(args):
+    videos = list(args.video)
+    for resolution in [] if args.video else args.resolutions:
+        width, height = parse_size(resolution)
+        videos.append(
+            synthetic_video(
+                args.video_dir,
+                width,
+                height,
+                args.video_fps,
+                args.video_seconds,
+                args.keyframe_interval,
+            )
+        )
+
+    for video in videos:
+        for cameras in args.cameras:
+            yield {
+                "video": video,
+                "cameras": cameras,
+                "seconds": args.seconds,
+                "warmup": args.warmup,
+                "fps": args.fps,
+                "decode": args.decode,
+                "capture_process": args.capture_process,
+                "queue_frames": args.queue_frames,
+                "batch_size": args.batch_size,
+                "detectors": args.detectors,
+                "detector_latency": args.detector_latency,
+                "input_size": args.input_size,
+                "model": args.model,
+                "labels": args.labels,
+            }
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "av": av.__version__,
+        "numpy": numpy.__version__,
+        "opencv": cv2.__version__,
+    }
+
+
+def main():
+    args = parse_args()
+    if args.scenario:
+        # Child process running a single scenario, the results are the last line of output
+        print(json.dumps(run_scenario(json.loads(args.scenario))))
+        return
+
+    results = []
+    print(
+        f"{'video':<36}{'cameras':>8}{'captured':>10}{'analyzed':>10}{'dropped':>10}"
+        f"{'cpu %':>8}{'rss MB':>8}"
+    )
+    for scenario in scenarios(args):
+        output = subprocess.run(
+            [sys.executable, __file__, "--scenario", json.dumps(scenario)],
+            check=True,
+            stdout=subprocess.PIPE,
+            text=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        print(
+            f"{os.path.basename(scenario['video'])[:35]:<36}{scenario['cameras']:>8}"
+            f"{result['frames_captured_per_second']:>10.1f}"
+            f"{result['frames_analyzed_per_second']:>10.1f}"
+            f"{result['frames_dropped_per_second']:>10.1f}"
+            f"{result['cpu_percent_of_one_core']:>8.0f}{result['peak_rss_mb']:>8.0f}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"environment": environment(), "results": results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Compares filtering raw model output one object at a time, the way visionalert used to, with
+the vectorized Detections and InterestFilter used now.  With visionalert installed, run:
+
+    python benchmark/postprocess_benchmark.py --objects 10
+"""
+import argparse
+import timeit
+
+import numpy
+
+from visionalert.detection import (
+    DetectionResult,
+    Interest,
+    InterestFilter,
+    Rectangle,
+    matches_interest,
+)
+from visionalert.tensorflow import Detector
+
+LABELS = ["person", "bicycle", "car", "motorcycle", "bus", "truck", "cat", "dog"]
+SHAPE = (1080, 1920, 3)
+INTERESTS = {
+    "person": Interest("person", 0.6, 10000, 50000),
+    "car": Interest("car", 0.55, 0, 1000000),
+    "dog": Interest("dog", 0.65, 0, 1000000),
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark detection post-processing")
+    parser.add_argument("--objects", type=int, default=10, help="objects output per frame")
+    parser.add_argument("--number", type=int, default=10000, help="frames to process")
+    return parser.parse_args()
+
+
+def model_output(objects, seed=0):
+    random = numpy.random.default_rng(seed)
+    corners = random.uniform(0, 1, (objects, 2, 2))
+    boxes = numpy.concatenate([corners.min(axis=1), corners.max(axis=1)], axis=1)
+    label_indexes = random.integers(0, len(LABELS), objects).astype(numpy.float32)
+    scores = numpy.sort(random.uniform(0, 1, objects).astype(numpy.float32))[::-1]
+    return boxes, label_indexes, scores
+
+
+def legacy(boxes, label_indexes, scores):
+    """One DetectionResult and Rectangle per object, filtered one at a time"""
+    h, w, _ = SHAPE
+    results = [
+        DetectionResult(
+            name=LABELS[int(label_index)],
+            confidence=score,
+            coordinates=Rectangle(
+                start_x=int(max(1, box[1] * w)),
+                start_y=int(max(1, box[0] * h)),
+                end_x=int(min(w, box[3] * w)),
+                end_y=int(min(h, box[2] * h)),
+            ),
+        )
+        for box, label_index, score in zip(boxes, label_indexes, scores)
+    ]
+    return [result for result in results if matches_interest(INTERESTS, result)]
+
+
+def vectorized(parse_results, interest_filter, boxes, label_indexes, scores):
+    return list(interest_filter(parse_results(SHAPE, None, boxes, label_indexes, scores)))
+
+
+def main():
+    args = parse_args()
+    output = model_output(args.objects)
+
+    detector = Detector.__new__(Detector)  # Only the post-processing is needed
+    detector.labels = LABELS
+    interest_filter = InterestFilter(INTERESTS, LABELS)
+
+    assert legacy(*output) == vectorized(detector._parse_results, interest_filter, *output)
+
+    for name, function in [
+        ("legacy", lambda: legacy(*output)),
+        ("vectorized", lambda: vectorized(detector._parse_results, interest_filter, *output)),
+    ]:
+        seconds = timeit.timeit(function, number=args.number)
+        print(f"{name:<12} {seconds / args.number * 1e6:>8.1f} us per frame")
+
+
+if __name__ == "__main__":
+    main()
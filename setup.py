@@ -12,5 +12,6 @@ setup(
     license="AGPL3",
     packages=['visionalert'],
     package_dir={"": "src"},
+    python_requires=">=3.11",
     entry_points={"console_scripts": ["visionalert = visionalert.app:run"]},
 )
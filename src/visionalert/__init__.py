@@ -1,10 +1,17 @@
+import importlib.util
 import os
 import re
+import sys
+import threading
+import types
 
 import yaml
 
 config = {}
 
+# Held while a module returned by lazy_import loads
+_lazy_import_lock = threading.RLock()
+
 
 def _env_var_constructor(_, node):
     return re.sub(r'\${([^}]+)}', lambda m: os.getenv(m.group(1), m.group(0)), node.value)
@@ -15,6 +22,58 @@ yaml.add_implicit_resolver('!path', re.compile(r'.*?\${[^}]+}'), None, yaml.Safe
 yaml.add_constructor('!path', _env_var_constructor, yaml.SafeLoader)
 
 
-def load_config(filename):
+def read_config(filename):
+    """Returns the configuration in filename without loading it into config"""
     with open(filename) as file:
-        config.update(yaml.safe_load(file))
+        return yaml.safe_load(file)
+
+
+def load_config(filename):
+    config.update(read_config(filename))
+
+
+def lazy_import(name):
+    """
+    Returns the module called name without executing it until one of its attributes is first
+    used, so that heavy dependencies only slow startup if they're needed.  If the module has
+    already been imported, it's returned as it is.  Threads that use the module while it's
+    being executed wait for it to finish.
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    module = importlib.util.module_from_spec(spec)
+    module.__class__ = _LazyModule
+    sys.modules[name] = module
+    return module
+
+
+class _LazyModule(types.ModuleType):
+    """A module that's executed when one of its attributes is first used"""
+
+    def __getattribute__(self, attribute):
+        with _lazy_import_lock:
+            if type(self) is _LazyModule:
+                # importlib.util.LazyLoader isn't used as it makes the module a plain one
+                # before executing it, so other threads using it meanwhile find it incomplete
+                self.__class__ = _ExecutingModule
+                try:
+                    types.ModuleType.__getattribute__(self, "__spec__").loader.exec_module(self)
+                except BaseException:
+                    self.__class__ = _LazyModule
+                    raise
+                self.__class__ = types.ModuleType
+        return types.ModuleType.__getattribute__(self, attribute)
+
+
+class _ExecutingModule(types.ModuleType):
+    """A module returned by lazy_import while it's being executed"""
+
+    def __getattribute__(self, attribute):
+        # The thread executing the module already holds the lock, the others wait for it
+        with _lazy_import_lock:
+            return types.ModuleType.__getattribute__(self, attribute)
@@ -1,83 +1,284 @@
 import collections
 from concurrent.futures import ThreadPoolExecutor
+import heapq
 from io import BytesIO
+import itertools
 import logging
+import sys
 import threading
 import time
 
-import boto3
-from PIL import Image
-import requests
+from visionalert import config, lazy_import, metrics
 
-from visionalert import config
+boto3 = lazy_import("boto3")
+botocore_config = lazy_import("botocore.config")
+cv2 = lazy_import("cv2")
+Image = lazy_import("PIL.Image")
+requests = lazy_import("requests")
 
 logger = logging.getLogger(__name__)
 
+ALERT_SECONDS = metrics.histogram(
+    "visionalert_alert_seconds", "Time spent by each stage of sending an alert", ["stage"]
+)
+_ENCODE_SECONDS = ALERT_SECONDS.labels("encode")
+_UPLOAD_SECONDS = ALERT_SECONDS.labels("upload")
+_NOTIFY_SECONDS = ALERT_SECONDS.labels("notify")
+ALERTS_SENT = metrics.counter("visionalert_alerts_sent", "Alerts sent", ["camera"])
+
+_clients = {}
+_clients_lock = threading.Lock()
+
 
 def s3_upload(byte_object, mime_type, s3_filename):
-    s3 = boto3.client(
+    s3_client().upload_fileobj(
+        byte_object,
+        config["aws_image_bucket"],
+        s3_filename,
+        ExtraArgs={"ContentType": mime_type},
+    )
+
+
+def s3_client():
+    """
+    The S3 client shared by every alert.  It's created on first use and keeps its connections
+    open between uploads.  boto3 clients are safe to share between threads.
+    """
+    return _shared_client("s3", _create_s3_client)
+
+
+def http_session():
+    """
+    The requests Session shared by every alert.  It's created on first use and keeps its
+    connections to the Gotify server open between notifications.
+    """
+    return _shared_client("http", _create_http_session)
+
+
+def close_clients():
+    """Closes the shared clients, they're created again when next used"""
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
+
+
+def _shared_client(name, create):
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = create()
+    return client
+
+
+def _create_s3_client():
+    return boto3.client(
         "s3",
         aws_access_key_id=config["aws_access_key"],
         aws_secret_access_key=config["aws_secret_key"],
         endpoint_url=config["aws_s3_url"],
+        config=botocore_config.Config(
+            max_pool_connections=config.get("alert_connection_pool_size", 10),
+            connect_timeout=config.get("alert_connect_timeout_seconds", 5),
+            read_timeout=config.get("alert_read_timeout_seconds", 30),
+        ),
     )
 
-    s3.upload_fileobj(
-        byte_object,
-        config["aws_image_bucket"],
-        s3_filename,
-        ExtraArgs={"ContentType": mime_type},
+
+def _create_http_session():
+    pool_size = config.get("alert_connection_pool_size", 10)
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+    return session
+
+
+def frame_to_jpeg(frame, max_size=1024, quality=75):
+    """
+    Encodes an RGB frame as a JPEG scaled down to fit within max_size pixels, or at full size
+    if max_size is None.  Returns the JPEG in a BytesIO.
+    """
+    return frame_to_jpegs(frame, [max_size], quality)[0]
+
+
+def frame_to_jpegs(frame, max_sizes, quality=75):
+    """
+    Encodes an RGB frame as a JPEG for each of max_sizes, as frame_to_jpeg would.  Each JPEG
+    is scaled down from the next larger one, so the full frame is only scaled once no matter
+    how many renditions are wanted.  Pillow encodes the RGB pixels as they are, which
+    benchmark/jpeg_benchmark.py found several times faster than converting them for
+    cv2.imencode.
+    """
+    largest_first = sorted(
+        range(len(max_sizes)), key=lambda i: max_sizes[i] or sys.maxsize, reverse=True
     )
+    jpegs = [None] * len(max_sizes)
+    image = frame
+    for index in largest_first:
+        image = _shrink(image, max_sizes[index])
+        jpeg = BytesIO()
+        Image.fromarray(image).save(jpeg, format="JPEG", quality=quality)
+        jpeg.seek(0)
+        jpegs[index] = jpeg
+    return jpegs
 
 
-def frame_to_jpeg(frame):
-    image_bytes = BytesIO()
-    image = Image.fromarray(frame)
-    image.thumbnail((1024, 1024), Image.ANTIALIAS)
-    image.save(image_bytes, format="JPEG")
-    image_bytes.seek(0)  # Rewind the pointer
-    return image_bytes
+def _shrink(image, max_size):
+    """Scales image down, keeping its aspect ratio, so neither side exceeds max_size"""
+    height, width = image.shape[:2]
+    if max_size is None or max(height, width) <= max_size:
+        return image
+    scale = max_size / max(height, width)
+    return cv2.resize(
+        image,
+        (max(1, round(width * scale)), max(1, round(height * scale))),
+        interpolation=cv2.INTER_AREA,
+    )
 
 
-def send_push_notification(title, image_url):
+def send_push_notification(title, image_url, link_url=None):
     gotify_key = {"X-Gotify-Key": config["gotify_key"]}
     gotify_req = {
         "extras": {"client::display": {"contentType": "text/markdown"}},
-        "message": f"[![Image]({image_url})]({image_url})",
+        "message": f"[![Image]({image_url})]({link_url or image_url})",
         "priority": 5,
         "title": f"{title}",
     }
-    requests.post(
-        f"{config['gotify_url']}/message", json=gotify_req, headers=gotify_key
+    response = http_session().post(
+        f"{config['gotify_url']}/message",
+        json=gotify_req,
+        headers=gotify_key,
+        timeout=(
+            config.get("alert_connect_timeout_seconds", 5),
+            config.get("alert_read_timeout_seconds", 30),
+        ),
     )
+    response.raise_for_status()
+
+
+class AlertScheduler:
+    """
+    Runs functions after a delay without tying up a thread for each one.  A single timer
+    thread waits until the next function is due and hands it to a bounded pool of workers.
+
+    :param max_workers: Maximum number of functions run at once
+    """
+
+    def __init__(self, max_workers=4):
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="Notifier")
+        self._condition = threading.Condition()
+        self._pending = []  # Heap of (due time, sequence number, function, args)
+        self._sequence = itertools.count()
+        self._thread = threading.Thread(
+            name=self.__class__.__name__, daemon=True, target=self._schedule_loop
+        )
+
+    def schedule(self, delay, function, *args):
+        """Runs function with args in delay seconds"""
+        with self._condition:
+            if not self._thread.is_alive():
+                self._thread.start()
+            heapq.heappush(
+                self._pending, (time.monotonic() + delay, next(self._sequence), function, args)
+            )
+            self._condition.notify()
+
+    @property
+    def pending(self):
+        """Number of functions waiting until they're due"""
+        with self._condition:
+            return len(self._pending)
+
+    def _schedule_loop(self):
+        while True:
+            with self._condition:
+                while not self._pending or self._pending[0][0] > time.monotonic():
+                    timeout = self._pending[0][0] - time.monotonic() if self._pending else None
+                    self._condition.wait(timeout)
+                _, _, function, args = heapq.heappop(self._pending)
+            self._executor.submit(function, *args)
 
 
 class Notifier:
     """
     Responsible for sending alert when an event is received.
+
+    :param detection_timeout: Seconds after the last detection of an object that a new detection
+    starts a new event
+    :param send_delay: Seconds to wait before sending an alert, to give the event a chance to
+    get a higher scoring frame
+    :param max_workers: Maximum number of alerts sent at once
+    :param image_size: Maximum width and height of the image sent with an alert
+    :param image_quality: JPEG quality, from 0 to 100, of the images sent
+    :param full_image: Whether to also upload the full size frame, which the image sent links to
+    :param max_event_bytes: Most memory the frames kept for events waiting to be sent may use.
+    When a new event needs more, the frames of the least recently seen events are dropped and
+    their alerts aren't sent.  None for no limit.
+    :param cameras: dict mapping camera names to a Camera object.  A detection_timeout or
+    send_delay set on a camera, or on one of its interests, overrides the defaults above.
     """
 
-    def __init__(self, detection_timeout=30, send_delay=5):
+    def __init__(
+        self,
+        detection_timeout=30,
+        send_delay=5,
+        max_workers=4,
+        image_size=1024,
+        image_quality=75,
+        full_image=False,
+        max_event_bytes=None,
+        cameras=None,
+    ):
         self.detection_timeout = detection_timeout
         self.send_delay = send_delay
-        self.executor = ThreadPoolExecutor(thread_name_prefix="Notifier")
+        self.image_size = image_size
+        self.image_quality = image_quality
+        self.full_image = full_image
+        self.max_event_bytes = max_event_bytes
+        self.scheduler = AlertScheduler(max_workers)
         self.current_events = collections.defaultdict(dict)
+        self._cameras = cameras or {}
+        self._events_lock = threading.Lock()
+        # Events keeping a frame for their alert, including those that are over but unsent
+        self._held_events = set()
 
     def submit_detections(self, data):
         detections, frame = data
-        for each in detections:
-            self._update_event(frame, each)
+        with self._events_lock:
+            self._expire_events()
+            for each in detections:
+                self._update_event(frame, each)
+
+    @property
+    def event_bytes(self):
+        """Memory used by the frames kept for events whose alerts haven't been sent"""
+        with self._events_lock:
+            return self._event_bytes()
+
+    def _event_bytes(self):
+        return sum(event.nbytes for event in self._held_events)
 
     def _update_event(self, frame, detected_object):
-        event = self.current_events[frame.camera_name].setdefault(detected_object.name)
+        # Tracked objects each get their own event, others share one per type of object
+        key = (detected_object.name, detected_object.track_id)
+        event = self.current_events[frame.camera_name].get(key)
+        detection_timeout = self._setting(
+            frame.camera_name, detected_object.name, "detection_timeout"
+        )
 
-        if not event or time.time() - event.last_frame_time > self.detection_timeout:
+        if not event or time.time() - event.last_frame_time > detection_timeout:
             logger.info(
                 f"New detection event for {detected_object.name} triggered on {frame.camera_name} "
                 f"with confidence {detected_object.confidence * 100:.2f}%"
             )
-            new_event = Event(frame, detected_object)
-            self.current_events[frame.camera_name][detected_object.name] = new_event
+            # Only keep as much of the frame as the alert will send
+            new_event = Event(frame, detected_object, None if self.full_image else self.image_size)
+            self._make_room(new_event.nbytes)
+            self.current_events[frame.camera_name][key] = new_event
+            self._held_events.add(new_event)
             self._enqueue_alert(new_event)
 
         else:
@@ -85,24 +286,90 @@ class Notifier:
                 f"{detected_object.name.capitalize()} still detected on camera {frame.camera_name} "
                 f"with confidence {detected_object.confidence * 100:.2f}% at {detected_object.coordinates}"
             )
-            event.update(detected_object.confidence, frame.data)
+            # Accessing frame.data converts the full resolution image, so only do it when needed
+            if detected_object.confidence <= event.confidence:
+                event.touch()
+                return
+            max_bytes = None
+            if self.max_event_bytes is not None:
+                max_bytes = self.max_event_bytes - self._event_bytes() + event.nbytes
+            event.update(detected_object.confidence, frame.data, max_bytes)
+
+    def _expire_events(self):
+        """
+        Forgets events that are over, so that their next detection starts a new event.  Their
+        frames still count towards max_event_bytes until their alerts are sent.
+        """
+        now = time.time()
+        for camera_name, events in list(self.current_events.items()):
+            for key, event in list(events.items()):
+                timeout = self._setting(camera_name, event.object_name, "detection_timeout")
+                if now - event.last_frame_time > timeout:
+                    del events[key]
+            if not events:
+                del self.current_events[camera_name]
+        self._held_events = {event for event in self._held_events if event.nbytes}
+
+    def _make_room(self, nbytes):
+        """Drops the frames of the least recently seen events until nbytes more fit"""
+        if self.max_event_bytes is None:
+            return
+        held = sorted(
+            (event for event in self._held_events if event.nbytes),
+            key=lambda event: event.last_frame_time,
+        )
+        total = sum(event.nbytes for event in held)
+        for event in held:
+            if total + nbytes <= self.max_event_bytes:
+                break
+            logger.warning(
+                f"Event memory limit reached, dropping alert for {event.object_name} "
+                f"on camera {event.camera_name}"
+            )
+            total -= event.nbytes
+            event.release()
+
+    def _setting(self, camera_name, object_name, name):
+        """The named setting from the camera's interest in object_name, the camera or the default"""
+        camera = self._cameras.get(camera_name)
+        interest = camera.interests.get(object_name) if camera else None
+        for settings in (interest, camera):
+            value = getattr(settings, name, None)
+            if value is not None:
+                return value
+        return getattr(self, name)
 
     def _enqueue_alert(self, event):
-        self.executor.submit(self._send_alert, event)
+        # Wait a few seconds to give the event a chance to potentially
+        # get a higher scoring frame.
+        send_delay = self._setting(event.camera_name, event.object_name, "send_delay")
+        self.scheduler.schedule(send_delay, self._send_alert, event)
 
     def _send_alert(self, event):
+        frame = event.frame
+        if frame is None:
+            return  # Dropped to stay within max_event_bytes
         try:
-            # Wait a few seconds to give the event a chance to potentially
-            # get a higher scoring frame.
-            time.sleep(self.send_delay)  # TODO make this configurable
+            timestamp = int(time.time())
+            s3_filenames = [f"{timestamp}.jpg"]
+            max_sizes = [self.image_size]
+            if self.full_image:
+                s3_filenames.append(f"{timestamp}-full.jpg")
+                max_sizes.append(None)
 
-            s3_filename = f"{int(time.time())}.jpg"
-            s3_upload(frame_to_jpeg(event.frame), "image/jpg", s3_filename)
+            with _ENCODE_SECONDS.time():
+                images = frame_to_jpegs(frame, max_sizes, self.image_quality)
+            event.release()  # The event is still tracked, but its frame won't be sent again
+            with _UPLOAD_SECONDS.time():
+                for image, s3_filename in zip(images, s3_filenames):
+                    s3_upload(image, "image/jpg", s3_filename)
 
-            send_push_notification(
-                f"{event.camera_name} Motion Detected",
-                f"{config['aws_image_base_url']}/{s3_filename}",
-            )
+            image_urls = [
+                f"{config['aws_image_base_url']}/{s3_filename}" for s3_filename in s3_filenames
+            ]
+            with _NOTIFY_SECONDS.time():
+                send_push_notification(f"{event.camera_name} Motion Detected", *image_urls)
+            ALERTS_SENT.labels(event.camera_name).inc()
 
             logger.info(
                 f"Sending alert for {event.object_name} on camera {event.camera_name} "
@@ -117,25 +384,48 @@ class Notifier:
 class Event:
     """
     Updateable container representing a notification Event.  Allows the representative
-    frame to be updated if one with a higher confidence is available.
+    frame to be updated if one with a higher confidence is available.  The frame is kept
+    scaled down to max_size pixels, if given, and is let go once the alert is sent.
     """
 
-    def __init__(self, frame, detected_object) -> None:
+    def __init__(self, frame, detected_object, max_size=None) -> None:
         self.camera_name = frame.camera_name
         self.object_name = detected_object.name
+        self.max_size = max_size
         self._mutex = threading.Lock()  # Just being cautious here
         self._last_frame_time = 0.0
         self._confidence = 0.0
         self._frame = None
+        self._released = False
 
         self.update(detected_object.confidence, frame.data)
 
-    def update(self, confidence, frame):
+    def touch(self):
+        """Records that the object was seen again in a frame that won't replace the event's"""
+        with self._mutex:
+            self._last_frame_time = time.time()
+
+    def update(self, confidence, frame, max_bytes=None):
+        """
+        Records that the object was seen again, keeping frame if it has a higher confidence.
+
+        :param max_bytes: Most memory the event's frame may use, the current frame is kept if
+        frame would use more than this
+        """
         with self._mutex:
             self._last_frame_time = time.time()
-            if confidence > self._confidence:
-                self._frame = frame
-                self._confidence = confidence
+            if confidence > self._confidence and not self._released:
+                shrunk = _shrink(frame, self.max_size)
+                if max_bytes is None or shrunk.nbytes <= max_bytes:
+                    # Don't hold on to a buffer the camera may reuse
+                    self._frame = shrunk.copy() if shrunk is frame else shrunk
+                    self._confidence = confidence
+
+    def release(self):
+        """Lets go of the frame, it won't be replaced by later updates"""
+        with self._mutex:
+            self._frame = None
+            self._released = True
 
     @property
     def confidence(self):
@@ -147,6 +437,12 @@ class Event:
         with self._mutex:
             return self._frame
 
+    @property
+    def nbytes(self):
+        """Memory used by the event's frame"""
+        with self._mutex:
+            return self._frame.nbytes if self._frame is not None else 0
+
     @property
     def last_frame_time(self):
         with self._mutex:
@@ -1,20 +1,81 @@
 import argparse
 import collections
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+from dataclasses import replace
+import functools
 import logging
+import os
+import queue
+import signal
 import sys
 import threading
+import time
 
 import numpy
-from PIL import Image
 
-from visionalert import tensorflow
-from visionalert import load_config, config
+from visionalert import metrics, scan, tensorflow
+from visionalert import lazy_import, load_config, read_config, config
 from visionalert.alert import Notifier
-from visionalert.detection import Dispatcher, Interest
-from visionalert.video import Camera
+from visionalert.profiling import SamplingProfiler
+from visionalert.detection import (
+    Dispatcher,
+    Interest,
+    Mask,
+    MotionDetector,
+    RegionOfInterest,
+    Tracker,
+)
+from visionalert.video import (
+    AdaptiveFrameRate,
+    Camera,
+    CameraSettings,
+    DecodeThreadBudget,
+    ProcessCamera,
+)
+
+Image = lazy_import("PIL.Image")
 
 logger = logging.getLogger(__name__)
 
+# CameraSettings built from each camera setting that may be changed without reconnecting
+LIVE_CAMERA_SETTINGS = {
+    "interests": ("interests",),
+    "mask": ("mask", "motion_detector", "region_of_interest"),
+    "zones": ("mask", "motion_detector", "region_of_interest"),
+    "motion": ("motion_detector",),
+    "tracking": ("tracker",),
+    "region_of_interest": ("region_of_interest",),
+    "send_delay_seconds": ("send_delay",),
+    "detection_timeout_seconds": ("detection_timeout",),
+}
+# Settings, besides the cameras', that may be changed without restarting
+LIVE_SETTINGS = ("cameras", "connection_timeout_seconds", "read_timeout_seconds")
+
+QUEUE_WAIT_SECONDS = metrics.histogram(
+    "visionalert_queue_wait_seconds",
+    "Time frames spent waiting for object detection",
+    ["camera"],
+)
+QUEUE_FRAMES = metrics.gauge(
+    "visionalert_queue_frames", "Frames waiting for object detection", ["camera"]
+)
+FRAMES_DROPPED = metrics.counter(
+    "visionalert_frames_dropped",
+    "Frames discarded because object detection was behind",
+    ["camera"],
+)
+FPS_LIMIT = metrics.gauge(
+    "visionalert_camera_fps_limit",
+    "Frames per second a camera is limited to because object detection was behind, or 0",
+    ["camera"],
+)
+STARTUP_SECONDS = metrics.gauge(
+    "visionalert_startup_seconds",
+    "Seconds each phase of starting up took, and from starting to the first frame analyzed",
+    ["phase"],
+)
+
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -24,6 +85,24 @@ def parse_args():
         "-c", default="config.yml", dest="config", help="location of configuration file"
     )
     parser.add_argument("--debug", action="store_true", help="enable debug mode")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="start profiling every thread, which SIGUSR2 toggles, at launch",
+    )
+
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    scan_parser = commands.add_parser(
+        "scan", help="search video files for objects instead of monitoring the cameras"
+    )
+    # Suppressed defaults let these be given before or after the command
+    scan_parser.add_argument(
+        "-c", default=argparse.SUPPRESS, dest="config", help="location of configuration file"
+    )
+    scan_parser.add_argument(
+        "--debug", action="store_true", default=argparse.SUPPRESS, help="enable debug mode"
+    )
+    scan.add_arguments(scan_parser)
     return parser.parse_args()
 
 
@@ -37,86 +116,833 @@ def init_logging(debug):
         sys.tracebacklimit = 0
 
 
-def init_camera(config, frame_action):
-    return Camera(
+def init_camera(config, frame_action, input_size=None, decode_budget=None):
+    camera_class = Camera
+    options = {}
+    if config.get("capture_process"):
+        camera_class = ProcessCamera
+        options["ring_slots"] = config.get("capture_ring_frames", 8)
+    if decode_budget is not None:
+        decode_budget.register(
+            config["name"],
+            fps=config.get("fps"),
+            decode=config.get("decode", "all"),
+            threads=config.get("decode_threads"),
+        )
+        options["decode_budget"] = decode_budget
+
+    return camera_class(
         config["name"],
         config["url"],
         frame_action,
-        fps=config.get("fps"),
-        mask=init_mask(config["mask"]) if "mask" in config else None,
+        fps=(
+            init_adaptive_frame_rate(config["adaptive_fps"] or {}, config.get("fps"))
+            if "adaptive_fps" in config
+            else config.get("fps")
+        ),
+        decode=config.get("decode", "all"),
+        input_size=input_size,
+        **vars(init_camera_settings(config)),
+        **options,
+    )
+
+
+def init_camera_settings(config):
+    mask = None
+    if "mask" in config or "zones" in config:
+        mask = init_mask(config.get("mask"), config.get("zones"))
+
+    return CameraSettings(
+        mask=mask,
         interests={
             name: Interest(
                 name,
                 interest["confidence"],
                 interest.get("minimum_area", 0),
                 interest.get("maximum_area", sys.maxsize),
+                send_delay=interest.get("send_delay_seconds"),
+                detection_timeout=interest.get("detection_timeout_seconds"),
             )
             for name, interest in config["interests"].items()
         },
+        motion_detector=(
+            init_motion_detector(config["motion"] or {}, mask)
+            if "motion" in config
+            else None
+        ),
+        send_delay=config.get("send_delay_seconds"),
+        detection_timeout=config.get("detection_timeout_seconds"),
+        tracker=init_tracker(config["tracking"] or {}) if "tracking" in config else None,
+        region_of_interest=(
+            init_region_of_interest(config["region_of_interest"] or {}, mask)
+            if "region_of_interest" in config
+            else None
+        ),
+    )
+
+
+def init_adaptive_frame_rate(config, fps):
+    return AdaptiveFrameRate(
+        config.get("idle_fps", 1),
+        burst_fps=config.get("burst_fps", fps),
+        cooldown=config.get("cooldown_seconds", 30),
+    )
+
+
+def init_backpressure_governor(config, scheduler, cameras):
+    return BackpressureGovernor(
+        scheduler,
+        cameras,
+        interval=config.get("interval_seconds", 1.0),
+        target_occupancy=config.get("target_occupancy", 0.5),
+        headroom=config.get("headroom", 0.9),
+        min_fps=config.get("min_fps", 0.1),
+        keyframe_fps=config.get("keyframes_below_fps"),
+    )
+
+
+def init_cascade(config):
+    cascade = config.get("cascade")
+    if not cascade:
+        return None
+
+    logger.info(f"Checking uncertain objects with {cascade['model_file']}")
+    cascade = tensorflow.create_cascade(
+        cascade["model_file"],
+        config["tensorflow_label_map"],
+        input_width=cascade.get("input_width", 300),
+        input_height=cascade.get("input_height", 300),
+        num_threads=cascade.get("threads"),
+        candidate_margin=cascade.get("candidate_margin", 0.2),
+        accept_margin=cascade.get("accept_margin", 0.2),
+        padding=cascade.get("crop_padding", 0.25),
+        iou_threshold=cascade.get("iou_threshold", 0.3),
+    )
+    cascade.detection_function.warm_up()
+    return cascade
+
+
+def init_detectors(config):
+    detectors = tensorflow.create_detector_pool(
+        config["tensorflow_model_file"],
+        config["tensorflow_label_map"],
+        size=config.get("detector_pool_size", 1),
+        num_threads=config.get("detector_threads"),
+    )
+    for detector in detectors:
+        detector.warm_up()
+    logger.info(
+        f"Started {len(detectors)} object detector(s) using "
+        f"{config.get('detector_threads') or 'default'} thread(s) each"
+    )
+    return detectors
+
+
+def init_decode_budget(config):
+    threads = config.get("decode_thread_budget")
+    if not threads:
+        threads = os.cpu_count() or 1
+        if config.get("detector_threads"):  # Leave the detectors their threads
+            threads -= config["detector_threads"] * config.get("detector_pool_size", 1)
+    return DecodeThreadBudget(
+        max(1, threads), max_latency=config.get("decode_max_latency_seconds", 0.5)
     )
 
 
-def init_mask(filename):
-    image = Image.open(filename)
-    return numpy.asarray(image)
+def init_motion_detector(config, mask):
+    return MotionDetector(
+        threshold=config.get("threshold", 0.005),
+        check_interval=config.get("check_interval_seconds", 10.0),
+        sensitivity=config.get("sensitivity", 25),
+        mask=mask,
+    )
+
+
+def init_config_reloader(config, filename, cameras, create_camera, scheduler, **kwargs):
+    return ConfigReloader(
+        filename,
+        cameras,
+        create_camera,
+        scheduler,
+        interval=config.get("config_reload_interval_seconds", 5) or None,
+        **kwargs,
+    )
+
+
+def init_profiler(config):
+    profiler = SamplingProfiler(
+        interval=config.get("profile_sample_interval_seconds", 0.01),
+        directory=config.get("profile_directory", "profiles"),
+        write_interval=config.get("profile_write_interval_seconds", 60),
+    )
+
+    if hasattr(signal, "SIGUSR2"):  # Not available on Windows
+        signal.signal(signal.SIGUSR2, lambda *_: profiler.toggle())
+    metrics.add_route("/profile", profiler.collapsed)
+    metrics.add_route("/profile/start", lambda: profiler.start() or "Started\n", "POST")
+    metrics.add_route("/profile/stop", lambda: profiler.stop() or "Stopped\n", "POST")
+    return profiler
+
+
+def init_region_of_interest(config, mask):
+    return RegionOfInterest(
+        area=config.get("area"),
+        mask=mask,
+        tiles=config.get("tiles", (1, 1)),
+        overlap=config.get("tile_overlap", 0.1),
+    )
+
+
+def init_tracker(config):
+    return Tracker(
+        detect_interval=config.get("detect_every_frames", 5),
+        iou_threshold=config.get("iou_threshold", 0.3),
+        max_missed=config.get("max_missed_detections", 1),
+        optical_flow=config.get("optical_flow", False),
+    )
+
+
+def init_input_queue(config):
+    slots = config.get("input_queue_frames_per_camera")
+    if slots is None and "input_queue_maximum_frames" in config:
+        # The old setting bounded the frames queued for all cameras together
+        slots = max(1, config["input_queue_maximum_frames"] // len(config["cameras"]))
+        logger.warning(
+            "input_queue_maximum_frames has been replaced by input_queue_frames_per_camera, "
+            f"using {slots} frame(s) per camera"
+        )
+    return FrameScheduler(
+        slots or 1,
+        weights={params["name"]: params.get("weight", 1) for params in config["cameras"]},
+        overflow_action=lambda name: logger.debug(
+            f"Object detection is behind, discarding oldest frame from {name}"
+        ),
+    )
+
+
+def init_mask(filename=None, zones=None):
+    image = numpy.asarray(Image.open(filename).convert("L")) if filename else None
+    return Mask(image, zones)
+
+
+def start_camera(camera):
+    camera.connection_timeout = config["connection_timeout_seconds"]
+    camera.read_timeout = config["read_timeout_seconds"]
+    camera.start()
 
 
 def run():
+    timer = StartupTimer()
     args = parse_args()
     load_config(args.config)
     init_logging(args.debug)
 
-    input_queue = DiscardingQueue(
-        config["input_queue_maximum_frames"],
-        overflow_action=lambda: logger.warning(
-            "Object detection input queue overflow detected, discarding oldest frame!"
-        ),
-    )
+    if args.command == "scan":
+        scan.run(args)
+        return
 
-    cameras = {
-        params["name"]: init_camera(params, input_queue.put)
-        for params in config["cameras"]
-    }
+    if config.get("metrics_port"):
+        metrics.start_http_server(config["metrics_port"])
+    if config.get("stats_interval_seconds"):
+        metrics.start_stats_logger(config["stats_interval_seconds"])
 
-    detector = tensorflow.create_detector(
-        config["tensorflow_model_file"], config["tensorflow_label_map"]
-    )
+    profiler = init_profiler(config)
+    if args.profile:
+        profiler.start()
 
-    dispatcher = Dispatcher(
-        input_queue.get, detector, Notifier().submit_detections, cameras
-    )
+    input_queue = init_input_queue(config)
+
+    # Loading the models, loading the masks and connecting to the cameras are independent, so
+    # they're done at once.  Frames that arrive before the models are ready wait in input_queue.
+    with ThreadPoolExecutor(thread_name_prefix="Startup") as executor:
+        detectors = executor.submit(timer.timed, "detectors", init_detectors, config)
+        cascade = executor.submit(timer.timed, "cascade", init_cascade, config)
+
+        with timer.phase("cameras"):
+            decode_budget = init_decode_budget(config)
+            create_camera = functools.partial(
+                init_camera,
+                frame_action=input_queue.put,
+                input_size=tensorflow.INPUT_SIZE,
+                decode_budget=decode_budget,
+            )
+            cameras = dict(
+                zip(
+                    [params["name"] for params in config["cameras"]],
+                    executor.map(create_camera, config["cameras"]),
+                )
+            )
+            for camera in cameras.values():
+                start_camera(camera)
+        logger.info(
+            f"Sharing {decode_budget.threads} decoding thread(s) between the cameras, "
+            "until their resolutions are known: "
+            + ", ".join(
+                f"{name}={threads}" for name, threads in decode_budget.allocation().items()
+            )
+        )
+
+        event_memory_mb = config.get("alert_event_memory_mb", 256)
+        notifier = Notifier(
+            detection_timeout=config.get("alert_detection_timeout_seconds", 30),
+            send_delay=config.get("alert_send_delay_seconds", 5),
+            max_workers=config.get("alert_workers", 4),
+            image_size=config.get("alert_image_size", 1024),
+            image_quality=config.get("alert_image_quality", 75),
+            full_image=config.get("alert_full_image", False),
+            max_event_bytes=event_memory_mb * 1024 * 1024 if event_memory_mb else None,
+            cameras=cameras,
+        )
+
+        dispatcher = Dispatcher(
+            input_queue.get,
+            detectors.result(),
+            notifier.submit_detections,
+            cameras,
+            batch_size=config.get("detection_batch_size", 1),
+            batch_timeout=config.get("detection_batch_timeout_seconds", 0.0),
+            cascade=cascade.result(),
+        )
     dispatcher.start()
+    timer.record("ready")
+    timer.record_event("first_detection", dispatcher.first_analyzed)
+
+    governor = None
+    if "backpressure" in config:
+        governor = init_backpressure_governor(config["backpressure"] or {}, input_queue, cameras)
+        governor.start()
 
-    for camera in cameras.values():
-        camera.connection_timeout = config["connection_timeout_seconds"]
-        camera.read_timeout = config["read_timeout_seconds"]
-        camera.start()
+    reloader = init_config_reloader(
+        config,
+        args.config,
+        cameras,
+        create_camera,
+        input_queue,
+        decode_budget=decode_budget,
+        governor=governor,
+    )
+    if hasattr(signal, "SIGHUP"):  # Not available on Windows
+        signal.signal(signal.SIGHUP, lambda *_: reloader.request())
+    reloader.start()
 
     dispatcher.join()
 
 
-class DiscardingQueue:
-    """A bounded queue that discards the oldest items when it overflows"""
+class StartupTimer:
+    """
+    Times each phase of starting up, logging how long it took and reporting it with the
+    visionalert_startup_seconds metric.  Phases may run at once, in different threads.
+    Milestones, such as the first frame being analyzed, are recorded as the time since the
+    timer was created.
+    """
 
-    def __init__(self, max_size, overflow_action=None) -> None:
-        self._deque = collections.deque(maxlen=max_size)
-        self._semaphore = threading.BoundedSemaphore(max_size)
-        self._overflow_action = overflow_action
-        for _ in range(max_size):
-            self._semaphore.acquire()
+    def __init__(self):
+        self.start_time = time.monotonic()
 
-    def put(self, item):
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager that times its block as the phase called name"""
+        start_time = time.monotonic()
         try:
-            self._deque.appendleft(item)
-            self._semaphore.release()
-        except ValueError:
+            yield
+        finally:
+            self._report(name, time.monotonic() - start_time, "took")
+
+    def timed(self, name, function, *args, **kwargs):
+        """Calls function with the given arguments, timing it as the phase called name"""
+        with self.phase(name):
+            return function(*args, **kwargs)
+
+    def record(self, name):
+        """Records the time since the timer was created as the milestone called name"""
+        self._report(name, time.monotonic() - self.start_time, "reached after")
+
+    def record_event(self, name, event):
+        """Records the milestone called name once event is set, without waiting for it"""
+
+        def wait():
+            event.wait()
+            self.record(name)
+
+        threading.Thread(name=f"{self.__class__.__name__}-{name}", daemon=True, target=wait).start()
+
+    @staticmethod
+    def _report(name, seconds, verb):
+        STARTUP_SECONDS.labels(name).set(seconds)
+        logger.info(f"Startup phase {name} {verb} {seconds:.2f}s")
+
+
+class FrameScheduler:
+    """
+    Holds the latest few frames from each camera and hands them out fairly.  When a camera
+    has more frames waiting than it has slots for, its oldest frame is discarded, so a busy
+    camera can't push out frames from the quiet ones.  Cameras with frames waiting are served
+    in smooth weighted round-robin order.
+
+    :param slots: Number of frames held for each camera
+    :param weights: dict mapping camera names to their weight, defaults to 1.  When several
+    cameras have frames waiting, a camera is served in proportion to its weight.
+    :param overflow_action: Called with the camera name when a frame is discarded
+    """
+
+    def __init__(self, slots=1, weights=None, overflow_action=None) -> None:
+        self.received = collections.Counter()  # Frames put for each camera
+        self.dropped = collections.Counter()  # Frames discarded for each camera
+        self.served = 0  # Frames taken by get
+        self._slots = slots
+        self._weights = weights or {}
+        self._overflow_action = overflow_action
+        self._condition = threading.Condition()
+        self._mailboxes = {}
+        self._credits = collections.Counter()
+        self._waiting = 0
+        self._removed = set()  # Cameras whose late frames are dropped until they're added again
+
+    def put(self, frame):
+        name = frame.camera_name
+        with self._condition:
+            if name in self._removed:
+                return
+            mailbox = self._mailboxes.get(name)
+            if mailbox is None:
+                mailbox = self._mailboxes[name] = collections.deque(maxlen=self._slots)
+                QUEUE_FRAMES.labels(name).set_function(mailbox.__len__)
+
+            self.received[name] += 1
+            overflow = len(mailbox) == self._slots
+            if overflow:
+                self.dropped[name] += 1
+            else:
+                self._waiting += 1
+            mailbox.append((time.monotonic(), frame))
+            self._condition.notify()
+
+        if overflow:
+            FRAMES_DROPPED.labels(name).inc()
             if self._overflow_action:
-                self._overflow_action()
+                self._overflow_action(name)
+
+    def get(self, timeout=None):
+        """Removes and returns the next frame, raising queue.Empty if timeout expires first"""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._waiting, timeout):
+                raise queue.Empty
+            self._waiting -= 1
+            self.served += 1
+            queued, frame = self._mailboxes[self._next_camera()].popleft()
+
+        QUEUE_WAIT_SECONDS.labels(frame.camera_name).observe(time.monotonic() - queued)
+        return frame
+
+    @property
+    def weights(self):
+        return self._weights
+
+    def set_weight(self, name, weight):
+        """Sets a camera's weight, adding it again if it had been removed"""
+        with self._condition:
+            self._weights[name] = weight
+            self._removed.discard(name)
+
+    def remove_camera(self, name):
+        """
+        Discards the frames waiting from a camera that's been removed, and its weight.  Frames
+        it puts afterwards are dropped until set_weight adds it again.
+        """
+        with self._condition:
+            self._removed.add(name)
+            mailbox = self._mailboxes.pop(name, None)
+            if mailbox:
+                self._waiting -= len(mailbox)
+            self._credits.pop(name, None)
+            self._weights.pop(name, None)
+        QUEUE_FRAMES.remove(name)
+
+    def statistics(self):
+        """
+        Tuple of the number of frames served so far, a Counter of the frames received from
+        each camera and the number of frames discarded
+        """
+        with self._condition:
+            return self.served, collections.Counter(self.received), sum(self.dropped.values())
+
+    @property
+    def occupancy(self):
+        """Fraction of the slots of the cameras that have sent frames that are holding one"""
+        with self._condition:
+            slots = self._slots * len(self._mailboxes)
+            return self._waiting / slots if slots else 0.0
+
+    def _next_camera(self):
+        total = 0
+        selected = None
+        for name, mailbox in self._mailboxes.items():
+            if mailbox:
+                weight = self._weights.get(name, 1)
+                self._credits[name] += weight
+                total += weight
+                if selected is None or self._credits[name] > self._credits[selected]:
+                    selected = name
+        self._credits[selected] -= total
+        return selected
+
+
+class BackpressureGovernor:
+    """
+    Feeds back how fast object detection takes frames from a FrameScheduler to the cameras
+    so that, when it falls behind, the cameras capture fewer frames rather than decoding and
+    converting frames the scheduler then discards.  Every interval seconds, if frames were
+    discarded or the scheduler is fuller than target_occupancy, the rate frames were taken
+    at is shared fairly between the cameras and each camera's FrameRateLimit is lowered to
+    its share.  Once detection keeps up again the limits are raised by increase each
+    interval, and removed once cameras no longer reach them.  Cameras limited below
+    keyframe_fps only decode keyframes, skipping the decoding of most frames altogether.
+
+    :param scheduler: FrameScheduler the cameras put their frames in
+    :param cameras: dict mapping camera names to a Camera object
+    :param interval: Seconds between adjustments
+    :param target_occupancy: Fraction of the scheduler's slots that may be full before the
+    cameras are limited
+    :param headroom: Fraction of the rate frames were taken at that's shared out, leaving
+    object detection room to catch up
+    :param increase: Factor limits are raised by each interval detection keeps up
+    :param min_fps: Lowest limit a camera is given
+    :param keyframe_fps: Limit below which cameras only decode keyframes, or None to always
+    decode as configured
+    """
+
+    def __init__(
+        self,
+        scheduler,
+        cameras,
+        interval=1.0,
+        target_occupancy=0.5,
+        headroom=0.9,
+        increase=1.25,
+        min_fps=0.1,
+        keyframe_fps=None,
+    ):
+        self.scheduler = scheduler
+        self.cameras = cameras
+        self.interval = interval
+        self.target_occupancy = target_occupancy
+        self.headroom = headroom
+        self.increase = increase
+        self.min_fps = min_fps
+        self.keyframe_fps = keyframe_fps
+        self._last_time = time.monotonic()
+        self._last_counts = scheduler.statistics()
+
+        for name in cameras:
+            self.add_camera(name)
+
+    def add_camera(self, name):
+        """Reports the limit of a camera with the visionalert_camera_fps_limit metric"""
+        FPS_LIMIT.labels(name).set_function(lambda: self._current_limit(name))
+
+    def remove_camera(self, name):
+        FPS_LIMIT.remove(name)
+
+    def _current_limit(self, name):
+        camera = self.cameras.get(name)
+        return (camera.fps_limit.fps or 0) if camera else 0
+
+    def start(self):
+        threading.Thread(
+            name=self.__class__.__name__, daemon=True, target=self._adjust_loop
+        ).start()
+
+    def _adjust_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.adjust()
+            except Exception as e:
+                logger.error(f"Error encountered adjusting camera frame rates: {e}")
 
-    def get(self):
-        self._semaphore.acquire()
-        return self._deque.pop()
+    def adjust(self):
+        """Lowers or raises the cameras' limits from what happened since the last adjustment"""
+        now = time.monotonic()
+        elapsed = max(now - self._last_time, 1e-6)
+        counts = self.scheduler.statistics()
+        served, received, dropped = (
+            current - previous for current, previous in zip(counts, self._last_counts)
+        )
+        self._last_time, self._last_counts = now, counts
 
+        # Cameras may be added or removed by a ConfigReloader while this runs
+        rates = {name: received[name] / elapsed for name in list(self.cameras)}
+        if dropped or self.scheduler.occupancy > self.target_occupancy:
+            if served:
+                self._lower(rates, served / elapsed * self.headroom)
+        else:
+            self._raise(rates)
+
+    def _lower(self, rates, capacity):
+        shares = fair_shares(rates, self.scheduler.weights, capacity)
+        for name, share in shares.items():
+            if share < rates[name]:
+                self._limit(name, max(share, self.min_fps))
+
+    def _raise(self, rates):
+        for name in rates:
+            camera = self.cameras.get(name)
+            if camera is None:
+                continue
+            limit = camera.fps_limit.fps
+            if limit is None:
+                continue
+            if rates[name] < limit * 0.8:  # Not held back by the limit any more
+                self._limit(name, None)
+            else:
+                self._limit(name, limit * self.increase)
+
+    def _limit(self, name, fps):
+        camera = self.cameras.get(name)
+        if camera is None:
+            return
+        fps_limit = camera.fps_limit
+        keyframes = bool(fps and self.keyframe_fps and fps < self.keyframe_fps)
+        if (fps_limit.fps is None) != (fps is None) or fps_limit.keyframes != keyframes:
+            if fps is None:
+                logger.info(f"Object detection has caught up, no longer limiting {name}")
+            else:
+                logger.info(
+                    f"Object detection is behind, limiting {name} to {fps:.2f} fps"
+                    + (" of keyframes" if keyframes else "")
+                )
+        fps_limit.set(fps, keyframes)
+
+
+def fair_shares(demands, weights, capacity):
+    """
+    Shares capacity between the demands so that each gets its weighted share, unless it
+    demands less, in which case it gets its demand and the rest is shared by the others.
+
+    :param demands: dict mapping names to what each demands
+    :param weights: dict mapping names to their weight, defaults to 1
+    :return: dict mapping each name to its share
+    """
+    shares = {}
+    remaining = capacity
+    unsatisfied = dict(demands)
+    while unsatisfied:
+        total_weight = sum(weights.get(name, 1) for name in unsatisfied)
+        satisfied = {
+            name: demand
+            for name, demand in unsatisfied.items()
+            if demand <= remaining * weights.get(name, 1) / total_weight
+        }
+        if not satisfied:
+            for name in unsatisfied:
+                shares[name] = remaining * weights.get(name, 1) / total_weight
+            break
+
+        for name, demand in satisfied.items():
+            shares[name] = demand
+            remaining -= demand
+            del unsatisfied[name]
+    return shares
+
+
+class ConfigReloader:
+    """
+    Applies changes to the configuration file without restarting, when asked to by calling
+    request(), such as on SIGHUP, or when the file is modified.  Only what changed is touched:
+    cameras that were added are started, those that were removed are stopped and those whose
+    connection settings changed are reconnected.  Changes to a camera's LIVE_CAMERA_SETTINGS,
+    such as its interests or mask, are swapped into the running camera without reconnecting.
+    The object detectors and the Notifier, along with the events it's waiting to send, are
+    kept as they are, so changes to settings other than LIVE_SETTINGS are only logged as
+    needing a restart.  If the file can't be read, or a camera's new settings can't be
+    applied, the running configuration is kept.
+
+    :param filename: The configuration file
+    :param cameras: dict mapping camera names to the running Cameras, which is updated in place
+    :param create_camera: Takes a camera's configuration and returns a new Camera
+    :param scheduler: FrameScheduler the cameras put their frames in
+    :param decode_budget: DecodeThreadBudget the cameras share, if any
+    :param governor: BackpressureGovernor limiting the cameras, if any
+    :param interval: Seconds between checking whether the file was modified, or None to only
+    reload when asked to.  A modified file is only reloaded once it's stopped changing.
+    :param stop_timeout: Most seconds to wait for a camera to disconnect before reconnecting
+    """
+
+    def __init__(
+        self,
+        filename,
+        cameras,
+        create_camera,
+        scheduler,
+        decode_budget=None,
+        governor=None,
+        interval=None,
+        stop_timeout=10.0,
+    ):
+        self.filename = filename
+        self.cameras = cameras
+        self.create_camera = create_camera
+        self.scheduler = scheduler
+        self.decode_budget = decode_budget
+        self.governor = governor
+        self.interval = interval
+        self.stop_timeout = stop_timeout
+        self._requested = threading.Event()
+        self._modified_time = None
+
+    def start(self):
+        self._modified_time = self._modified()
+        threading.Thread(
+            name=self.__class__.__name__, daemon=True, target=self._watch_loop
+        ).start()
+
+    def request(self):
+        """Reloads the configuration as soon as possible"""
+        self._requested.set()
+
+    def _watch_loop(self):
+        pending = None
+        while True:
+            requested = self._requested.wait(self.interval)
+            self._requested.clear()
+            modified = self._modified()
+            if not requested:
+                if modified == self._modified_time:
+                    continue
+                if modified != pending:  # Wait for it to stop changing, it may be half saved
+                    pending = modified
+                    continue
+
+            self._modified_time, pending = modified, None
+            try:
+                self.reload()
+            except Exception as e:
+                logger.error(f"Error encountered reloading the configuration: {e}")
+
+    def _modified(self):
+        try:
+            return os.stat(self.filename).st_mtime_ns
+        except OSError:
+            return None
+
+    def reload(self):
+        """
+        Reads the configuration file and applies what changed since it was last applied
+
+        :return: True if it was applied, False if it couldn't be read
+        """
+        try:
+            new_config = read_config(self.filename)
+            if not new_config or not new_config.get("cameras"):
+                raise ValueError("it has no cameras")
+            new_cameras = {params["name"]: params for params in new_config["cameras"]}
+        except Exception as e:
+            logger.error(
+                f"Unable to reload {self.filename}, keeping the running configuration: {e}"
+            )
+            return False
+
+        needs_restart = sorted(
+            key
+            for key in config.keys() | new_config.keys()
+            if key not in LIVE_SETTINGS and config.get(key) != new_config.get(key)
+        )
+        if needs_restart:
+            logger.warning(f"Changes to {', '.join(needs_restart)} take effect after restarting")
+
+        for key in LIVE_SETTINGS:
+            if key != "cameras" and key in new_config:
+                config[key] = new_config[key]
+        for camera in self.cameras.values():
+            camera.connection_timeout = config["connection_timeout_seconds"]
+            camera.read_timeout = config["read_timeout_seconds"]
+
+        old_cameras = {params["name"]: params for params in config["cameras"]}
+        for name in old_cameras.keys() - new_cameras.keys():
+            self._remove(name)
+
+        # Cameras whose new settings can't be applied keep running with their old ones
+        applied = []
+        for name, params in new_cameras.items():
+            old_params = old_cameras.get(name)
+            try:
+                if old_params is None:
+                    self._add(params)
+                elif params != old_params:
+                    self._update(old_params, params)
+            except Exception as e:
+                logger.error(f"Unable to apply the configuration of camera {name}: {e}")
+                params = old_params
+            if params is not None:
+                applied.append(params)
+        config["cameras"] = applied
+
+        logger.info(f"Reloaded {self.filename}")
+        return True
+
+    def _add(self, params):
+        name = params["name"]
+        camera = self.create_camera(params)
+        self.scheduler.set_weight(name, params.get("weight", 1))
+        self.cameras[name] = camera
+        if self.governor:
+            self.governor.add_camera(name)
+        start_camera(camera)
+        logger.info(f"Added camera {name}")
+
+    def _remove(self, name):
+        camera = self.cameras[name]
+        camera.stop(self.stop_timeout)
+        self.scheduler.remove_camera(name)
+        del self.cameras[name]
+        if self.decode_budget:
+            self.decode_budget.unregister(name)
+        if self.governor:
+            self.governor.remove_camera(name)
+        logger.info(f"Removed camera {name}")
+
+    def _update(self, old_params, params):
+        name = params["name"]
+        changed = {
+            key
+            for key in old_params.keys() | params.keys()
+            if old_params.get(key) != params.get(key)
+        }
+        if "weight" in changed:
+            self.scheduler.set_weight(name, params.get("weight", 1))
+            changed.discard("weight")
+        if not changed:
+            return
+
+        camera = self.cameras[name]
+        settings = init_camera_settings(params)
+        attributes = {
+            attribute for key in changed for attribute in LIVE_CAMERA_SETTINGS.get(key, ())
+        }
+        reconnect = not changed <= LIVE_CAMERA_SETTINGS.keys() or (
+            # Capture processes are given the region of interest when they start
+            isinstance(camera, ProcessCamera)
+            and "region_of_interest" in attributes
+            and (
+                camera.region_of_interest is not None or settings.region_of_interest is not None
+            )
+        )
+
+        if reconnect:
+            logger.info(
+                f"Reconnecting to camera {name} to apply changes to {', '.join(sorted(changed))}"
+            )
+            replacement = self.create_camera(params)
+            camera.stop(self.stop_timeout)
+            self.cameras[name] = replacement
+            start_camera(replacement)
+        else:
+            # Swapped in a single assignment so the camera's threads never see a mix of both
+            camera.settings = replace(
+                camera.settings,
+                **{attribute: getattr(settings, attribute) for attribute in attributes},
+            )
+            logger.info(f"Applied changes to {', '.join(sorted(changed))} of camera {name}")
 
 if __name__ == "__main__":
     run()
@@ -1,14 +1,46 @@
 import collections
-from dataclasses import dataclass
+import contextlib
+from dataclasses import dataclass, replace
+import itertools
 import logging
+import math
+import queue
 import threading
+import time
 
-import cv2
+import numpy
+
+from visionalert import lazy_import, metrics
+
+cv2 = lazy_import("cv2")
 
 logger = logging.getLogger(__name__)
 
+DISPATCH_SECONDS = metrics.histogram(
+    "visionalert_dispatch_seconds",
+    "Time spent filtering and annotating the detections in each frame",
+    ["stage"],
+)
+_FILTER_SECONDS = DISPATCH_SECONDS.labels("filter")
+_ANNOTATE_SECONDS = DISPATCH_SECONDS.labels("annotate")
+_CASCADE_SECONDS = DISPATCH_SECONDS.labels("cascade")
+FRAMES_ANALYZED = metrics.counter(
+    "visionalert_frames_analyzed", "Frames checked for objects", ["camera"]
+)
+CASCADE_CANDIDATES = metrics.counter(
+    "visionalert_cascade_candidates",
+    "Objects the first stage of a detector cascade was unsure of, by the second stage's verdict",
+    ["camera", "result"],
+)
+FRAMES_TRACKED = metrics.counter(
+    "visionalert_frames_tracked",
+    "Frames checked by following tracked objects instead of running object detection",
+    ["camera"],
+)
+
+# track_id identifies the same object across frames when the camera has a Tracker
 DetectionResult = collections.namedtuple(
-    "DetectionResult", ["name", "confidence", "coordinates"]
+    "DetectionResult", ["name", "confidence", "coordinates", "track_id"], defaults=(None,)
 )
 
 
@@ -20,6 +52,8 @@ class Interest:
     confidence: float
     minimum_area: int
     maximum_area: int
+    send_delay: float = None  # Overrides the camera's, if set
+    detection_timeout: float = None  # Overrides the camera's, if set
 
 
 @dataclass
@@ -36,15 +70,190 @@ class Rectangle:
         return (self.end_x - self.start_x) * (self.end_y - self.start_y)
 
 
-def is_masked(mask, rectangle):
+class Detections:
+    """
+    Objects detected in a frame, held as arrays with one element per object so that they can
+    be filtered without creating Python objects for each.  Indexing or iterating produces
+    DetectionResults.
+
+    :param labels: List mapping class ids to object names
+    :param class_ids: Integer nd_array of class ids
+    :param scores: nd_array of confidence scores
+    :param boxes: Integer nd_array of shape (n, 4) containing start_x, start_y, end_x, end_y
+    :param track_ids: Integer nd_array of the id of each object's track, if they're tracked
+    """
+
+    __slots__ = ("labels", "class_ids", "scores", "boxes", "areas", "track_ids")
+
+    def __init__(self, labels, class_ids, scores, boxes, track_ids=None):
+        self.labels = labels
+        self.class_ids = class_ids
+        self.scores = scores
+        self.boxes = boxes
+        self.track_ids = track_ids
+        self.areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __getitem__(self, index):
+        return DetectionResult(
+            name=self.labels[self.class_ids[index]],
+            confidence=self.scores[index].item(),
+            coordinates=Rectangle(*self.boxes[index].tolist()),
+            track_id=None if self.track_ids is None else self.track_ids[index].item(),
+        )
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def select(self, keep):
+        """Returns Detections containing the objects selected by the index or boolean nd_array keep"""
+        return Detections(
+            self.labels,
+            self.class_ids[keep],
+            self.scores[keep],
+            self.boxes[keep],
+            None if self.track_ids is None else self.track_ids[keep],
+        )
+
+
+class InterestFilter:
+    """
+    A camera's interests compiled into arrays indexed by class id so that Detections can be
+    checked against all of them in a single pass.  Call it with Detections to receive the
+    Detections that match an interest, as matches_interest would decide.
+
+    :param interests: dict containing an object name to Interest map
+    :param labels: List mapping class ids to object names
+    """
+
+    def __init__(self, interests, labels):
+        self.interests = interests
+        self.labels = labels
+
+        # Rows of confidence, minimum and maximum area for each class id.  Classes we aren't
+        # interested in, and the extra row any unknown class id is clipped to, require an
+        # infinite confidence which no detection can reach.
+        self._limits = numpy.zeros((len(labels) + 1, 3))
+        self._limits[:, 0] = numpy.inf
+        for class_id, name in enumerate(labels):
+            if interests and name in interests:
+                interest = interests[name]
+                self._limits[class_id] = (
+                    interest.confidence,
+                    interest.minimum_area,
+                    interest.maximum_area,
+                )
+
+    def confidences(self, detections):
+        """nd_array of the confidence each of the detections needs to match an interest"""
+        return self._limits.take(detections.class_ids, axis=0, mode="clip")[:, 0]
+
+    def __call__(self, detections):
+        limits = self._limits.take(detections.class_ids, axis=0, mode="clip")
+        return detections.select(
+            (detections.scores >= limits[:, 0])
+            & (detections.areas >= limits[:, 1])
+            & (detections.areas <= limits[:, 2])
+        )
+
+
+class Mask:
+    """
+    The areas of a camera's view that we're interested in.  It's built from a grayscale image,
+    where white (255) pixels are of interest, and/or polygon zones of interest.  The mask is
+    scaled to whatever resolution it's used at and a summed-area table is computed once for
+    each resolution so that checking a rectangle takes four lookups, no matter its size.
+
+    :param image: Single channel nd_array where the value 255 is considered unmasked
+    :param zones: List of polygons that are unmasked, each a list of (x, y) points given as
+    fractions (0.0-1.0) of the width and height of the image
+    """
+
+    def __init__(self, image=None, zones=None):
+        self.image = image
+        self.zones = [numpy.asarray(zone, dtype=numpy.float64) for zone in zones or []]
+        self._lock = threading.Lock()
+        self._regions = {}
+        self._tables = {}
+
+    def region(self, shape):
+        """Boolean nd_array of the given (height, width) that is True where unmasked"""
+        height, width = shape[:2]
+        region = self._regions.get((height, width))
+        if region is None:
+            with self._lock:
+                region = self._regions.setdefault((height, width), self._rasterize(height, width))
+        return region
+
+    def __getstate__(self):
+        # Capture processes are sent a copy, which rasterizes its own regions
+        return {"image": self.image, "zones": self.zones}
+
+    def __setstate__(self, state):
+        self.__init__(state["image"], state["zones"])
+
+    def is_masked(self, rectangle, shape=None):
+        """
+        Returns True if rectangle is entirely inside the masked area
+
+        :param shape: Shape of the image rectangle is in, defaults to the shape of the mask image
+        """
+        height, width = (shape or self.image.shape)[:2]
+        table = self._tables.get((height, width))
+        if table is None:
+            region = self.region((height, width))
+            with self._lock:
+                table = self._tables.setdefault(
+                    (height, width), cv2.integral(region.view(numpy.uint8))
+                )
+
+        start_x, end_x = (min(max(x, 0), width) for x in (rectangle.start_x, rectangle.end_x))
+        start_y, end_y = (min(max(y, 0), height) for y in (rectangle.start_y, rectangle.end_y))
+        unmasked = (
+            table[end_y, end_x]
+            - table[start_y, end_x]
+            - table[end_y, start_x]
+            + table[start_y, start_x]
+        )
+        return bool(unmasked == 0)
+
+    def _rasterize(self, height, width):
+        if self.image is None and not self.zones:
+            return numpy.ones((height, width), dtype=bool)
+
+        region = numpy.zeros((height, width), dtype=bool)
+        if self.image is not None:
+            image = self.image
+            if image.shape[:2] != (height, width):
+                image = cv2.resize(image, (width, height), interpolation=cv2.INTER_NEAREST)
+            region |= image == 255
+
+        if self.zones:
+            zones = numpy.zeros((height, width), dtype=numpy.uint8)
+            cv2.fillPoly(
+                zones,
+                [numpy.round(zone * (width, height)).astype(numpy.int32) for zone in self.zones],
+                1,
+            )
+            region |= zones.view(bool)
+
+        return region
+
+
+def is_masked(mask, rectangle, shape=None):
     """
     Evaluates rectangle against mask returning true if the rectangle is entirely
     inside the masked area containing zeros
 
-    :param mask: Numpy 2-dimensional nd_array where the value 255 is considered unmasked.
+    :param mask: Mask, or a numpy 2-dimensional nd_array where the value 255 is considered unmasked.
     :param rectangle: Rectangle to compare against the mask
+    :param shape: Shape of the frame rectangle is in.  A Mask is scaled to it if required.
     """
-    if mask is not None:
+    if isinstance(mask, Mask):
+        return mask.is_masked(rectangle, shape)
+    elif mask is not None:
         return (
             255
             not in mask[
@@ -55,6 +264,87 @@ def is_masked(mask, rectangle):
         return False
 
 
+class RegionOfInterest:
+    """
+    The part of a camera's frames worth analyzing, so that object detection isn't spent on
+    the rest.  The region is cropped from each frame and scaled to the detector's input size,
+    rather than the whole frame, which keeps distant objects in it large enough to detect.  It
+    may be split into overlapping tiles, all the same size, that are each analyzed separately.
+
+    :param area: Relative coordinates (start_x, start_y, end_x, end_y), fractions (0.0-1.0) of
+    the width and height of the frame.  If None, the bounding box of mask's unmasked area.
+    :param mask: Camera Mask the region is taken from when area isn't given
+    :param tiles: Number of (columns, rows) of tiles to split the region into
+    :param overlap: Fraction of each tile that overlaps its neighbours, so that objects on a
+    seam are whole in at least one tile
+    """
+
+    def __init__(self, area=None, mask=None, tiles=(1, 1), overlap=0.1):
+        self.area = area
+        self.mask = mask
+        self.tiles = tuple(tiles)
+        self.overlap = overlap
+        self._lock = threading.Lock()
+        self._regions = {}
+
+    def regions(self, shape):
+        """
+        Tuple of the tiles of a frame of the given shape to analyze, each a tuple of
+        start_x, start_y, end_x, end_y pixel coordinates
+        """
+        height, width = shape[:2]
+        regions = self._regions.get((height, width))
+        if regions is None:
+            with self._lock:
+                regions = self._regions.setdefault(
+                    (height, width), self._tile(*self._bounds(height, width))
+                )
+        return regions
+
+    def __getstate__(self):
+        # Capture processes are sent a copy, which works out its own regions
+        return {"area": self.area, "mask": self.mask, "tiles": self.tiles, "overlap": self.overlap}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _bounds(self, height, width):
+        if self.area is not None:
+            scaled = numpy.round(numpy.asarray(self.area) * (width, height, width, height))
+            start_x, start_y, end_x, end_y = numpy.clip(scaled, 0, (width, height) * 2).astype(int)
+            if end_x > start_x and end_y > start_y:
+                return start_x, start_y, end_x, end_y
+
+        elif self.mask is not None:
+            unmasked = self.mask.region((height, width))
+            columns = numpy.flatnonzero(unmasked.any(axis=0))
+            rows = numpy.flatnonzero(unmasked.any(axis=1))
+            if len(columns):
+                return columns[0], rows[0], columns[-1] + 1, rows[-1] + 1
+
+        return 0, 0, width, height
+
+    def _tile(self, start_x, start_y, end_x, end_y):
+        columns, rows = self.tiles
+        width, height = end_x - start_x, end_y - start_y
+        tile_width = min(width, math.ceil(width / (columns - (columns - 1) * self.overlap)))
+        tile_height = min(height, math.ceil(height / (rows - (rows - 1) * self.overlap)))
+        # Spread the tiles evenly so the last lines up with the end of the region
+        xs = numpy.linspace(start_x, end_x - tile_width, columns).round().astype(int)
+        ys = numpy.linspace(start_y, end_y - tile_height, rows).round().astype(int)
+        return tuple(
+            (int(x), int(y), int(x) + tile_width, int(y) + tile_height) for y in ys for x in xs
+        )
+
+
+def _unmasked(mask, detections, shape):
+    """The Detections that aren't entirely inside the masked area of a frame of shape"""
+    if mask is None or not len(detections):
+        return detections
+    keep = [not is_masked(mask, Rectangle(*box), shape) for box in detections.boxes.tolist()]
+    return detections.select(numpy.array(keep, dtype=bool))
+
+
 def matches_interest(interests, detected_object):
     """
     Evaluates whether the detected_object matches the criteria defined by the dict
@@ -79,6 +369,453 @@ def outside_area_limits(interests, detected_object):
     return area < interest.minimum_area or area > interest.maximum_area
 
 
+class MotionDetector:
+    """
+    Cheap check for motion in a camera's frames, used to skip object detection while the
+    scene is static.  Frames are downscaled to grayscale and compared to a running average
+    of the scene.  Call it with an RGB nd_array, it returns True if the frame should be
+    analyzed.
+
+    :param threshold: Fraction of the unmasked pixels that must change for there to be motion
+    :param check_interval: Report motion if we haven't for this many seconds of video so that
+    objects that stopped moving are still checked periodically
+    :param mask: Camera Mask, motion in masked areas is ignored
+    :param sensitivity: Minimum change in the brightness (0-255) of a pixel to count as motion
+    :param width: Width frames are downscaled to before comparison
+    :param learning_rate: Weight of each new frame in the running average of the scene
+    """
+
+    def __init__(
+        self,
+        threshold=0.005,
+        check_interval=10.0,
+        mask=None,
+        sensitivity=25,
+        width=160,
+        learning_rate=0.05,
+    ):
+        self.threshold = threshold
+        self.check_interval = check_interval
+        self.mask = mask
+        self.sensitivity = sensitivity
+        self.width = width
+        self.learning_rate = learning_rate
+        self.checked = 0  # Frames that were passed on to be analyzed
+        self.skipped = 0  # Frames without motion that were skipped
+        self.moving = False  # If there was motion in the last frame
+        self._background = None
+        self._last_check = None
+
+    def __call__(self, frame, frame_time=None):
+        """
+        :param frame: RGB nd_array
+        :param frame_time: Seconds into the video the frame was captured at, so that recordings
+        analyzed faster than real time are checked every check_interval seconds of video.
+        Defaults to the current time.
+        """
+        now = time.monotonic() if frame_time is None else frame_time
+        motion = self.moving = self._has_motion(frame)
+        # Timestamps start again from zero when a camera reconnects
+        if (
+            motion
+            or self._last_check is None
+            or not 0 <= now - self._last_check < self.check_interval
+        ):
+            self._last_check = now
+            self.checked += 1
+            return True
+
+        self.skipped += 1
+        return False
+
+    def _has_motion(self, frame):
+        height = max(1, round(frame.shape[0] * self.width / frame.shape[1]))
+        small = cv2.resize(frame, (self.width, height), interpolation=cv2.INTER_AREA)
+        gray = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_RGB2GRAY), (5, 5), 0)
+
+        if self._background is None or self._background.shape != gray.shape:
+            self._background = gray.astype(numpy.float32)
+            return True
+
+        changed = cv2.absdiff(gray, cv2.convertScaleAbs(self._background)) > self.sensitivity
+        cv2.accumulateWeighted(gray, self._background, self.learning_rate)
+
+        if self.mask is None:
+            return numpy.count_nonzero(changed) > self.threshold * changed.size
+
+        region = self.mask.region(gray.shape)
+        area = numpy.count_nonzero(region)
+        return numpy.count_nonzero(changed & region) > self.threshold * area
+
+
+class Tracker:
+    """
+    Follows the objects detected in a camera's frames so that object detection needn't run on
+    every frame.  Each time detection runs, the objects found are matched to the tracked
+    objects whose boxes overlap them the most, so an object keeps its track id from frame to
+    frame.  On the frames in between, the tracked boxes are moved along at the speed they were
+    last seen moving or, with optical_flow, by following points inside each box.
+
+    :param detect_interval: Run object detection on one in this many frames
+    :param iou_threshold: Minimum intersection over union of a tracked and a detected box for
+    them to be the same object
+    :param max_missed: Forget an object after it's missing from this many detections in a row
+    :param optical_flow: Move boxes by the optical flow of the frame's model input, rather than
+    by the speed they last moved at.  Slower, but follows objects that change direction.
+    """
+
+    # Arrays with an element for each tracked object
+    _TRACK_ARRAYS = (
+        "_class_ids",
+        "_scores",
+        "_track_ids",
+        "_boxes",
+        "_detected_boxes",
+        "_velocities",
+        "_ages",
+        "_missed",
+    )
+
+    def __init__(self, detect_interval=5, iou_threshold=0.3, max_missed=1, optical_flow=False):
+        self.detect_interval = detect_interval
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.optical_flow = optical_flow
+        self._lock = threading.Lock()
+        self._track_id_sequence = itertools.count(1)
+        self._labels = []
+        self._class_ids = numpy.empty(0, dtype=numpy.int64)
+        self._scores = numpy.empty(0, dtype=numpy.float32)
+        self._track_ids = numpy.empty(0, dtype=numpy.int64)
+        self._boxes = numpy.empty((0, 4))  # Where each object is thought to be now
+        self._detected_boxes = numpy.empty((0, 4))  # Where each object was last detected
+        self._velocities = numpy.empty((0, 4))  # Pixels each box moves per frame
+        self._ages = numpy.empty(0, dtype=numpy.int64)  # Frames since each was last detected
+        self._missed = numpy.empty(0, dtype=numpy.int64)  # Detections each has been missing from
+        self._countdown = 0  # Frames until detection next runs
+        self._lost = False  # Detect on the next frame, an object was lost
+        self._previous = None  # Grayscale model input of the last frame, for optical flow
+
+    def __len__(self):
+        return len(self._track_ids)
+
+    def needs_detection(self):
+        """Call once per frame, returns True if object detection should run on it"""
+        with self._lock:
+            needed = self._lost or self._countdown <= 0
+            if needed:
+                self._countdown = self.detect_interval
+                self._lost = False
+            self._countdown -= 1
+            return needed
+
+    def update(self, detections, frame=None):
+        """
+        Matches freshly detected objects to the tracked objects, starting tracks for new ones.
+
+        :param detections: Detections found in frame
+        :param frame: The Frame they were found in
+        :return: detections with the track id of each object
+        """
+        boxes = detections.boxes.astype(numpy.float64)
+        with self._lock:
+            self._ages += 1
+            matches = self._match(boxes, detections.class_ids)
+            track_ids = numpy.empty(len(detections), dtype=numpy.int64)
+
+            matched = matches >= 0
+            tracks = matches[matched]
+            ages = self._ages[tracks, numpy.newaxis]
+            self._velocities[tracks] = (boxes[matched] - self._detected_boxes[tracks]) / ages
+            self._boxes[tracks] = self._detected_boxes[tracks] = boxes[matched]
+            self._class_ids[tracks] = detections.class_ids[matched]
+            self._scores[tracks] = detections.scores[matched]
+            self._ages[tracks] = 0
+            self._missed += 1
+            self._missed[tracks] = 0
+            track_ids[matched] = self._track_ids[tracks]
+
+            new = ~matched
+            track_ids[new] = [next(self._track_id_sequence) for _ in range(new.sum())]
+            self._keep(self._missed <= self.max_missed)
+            self._append(detections.select(new), boxes[new], track_ids[new])
+            self._labels = detections.labels
+
+            if self.optical_flow and frame is not None and frame.model_input is not None:
+                self._previous = cv2.cvtColor(frame.model_input, cv2.COLOR_RGB2GRAY)
+
+        return Detections(
+            detections.labels, detections.class_ids, detections.scores, detections.boxes, track_ids
+        )
+
+    def predict(self, frame):
+        """Moves the tracked objects to where they should be in frame, returns them as Detections"""
+        with self._lock:
+            self._ages += 1
+            if self.optical_flow and frame.model_input is not None:
+                found = self._flow(frame.model_input, frame.shape)
+            else:
+                self._boxes += self._velocities
+                found = numpy.ones(len(self._boxes), dtype=bool)
+
+            height, width = frame.shape[:2]
+            numpy.clip(self._boxes, 0, [width, height, width, height], out=self._boxes)
+            found &= (self._boxes[:, 2:] > self._boxes[:, :2]).all(axis=1)
+            if not found.all():
+                self._lost = True  # Out of the frame, or the flow couldn't follow it
+                self._keep(found)
+
+            return Detections(
+                self._labels,
+                self._class_ids.copy(),
+                self._scores.copy(),
+                self._boxes.round().astype(numpy.int64),
+                self._track_ids.copy(),
+            )
+
+    def _match(self, boxes, class_ids):
+        """The index of the tracked object matching each box, or -1 if none does"""
+        matches = numpy.full(len(boxes), -1, dtype=numpy.int64)
+        if not len(boxes) or not len(self._boxes):
+            return matches
+
+        overlap = box_iou(self._boxes, boxes)
+        overlap[self._class_ids[:, numpy.newaxis] != class_ids[numpy.newaxis, :]] = 0.0
+        # Greedily pair up the most overlapping boxes first
+        while True:
+            track, detection = numpy.unravel_index(numpy.argmax(overlap), overlap.shape)
+            if overlap[track, detection] < self.iou_threshold:
+                return matches
+            matches[detection] = track
+            overlap[track, :] = 0.0
+            overlap[:, detection] = 0.0
+
+    def _flow(self, model_input, shape):
+        """Moves each box by the median optical flow of a grid of points within it"""
+        gray = cv2.cvtColor(model_input, cv2.COLOR_RGB2GRAY)
+        previous, self._previous = self._previous, gray
+        found = numpy.ones(len(self._boxes), dtype=bool)
+        if previous is None or previous.shape != gray.shape or not len(self._boxes):
+            self._boxes += self._velocities
+            return found
+
+        scale = numpy.array([gray.shape[1] / shape[1], gray.shape[0] / shape[0]])
+        grid = numpy.linspace(0.2, 0.8, 4)
+        starts = self._boxes[:, numpy.newaxis, :2] * scale
+        sizes = (self._boxes[:, 2:] - self._boxes[:, :2])[:, numpy.newaxis, :] * scale
+        offsets = numpy.stack(numpy.meshgrid(grid, grid), axis=-1).reshape(-1, 2)
+        points = (starts + offsets * sizes).astype(numpy.float32)  # (boxes, points, 2)
+
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(
+            previous, gray, points.reshape(-1, 1, 2), None
+        )
+        moved = moved.reshape(points.shape)
+        status = status.reshape(points.shape[:2]).astype(bool)
+        for i in range(len(self._boxes)):
+            if numpy.count_nonzero(status[i]) < 3:
+                found[i] = False
+                continue
+            shift = numpy.median(moved[i][status[i]] - points[i][status[i]], axis=0) / scale
+            self._boxes[i] += numpy.tile(shift, 2)
+        return found
+
+    def _keep(self, keep):
+        for name in self._TRACK_ARRAYS:
+            setattr(self, name, getattr(self, name)[keep])
+
+    def _append(self, detections, boxes, track_ids):
+        self._class_ids = numpy.concatenate([self._class_ids, detections.class_ids])
+        self._scores = numpy.concatenate([self._scores, detections.scores])
+        self._track_ids = numpy.concatenate([self._track_ids, track_ids])
+        self._boxes = numpy.concatenate([self._boxes, boxes])
+        self._detected_boxes = numpy.concatenate([self._detected_boxes, boxes])
+        self._velocities = numpy.concatenate([self._velocities, numpy.zeros_like(boxes)])
+        self._ages = numpy.concatenate([self._ages, numpy.zeros(len(boxes), dtype=numpy.int64)])
+        self._missed = numpy.concatenate(
+            [self._missed, numpy.zeros(len(boxes), dtype=numpy.int64)]
+        )
+
+
+def box_iou(boxes_a, boxes_b):
+    """
+    Intersection over union of every box in boxes_a with every box in boxes_b
+
+    :param boxes_a: nd_array of shape (n, 4) containing start_x, start_y, end_x, end_y
+    :param boxes_b: nd_array of shape (m, 4) in the same form
+    :return: nd_array of shape (n, m)
+    """
+    intersection, area_a, area_b = _box_intersections(boxes_a, boxes_b)
+    union = area_a[:, numpy.newaxis] + area_b[numpy.newaxis, :] - intersection
+    return intersection / numpy.maximum(union, 1e-9)
+
+
+def _box_intersections(boxes_a, boxes_b):
+    """The areas of the intersections of every box in boxes_a with every box in boxes_b"""
+    top_left = numpy.maximum(boxes_a[:, numpy.newaxis, :2], boxes_b[numpy.newaxis, :, :2])
+    bottom_right = numpy.minimum(boxes_a[:, numpy.newaxis, 2:], boxes_b[numpy.newaxis, :, 2:])
+    intersection = numpy.prod(numpy.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = numpy.prod(boxes_a[:, 2:] - boxes_a[:, :2], axis=1)
+    area_b = numpy.prod(boxes_b[:, 2:] - boxes_b[:, :2], axis=1)
+    return intersection, area_a, area_b
+
+
+def merge_detections(results, overlap_threshold=0.6):
+    """
+    Combines the objects detected in overlapping tiles of a frame.  Where boxes of the same
+    class overlap, by more than overlap_threshold of the smaller box, only the highest scoring
+    is kept.  This also catches objects cut in two by a seam, whose partial box lies within
+    the whole one.
+
+    :param results: List of the Detections, or lists of DetectionResults, from each tile
+    """
+    if not all(isinstance(result, Detections) for result in results):
+        return [detected_object for result in results for detected_object in result]
+
+    combined = Detections(
+        results[0].labels,
+        numpy.concatenate([result.class_ids for result in results]),
+        numpy.concatenate([result.scores for result in results]),
+        numpy.concatenate([result.boxes for result in results]),
+    )
+    order = numpy.argsort(-combined.scores, kind="stable")
+    boxes, class_ids = combined.boxes[order], combined.class_ids[order]
+    intersection, areas, _ = _box_intersections(boxes, boxes)
+    smaller = numpy.minimum(areas[:, numpy.newaxis], areas[numpy.newaxis, :])
+    duplicate = (intersection > overlap_threshold * smaller) & (
+        class_ids[:, numpy.newaxis] == class_ids[numpy.newaxis, :]
+    )
+
+    keep = []
+    suppressed = numpy.zeros(len(order), dtype=bool)
+    for i in range(len(order)):
+        if not suppressed[i]:
+            keep.append(order[i])
+            suppressed |= duplicate[i]
+    return combined.select(numpy.array(keep, dtype=numpy.int64))
+
+
+class Cascade:
+    """
+    Second stage of a cascade of object detectors.  A fast first stage analyzes every frame
+    and the slower, more accurate detection_function only checks the objects the first stage
+    is unsure of: those scoring from candidate_margin below to accept_margin above the
+    confidence an interest requires.  Each is cropped from the full resolution frame, with
+    some padding for context, and kept only if the second stage finds an object of the same
+    class overlapping it by iou_threshold that matches an interest.  Objects scoring above
+    the uncertain range are kept as they are.  Call it with a Camera, the first stage's
+    Detections and the Frame to receive the Detections that remain.
+
+    :param detection_function: Takes an nd_array crop, the shape of the full resolution frame
+    and the start_x, start_y, end_x, end_y pixel coordinates of the crop and returns
+    Detections.  If it has a detect_batch method, that's used to analyze every crop of a frame
+    at once.  Both stages must use the same labels.
+    :param candidate_margin: How far below an interest's confidence an object is still checked
+    :param accept_margin: How far above an interest's confidence an object is still checked
+    :param padding: Fraction of an object's width and height added to each side of its crop
+    :param iou_threshold: Intersection over union with the first stage's box that the second
+    stage's object needs to confirm it
+    :param input_size: (width, height) the second stage analyzes, crops are widened to its
+    aspect ratio so they aren't distorted when resized
+    """
+
+    def __init__(
+        self,
+        detection_function,
+        candidate_margin=0.2,
+        accept_margin=0.2,
+        padding=0.25,
+        iou_threshold=0.3,
+        input_size=None,
+    ):
+        self.detection_function = detection_function
+        self.candidate_margin = candidate_margin
+        self.accept_margin = accept_margin
+        self.padding = padding
+        self.iou_threshold = iou_threshold
+        self.input_size = input_size
+        self._filters = {}
+        self._lock = threading.Lock()  # Interpreters can't be used by several threads at once
+
+    def __call__(self, camera, detections, frame):
+        with _CASCADE_SECONDS.time():
+            candidate_filter, interest_filter = self._compile_filters(camera, detections.labels)
+            candidates = candidate_filter(detections)
+            required = interest_filter.confidences(candidates)
+            uncertain = candidates.scores < required + self.accept_margin
+            if not uncertain.any():
+                return candidates
+
+            checked = candidates.select(uncertain)
+            regions = [self._crop_region(box, frame.shape) for box in checked.boxes.tolist()]
+            crops = [frame.data[y0:y1, x0:x1] for x0, y0, x1, y1 in regions]
+            with self._lock:
+                if hasattr(self.detection_function, "detect_batch"):
+                    results = self.detection_function.detect_batch(
+                        crops, [frame.shape] * len(crops), regions
+                    )
+                else:
+                    results = [
+                        self.detection_function(crop, frame.shape, region)
+                        for crop, region in zip(crops, regions)
+                    ]
+
+        confirmed = []
+        for i, result in enumerate(results):
+            result = interest_filter(result)
+            overlaps = box_iou(checked.boxes[i : i + 1], result.boxes)[0]
+            result = result.select(
+                (result.class_ids == checked.class_ids[i]) & (overlaps >= self.iou_threshold)
+            )
+            CASCADE_CANDIDATES.labels(
+                camera.name, "confirmed" if len(result) else "rejected"
+            ).inc()
+            confirmed.append(result)
+        return merge_detections([candidates.select(~uncertain), *confirmed])
+
+    def _compile_filters(self, camera, labels):
+        """
+        The camera's filters for candidates, which lower each interest's confidence by the
+        candidate_margin, and for interests, compiled again only if its interests have changed
+        """
+        filters = self._filters.get(camera.name)
+        if (
+            filters is None
+            or filters[1].interests is not camera.interests
+            or filters[1].labels is not labels
+        ):
+            lowered = {
+                name: replace(interest, confidence=interest.confidence - self.candidate_margin)
+                for name, interest in camera.interests.items()
+            }
+            filters = (InterestFilter(lowered, labels), InterestFilter(camera.interests, labels))
+            self._filters[camera.name] = filters
+        return filters
+
+    def _crop_region(self, box, shape):
+        """box padded, widened to the input's aspect ratio and kept within the frame"""
+        height, width = shape[:2]
+        x0, y0, x1, y1 = box
+        crop_width = (x1 - x0) * (1 + 2 * self.padding)
+        crop_height = (y1 - y0) * (1 + 2 * self.padding)
+        if self.input_size:
+            aspect = self.input_size[0] / self.input_size[1]
+            crop_width, crop_height = (
+                max(crop_width, crop_height * aspect),
+                max(crop_height, crop_width / aspect),
+            )
+        crop_width = min(max(crop_width, 1), width)
+        crop_height = min(max(crop_height, 1), height)
+
+        start_x = min(max(0, round((x0 + x1 - crop_width) / 2)), width - round(crop_width))
+        start_y = min(max(0, round((y0 + y1 - crop_height) / 2)), height - round(crop_height))
+        return (
+            start_x,
+            start_y,
+            start_x + round(crop_width),
+            start_y + round(crop_height),
+        )
+
+
 # TODO refactor this to get the magic numbers out of it and add some tests.
 def annotate_frame(frame, detected_object, color=(0, 255, 0), line_weight=2):
     coords = detected_object.coordinates
@@ -116,56 +853,293 @@ def annotate_frame(frame, detected_object, color=(0, 255, 0), line_weight=2):
     )
 
 
+class Sequencer:
+    """
+    Lets threads that finish work out of order take turns in the order the work was started.
+    A ticket is taken for a key when work is started and the turn for every ticket must be
+    taken, in any order, for later turns for that key to proceed.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._issued = collections.Counter()
+        self._completed = collections.Counter()
+
+    def ticket(self, key):
+        with self._condition:
+            ticket = self._issued[key]
+            self._issued[key] += 1
+            return ticket
+
+    @contextlib.contextmanager
+    def turn(self, key, ticket):
+        with self._condition:
+            self._condition.wait_for(lambda: self._completed[key] == ticket)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._completed[key] += 1
+                self._condition.notify_all()
+
+
 class Dispatcher:
     """
     Retrieves frames from get_frame_function, checks them for objects via the
     detection_function finally passing them and any valid detections to alert_function.
 
-    :param get_frame_function: Takes zero arguments and returns a Frame
-    :param detection_function: Takes a single nd_array parameter and returns a list of DetectionResults
+    :param get_frame_function: Takes an optional timeout in seconds and returns a Frame, raising
+    queue.Empty if none arrives in time
+    :param detection_function: Takes an nd_array and the shape of the full resolution frame it was
+    scaled from and returns Detections, or a list of DetectionResults.  If it has a detect_batch
+    method, that's used to analyze batches.  A list of detection functions may be given to
+    analyze frames in parallel, one thread per function, with each frame going to whichever is
+    free.  Frames from each camera are still passed to alert_function in the order they were
+    retrieved.  Frames from cameras with a Tracker are only analyzed when it needs them to be,
+    which is decided in that order too, so they're analyzed one at a time rather than batched.
+    Frames cropped to a region of interest are analyzed a tile at a time, with the tile's
+    region passed as a third argument.
     :param alert_function: Takes a tuple containing a list of verified DetectionResults and the annotated
     Frame that was analyzed.
     :param cameras: dict mapping camera names to a Camera object
+    :param batch_size: Analyze up to this many frames, from any camera, at once
+    :param batch_timeout: Seconds to wait for a batch to fill before analyzing what we have
+    :param annotate: Draw the detected objects onto the frames passed to alert_function
+    :param cascade: Cascade that checks the objects detection_function is unsure of with a
+    more accurate detector
+
+    first_analyzed is an Event that's set once the first frame has been analyzed.
     """
 
-    def __init__(self, get_frame_function, detection_function, alert_function, cameras):
+    def __init__(
+        self,
+        get_frame_function,
+        detection_function,
+        alert_function,
+        cameras,
+        batch_size=1,
+        batch_timeout=0.0,
+        annotate=True,
+        cascade=None,
+    ):
+        if not isinstance(detection_function, (list, tuple)):
+            detection_function = [detection_function]
+
         self._get_frame_function = get_frame_function
-        self._detection_function = detection_function
+        self._detection_function = detection_function[0]
         self._alert_function = alert_function
-        self._cameras = cameras or {}
+        self._cameras = cameras if cameras is not None else {}
+        self._batch_size = batch_size
+        self._batch_timeout = batch_timeout
+        self._annotate = annotate
+        self._cascade = cascade
+        self._get_lock = threading.Lock()
+        self._sequencer = Sequencer() if len(detection_function) > 1 else None
+        self._interest_filters = {}
+        self.first_analyzed = threading.Event()
 
-        self._thread = threading.Thread(
-            name=self.__class__.__name__, daemon=True, target=self._dispatch_loop
-        )
+        self._threads = [
+            threading.Thread(
+                name=self.__class__.__name__ + (f"-{i}" if len(detection_function) > 1 else ""),
+                daemon=True,
+                target=self._dispatch_loop,
+                args=(function,),
+            )
+            for i, function in enumerate(detection_function)
+        ]
 
     def start(self):
-        self._thread.start()
+        for thread in self._threads:
+            thread.start()
 
     def join(self):
-        self._thread.join()
+        for thread in self._threads:
+            thread.join()
 
-    def _dispatch_loop(self):
+    def _dispatch_loop(self, detection_function):
         while True:
-            self._process_frame(self._get_frame_function())
+            # Only one thread waits on the input at a time so tickets follow the input order
+            with self._get_lock:
+                if self._batch_size > 1:
+                    frames = self._get_batch()
+                else:
+                    frames = [self._get_frame_function()]
+
+                tickets = None
+                if self._sequencer:
+                    tickets = [self._sequencer.ticket(frame.camera_name) for frame in frames]
+
+            self._process_frames(frames, detection_function, tickets)
+
+    def _get_batch(self):
+        frames = [self._get_frame_function()]
+        deadline = time.monotonic() + self._batch_timeout
+        while len(frames) < self._batch_size:
+            try:
+                frames.append(
+                    self._get_frame_function(timeout=max(0.0, deadline - time.monotonic()))
+                )
+            except queue.Empty:
+                break
+        return frames
+
+    def process_frames(self, frames):
+        """
+        Analyzes frames in the calling thread and passes them on to alert_function, for use
+        without starting the dispatcher, such as when scanning a recording
+        """
+        self._process_frames(frames)
 
     def _process_frame(self, frame):
+        self._process_frames([frame])
+
+    def _process_frames(self, frames, detection_function=None, tickets=None):
+        detection_function = detection_function or self._detection_function
+        # Whether a camera's tracker needs a frame analyzed depends on the frames before it, so
+        # frames from cameras with a tracker are only analyzed once it's their camera's turn
+        untracked = [
+            frame
+            for frame in frames
+            if frame.camera_name in self._cameras and self._tracker(frame) is None
+        ]
+        results = self._detect_frames(detection_function, untracked)
+        for i, frame in enumerate(frames):
+            with self._turn(frame, tickets[i] if tickets else None):
+                if frame.camera_name not in self._cameras:
+                    logger.warning(
+                        f"Camera {frame.camera_name} not registered with dispatcher!"
+                    )
+                    continue
+
+                try:
+                    if id(frame) not in results and self._needs_detection(frame):
+                        results.update(self._detect_frames(detection_function, [frame]))
+                    # Frames the camera's tracker can follow objects through skip detection
+                    self._submit_detections(frame, results.get(id(frame)))
+                except Exception as e:
+                    logger.error(
+                        f"Error encountered handling detections from {frame.camera_name}: {e}"
+                    )
+
+    def _detect_frames(self, detection_function, frames):
+        """dict mapping the id of each frame to the objects detected in it"""
         try:
-            camera = self._cameras[frame.camera_name]
-        except KeyError:
-            logger.warning(
-                f"Camera {frame.camera_name} not registered with dispatcher!"
-            )
+            results = self._detect(detection_function, frames)
+        except Exception as e:
+            logger.error(f"Error encountered detecting objects: {e}")
+            results = [[] for _ in frames]
+        else:
+            if frames:
+                self.first_analyzed.set()
+        return dict(zip(map(id, frames), results))
+
+    def _turn(self, frame, ticket):
+        if ticket is None:
+            return contextlib.nullcontext()
+        return self._sequencer.turn(frame.camera_name, ticket)
+
+    def _tracker(self, frame):
+        camera = self._cameras.get(frame.camera_name)  # Cameras may be removed at any time
+        return camera.tracker if camera else None
+
+    def _needs_detection(self, frame):
+        tracker = self._tracker(frame)
+        return tracker is None or tracker.needs_detection()
+
+    @staticmethod
+    def _detect(detection_function, frames):
+        # Frames cropped to a region of interest have an input for each of its tiles
+        inputs, shapes, regions, counts = [], [], [], []
+        for frame in frames:
+            crops = frame.crops if frame.regions else [frame.model_input]
+            inputs.extend(crops)
+            shapes.extend([frame.shape] * len(crops))
+            regions.extend(frame.regions or [None])
+            counts.append(len(crops))
+
+        if not inputs:
+            return []
+        elif len(inputs) == 1:
+            results = [_analyze(detection_function, inputs[0], shapes[0], regions[0])]
+        elif hasattr(detection_function, "detect_batch"):
+            if any(regions):
+                results = detection_function.detect_batch(inputs, shapes, regions)
+            else:
+                results = detection_function.detect_batch(inputs, shapes)
+        else:
+            results = [
+                _analyze(detection_function, *arguments)
+                for arguments in zip(inputs, shapes, regions)
+            ]
+
+        merged = []
+        for count in counts:
+            frame_results, results = results[:count], results[count:]
+            merged.append(frame_results[0] if count == 1 else merge_detections(frame_results))
+        return merged
+
+    def _submit_detections(self, frame, detections=None):
+        """Passes detections in frame on to alert_function, or tracked objects if None"""
+        camera = self._cameras[frame.camera_name]
+        settings = camera.settings  # Taken once, as they may be swapped at any time
+        FRAMES_ANALYZED.labels(camera.name).inc()
+
+        with _FILTER_SECONDS.time():
+            if detections is None:
+                # Only objects that matched an interest are tracked.  The tracker may have been
+                # removed since it let this frame skip object detection.
+                tracker = settings.tracker
+                detections = tracker.predict(frame) if tracker is not None else []
+                FRAMES_TRACKED.labels(camera.name).inc()
+            elif isinstance(detections, Detections):
+                if self._cascade is not None:
+                    # The cascade drops objects no interest could match before checking the
+                    # rest, dropping masked objects too keeps its slower model off them
+                    detections = self._cascade(
+                        camera, _unmasked(settings.mask, detections, frame.shape), frame
+                    )
+                detections = self._interest_filter(camera, detections.labels)(detections)
+                if settings.tracker is not None:
+                    detections = settings.tracker.update(detections, frame)
+            else:
+                detections = [
+                    detection
+                    for detection in detections
+                    if matches_interest(settings.interests, detection)
+                ]
+
+            valid_detections = [
+                detection
+                for detection in detections
+                if not is_masked(settings.mask, detection.coordinates, frame.shape)
+            ]
+
+        if not valid_detections:
             return
+        camera.activity()
 
-        valid_detections = [
-            detection
-            for detection in self._detection_function(frame.data)
-            if matches_interest(camera.interests, detection)
-            and not is_masked(camera.mask, detection.coordinates)
-        ]
+        # Accessing frame.data converts the full resolution image, so only do it when needed
+        if self._annotate:
+            with _ANNOTATE_SECONDS.time():
+                for detected_object in valid_detections:
+                    annotate_frame(frame.data, detected_object)
+
+        self._alert_function((valid_detections, frame))
+
+    def _interest_filter(self, camera, labels):
+        """The camera's InterestFilter, compiled again only if its interests have changed"""
+        interest_filter = self._interest_filters.get(camera.name)
+        if (
+            interest_filter is None
+            or interest_filter.interests is not camera.interests
+            or interest_filter.labels is not labels
+        ):
+            interest_filter = InterestFilter(camera.interests, labels)
+            self._interest_filters[camera.name] = interest_filter
+        return interest_filter
 
-        for detected_object in valid_detections:
-            annotate_frame(frame.data, detected_object)
 
-        if valid_detections:
-            self._alert_function((valid_detections, frame))
+def _analyze(detection_function, model_input, shape, region):
+    if region is None:
+        return detection_function(model_input, shape)
+    return detection_function(model_input, shape, region)
@@ -0,0 +1,322 @@
+import bisect
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the buckets latency histograms count observations in
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+_registry = {}
+_registry_lock = threading.Lock()
+_routes = {}
+
+
+def counter(name, documentation, labelnames=()):
+    """Registers, or returns the already registered, Counter called name"""
+    return _register(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    """Registers, or returns the already registered, Gauge called name"""
+    return _register(Gauge, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    """Registers, or returns the already registered, Histogram called name"""
+    return _register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+def _register(metric_class, name, documentation, labelnames, **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = metric_class(name, documentation, labelnames, **kwargs)
+        elif not isinstance(metric, metric_class):
+            raise ValueError(f"Metric {name} is already registered as a {metric.type}")
+        return metric
+
+
+class _Metric:
+    """
+    A named metric that may be split by the values of its labels.  Metrics without labels
+    may be updated directly, otherwise call labels() with a value for each label name to get
+    the child metric to update.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), **kwargs):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(values, self._child_class(**self._kwargs))
+        return child
+
+    def remove(self, *values):
+        """Stops reporting the child metric with the given label values"""
+        with self._lock:
+            self._children.pop(values, None)
+
+    def children(self):
+        """Pairs of the label dict and child metric for every child"""
+        with self._lock:
+            children = list(self._children.items())
+        return [(dict(zip(self.labelnames, values)), child) for values, child in children]
+
+    def __getattr__(self, name):
+        # Lets metrics without labels be updated directly, e.g. metric.inc()
+        if name.startswith("_") or self.__dict__.get("labelnames", True):
+            raise AttributeError(name)
+        return getattr(self.labels(), name)
+
+
+class _CounterChild:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def samples(self):
+        yield "_total", {}, self._value
+
+
+class Counter(_Metric):
+    """A count that only goes up, such as the number of frames dropped"""
+
+    type = "counter"
+    _child_class = _CounterChild
+
+
+class _GaugeChild:
+    def __init__(self):
+        self._value = 0.0
+        self._function = None
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, function):
+        """Report the value returned by calling function rather than a value that's been set"""
+        self._function = function
+
+    @property
+    def value(self):
+        return self._function() if self._function else self._value
+
+    def samples(self):
+        yield "", {}, self.value
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, such as the number of frames waiting"""
+
+    type = "gauge"
+    _child_class = _GaugeChild
+
+
+class _HistogramChild:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self.buckets) + 1)  # The last bucket is +Inf
+        self._sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def time(self):
+        """Context manager that observes the seconds taken by its block"""
+        return _Timer(self)
+
+    @property
+    def count(self):
+        return sum(self._counts)
+
+    @property
+    def sum(self):
+        return self._sum
+
+    def quantile(self, q):
+        """Estimates the q quantile as the upper bound of the bucket it falls in"""
+        with self._lock:
+            counts = list(self._counts)
+        rank = q * sum(counts)
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            if count and cumulative >= rank:
+                return bound
+        return 0.0
+
+    def samples(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            yield "_bucket", {"le": _format_value(bound)}, cumulative
+        yield "_sum", {}, total
+        yield "_count", {}, cumulative
+
+
+class Histogram(_Metric):
+    """Counts observations, such as how long each frame takes to decode, in buckets"""
+
+    type = "histogram"
+    _child_class = _HistogramChild
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+def registered():
+    """Every registered metric, sorted by name"""
+    with _registry_lock:
+        return sorted(_registry.values(), key=lambda metric: metric.name)
+
+
+def render():
+    """Returns every registered metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in registered():
+        lines.append(f"# HELP {metric.name} {_escape(metric.documentation, False)}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for labels, child in metric.children():
+            for suffix, sample_labels, value in child.samples():
+                label_text = ",".join(
+                    f'{name}="{_escape(str(label_value))}"'
+                    for name, label_value in {**labels, **sample_labels}.items()
+                )
+                name = metric.name + suffix
+                lines.append(
+                    f"{name}{{{label_text}}} {_format_value(value)}"
+                    if label_text
+                    else f"{name} {_format_value(value)}"
+                )
+    return "\n".join(lines) + "\n"
+
+
+def _escape(text, quotes=True):
+    text = text.replace("\\", r"\\").replace("\n", r"\n")
+    return text.replace('"', r"\"") if quotes else text
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def add_route(path, function, method="GET"):
+    """
+    Serves the text returned by calling function at path of the metrics server, for
+    requests using method.  The paths "/" and "/metrics" are reserved for the metrics.
+    """
+    _routes[method, path] = function
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path in ("/", "/metrics"):
+            self._respond(render())
+        else:
+            self._route("GET", path)
+
+    def do_POST(self):
+        self._route("POST", self.path.split("?")[0])
+
+    def _route(self, method, path):
+        function = _routes.get((method, path))
+        if function is None:
+            self.send_error(404)
+            return
+        self._respond(function())
+
+    def _respond(self, text):
+        body = text.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def start_http_server(port, address=""):
+    """Serves the metrics for Prometheus to scrape at http://address:port/metrics"""
+    server = ThreadingHTTPServer((address, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(name="Metrics", daemon=True, target=server.serve_forever).start()
+    logger.info(f"Serving metrics on port {server.server_address[1]}")
+    return server
+
+
+def start_stats_logger(interval):
+    """Logs a summary of every metric each interval seconds"""
+
+    def log_loop():
+        while True:
+            time.sleep(interval)
+            for line in summarize():
+                logger.info(line)
+
+    threading.Thread(name="Stats", daemon=True, target=log_loop).start()
+
+
+def summarize():
+    """One line of text summarizing each child of every registered metric"""
+    lines = []
+    for metric in registered():
+        for labels, child in metric.children():
+            label_text = " ".join(f"{name}={value}" for name, value in labels.items())
+            if isinstance(metric, Histogram):
+                count = child.count
+                mean = child.sum / count if count else 0.0
+                summary = (
+                    f"count={count} mean={mean * 1000:.1f}ms "
+                    f"p50<={child.quantile(0.5) * 1000:g}ms p95<={child.quantile(0.95) * 1000:g}ms"
+                )
+            else:
+                summary = f"value={child.value:g}"
+            lines.append(" ".join(part for part in (metric.name, label_text, summary) if part))
+    return lines
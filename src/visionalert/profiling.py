@@ -0,0 +1,137 @@
+import collections
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of every thread in the process, such as the camera capture threads,
+    the dispatcher and the notifier's workers, each interval seconds and counts how often
+    each stack is seen.  Every write_interval seconds the counts are written to a file of
+    collapsed stacks, one line per stack of semicolon separated frames followed by its count,
+    which flame graph tools such as flamegraph.pl and speedscope read.  Sampling only pauses
+    the running threads long enough to copy their stacks, so it may be left running on a
+    live process.
+
+    :param interval: Seconds between samples
+    :param directory: Directory the profiles are written to, created if needed
+    :param write_interval: Seconds between writing profiles
+    """
+
+    def __init__(self, interval=0.01, directory="profiles", write_interval=60):
+        self.interval = interval
+        self.directory = directory
+        self.write_interval = write_interval
+        self._counts = collections.Counter()
+        self._counts_lock = threading.Lock()
+        self._sequence = itertools.count(1)
+        self._state_lock = threading.Lock()
+        self._stopped = None
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        with self._state_lock:
+            if self._thread is not None:
+                return
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(
+                name=self.__class__.__name__,
+                daemon=True,
+                target=self._sample_loop,
+                args=(self._stopped,),
+            )
+            self._thread.start()
+        logger.info(f"Started profiling, writing profiles to {self.directory}")
+
+    def stop(self):
+        """Stops sampling and writes the samples taken since the last profile was written"""
+        with self._state_lock:
+            if self._thread is None:
+                return
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+        self.write()
+        logger.info("Stopped profiling")
+
+    def toggle(self):
+        """Stops profiling if it's running, otherwise starts it, and returns if it's running"""
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+        return self.running
+
+    def collapsed(self):
+        """The samples taken since the last profile was written, as collapsed stacks"""
+        with self._counts_lock:
+            counts = list(self._counts.items())
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(counts))
+
+    def write(self):
+        """
+        Writes the samples taken since the last profile was written to a new file in
+        directory, returning its name, or None if there were no samples.
+        """
+        with self._counts_lock:
+            counts, self._counts = self._counts, collections.Counter()
+        if not counts:
+            return None
+
+        os.makedirs(self.directory, exist_ok=True)
+        filename = os.path.join(
+            self.directory,
+            f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(self._sequence)}.folded",
+        )
+        with open(filename, "w") as file:
+            for stack, count in sorted(counts.items()):
+                file.write(f"{stack} {count}\n")
+        logger.info(f"Wrote {sum(counts.values())} samples to {filename}")
+        return filename
+
+    def sample(self):
+        """Counts the current stack of every thread except the profiler's"""
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own_ident = threading.get_ident()
+        stacks = [
+            _collapse(names.get(ident, str(ident)), frame)
+            for ident, frame in sys._current_frames().items()
+            if ident != own_ident
+        ]
+        with self._counts_lock:
+            self._counts.update(stacks)
+
+    def _sample_loop(self, stopped):
+        next_write = time.monotonic() + self.write_interval
+        while not stopped.wait(self.interval):
+            try:
+                self.sample()
+                if time.monotonic() >= next_write:
+                    next_write += self.write_interval
+                    self.write()
+            except Exception as e:
+                logger.error(f"Error encountered profiling: {e}")
+
+
+def _collapse(thread_name, frame):
+    """The stack ending at frame as semicolon separated frames, outermost first"""
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(
+            f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        )
+        frame = frame.f_back
+    frames.append(thread_name)
+    # Semicolons separate the frames, so they can't appear in one
+    return ";".join(frame.replace(";", ":") for frame in reversed(frames))
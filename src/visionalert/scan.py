@@ -0,0 +1,240 @@
+"""
+Searches recorded video files for objects, as fast as the hardware allows, rather than
+monitoring live cameras.  Files are split into segments of time that are scanned in
+parallel, each by its own process, and every detection is written to a results file in
+the JSON Lines format instead of being alerted on.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+from visionalert import config, lazy_import, tensorflow
+from visionalert.detection import Dispatcher
+from visionalert.video import get_frames
+
+av = lazy_import("av")
+
+logger = logging.getLogger(__name__)
+
+# Set in each worker process by _init_worker
+_scanner = None
+
+
+def add_arguments(parser):
+    """Adds the arguments of the scan command to an argparse parser"""
+    parser.add_argument("files", nargs="+", help="video files to scan")
+    parser.add_argument(
+        "-o", "--output", default="detections.jsonl", help="file the detections are written to"
+    )
+    parser.add_argument(
+        "--camera",
+        help="name of the camera in the configuration whose interests, mask, zones and "
+        "region of interest are used, defaults to the first",
+    )
+    parser.add_argument(
+        "--fps", type=float, help="frames per second to analyze, defaults to every frame"
+    )
+    parser.add_argument(
+        "--decode", help="decode mode, defaults to the camera's (all, nonref or keyframes)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="segments scanned at once, each by its own process",
+    )
+    parser.add_argument(
+        "--segment-seconds", type=float, default=300, help="length of each segment"
+    )
+
+
+def run(args):
+    """Scans args.files as described by the arguments added by add_arguments"""
+    camera_config = _camera_config(args.camera)
+    options = {
+        "fps": args.fps or None,
+        "decode": args.decode or camera_config.get("decode", "all"),
+    }
+
+    tasks = [
+        (location, start, end)
+        for location in args.files
+        for start, end in segments(*video_span(location), args.segment_seconds)
+    ]
+    logger.info(
+        f"Scanning {len(args.files)} file(s) in {len(tasks)} segment(s) "
+        f"using {args.workers} worker(s)"
+    )
+
+    start_time = time.monotonic()
+    initargs = (dict(config), camera_config, options)
+    if args.workers <= 1:
+        _init_worker(*initargs)
+        results = [_scan_segment(*task) for task in tasks]
+    else:
+        results = []
+        with ProcessPoolExecutor(
+            args.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=initargs,
+        ) as executor:
+            futures = {executor.submit(_scan_segment, *task): task for task in tasks}
+            for future in as_completed(futures):
+                location, start, end = futures[future]
+                results.append(future.result())
+                logger.info(f"Scanned {location} from {start:.0f}s to {end:.0f}s")
+
+    detections = sorted(
+        (detection for result in results for detection in result),
+        key=lambda detection: (args.files.index(detection["file"]), detection["time"]),
+    )
+    with open(args.output, "w") as file:
+        for detection in detections:
+            file.write(json.dumps(detection) + "\n")
+
+    logger.info(
+        f"Found {len(detections)} detection(s) in {time.monotonic() - start_time:.1f}s, "
+        f"written to {args.output}"
+    )
+    return detections
+
+
+def video_span(location):
+    """Tuple of the start time and duration, in seconds, of the first video stream in location"""
+    with av.open(location) as container:
+        stream = container.streams.video[0]
+        start = float(stream.start_time * stream.time_base) if stream.start_time else 0.0
+        if stream.duration is not None:
+            duration = float(stream.duration * stream.time_base)
+        elif container.duration is not None:
+            duration = container.duration / av.time_base
+        else:
+            # Raw and streamed video don't record their duration, so read through to the end
+            end = start
+            for packet in container.demux(stream):
+                if packet.pts is not None:
+                    end = max(end, float((packet.pts + (packet.duration or 0)) * stream.time_base))
+            duration = end - start
+    return start, duration
+
+
+def segments(start, duration, segment_seconds):
+    """Splits duration seconds from start into (start, end) segments of segment_seconds"""
+    count = max(1, int(-(-duration // segment_seconds)))  # Round up
+    bounds = [start + duration * i / count for i in range(count)] + [float("inf")]
+    return list(zip(bounds, bounds[1:]))
+
+
+def _camera_config(name=None):
+    cameras = config.get("cameras") or []
+    if not cameras:
+        raise ValueError("The configuration has no cameras to take interests from")
+    if name is None:
+        return cameras[0]
+    for camera in cameras:
+        if camera["name"] == name:
+            return camera
+    raise ValueError(f"No camera named {name} in the configuration")
+
+
+class _Scanner:
+    """The detector and dispatcher a worker process scans segments with"""
+
+    def __init__(self, camera_config, options):
+        # Imported here as the app imports this module to run the scan command
+        from visionalert.app import init_cascade
+
+        self.camera_config = camera_config
+        self.options = options
+        self.detector = tensorflow.create_detector(
+            config["tensorflow_model_file"],
+            config["tensorflow_label_map"],
+            num_threads=config.get("detector_threads"),
+        )
+        self.batch_size = config.get("detection_batch_size", 1)
+        self.frames = []
+        self.cameras = {}
+        self.detections = []
+        self.dispatcher = Dispatcher(
+            None,
+            self.detector,
+            self._record,
+            self.cameras,
+            annotate=False,
+            cascade=init_cascade(config),
+        )
+        self._location = None
+
+    def scan(self, location, start, end):
+        from visionalert.app import init_camera
+
+        # Segments are unrelated, so each gets a camera whose tracker and motion detector
+        # haven't seen the others
+        camera = init_camera(self.camera_config, self.frames.append, self.detector.input_size)
+        if camera.tracker is not None:
+            # Only objects the model found are recorded, the tracker just links them into tracks
+            camera.tracker.detect_interval = 1
+        self.cameras.clear()
+        self.cameras[camera.name] = camera
+        self._location = location
+        self.detections = []
+        for source in get_frames(location, seek=start, **self.options):
+            if source.time is None or source.time < start:
+                continue  # Seeking lands on the keyframe before start
+            if source.time >= end:
+                break
+
+            # Frames without motion aren't added to self.frames
+            camera.feed(source)
+            if len(self.frames) >= self.batch_size:
+                self._process_frames()
+
+        self._process_frames()
+        return self.detections
+
+    def _process_frames(self):
+        if self.frames:
+            self.dispatcher.process_frames(list(self.frames))
+            self.frames.clear()
+
+    def _record(self, data):
+        detections, frame = data
+        for detection in detections:
+            coordinates = detection.coordinates
+            self.detections.append(
+                {
+                    "file": self._location,
+                    "time": round(frame.time, 3),
+                    "timestamp": _format_time(frame.time),
+                    "camera": frame.camera_name,
+                    "object": detection.name,
+                    "confidence": round(detection.confidence, 4),
+                    "box": [
+                        coordinates.start_x,
+                        coordinates.start_y,
+                        coordinates.end_x,
+                        coordinates.end_y,
+                    ],
+                    "track_id": detection.track_id,
+                }
+            )
+
+
+def _format_time(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:06.3f}"
+
+
+def _init_worker(worker_config, camera_config, options):
+    global _scanner
+    config.update(worker_config)
+    _scanner = _Scanner(camera_config, options)
+
+
+def _scan_segment(location, start, end):
+    return _scanner.scan(location, start, end)
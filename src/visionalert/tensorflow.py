@@ -1,11 +1,13 @@
 import logging
 import platform
 
-import cv2
 import numpy
-import tflite_runtime.interpreter as tflite
 
-from visionalert.detection import Rectangle, DetectionResult
+from visionalert import lazy_import, metrics
+from visionalert.detection import Cascade, Rectangle, Detections
+
+cv2 = lazy_import("cv2")
+tflite = lazy_import("tflite_runtime.interpreter")
 
 EDGETPU_SHARED_LIB = {
     "Linux": "libedgetpu.so.1",
@@ -15,6 +17,18 @@ EDGETPU_SHARED_LIB = {
 
 logger = logging.getLogger(__name__)
 
+# Width and height of the images the models analyze, unless told otherwise
+INPUT_SIZE = (300, 300)
+
+DETECTOR_SECONDS = metrics.histogram(
+    "visionalert_detector_seconds",
+    "Time spent by each stage of object detection per frame or batch",
+    ["stage"],
+)
+_RESIZE_SECONDS = DETECTOR_SECONDS.labels("resize")
+_INVOKE_SECONDS = DETECTOR_SECONDS.labels("invoke")
+_POSTPROCESS_SECONDS = DETECTOR_SECONDS.labels("postprocess")
+
 
 def load_labels(filename):
     with open(filename, "r") as label_file:
@@ -25,16 +39,34 @@ def load_labels(filename):
         return labels
 
 
-def calc_bounding_box(frame, box):
-    h, w, _ = frame.shape
-    start_y = int(max(1, (box[0] * h)))
-    start_x = int(max(1, (box[1] * w)))
-    end_y = int(min(h, (box[2] * h)))
-    end_x = int(min(w, (box[3] * w)))
-    return Rectangle(start_x=start_x, start_y=start_y, end_x=end_x, end_y=end_y)
+def calc_bounding_box(shape, box, region=None):
+    return Rectangle(*calc_bounding_boxes(shape, [box], region)[0].tolist())
+
+
+def calc_bounding_boxes(shape, boxes, region=None):
+    """
+    Scales boxes output by the model, rows of ymin, xmin, ymax, xmax between 0 and 1, to the
+    pixel coordinates start_x, start_y, end_x, end_y in an image of the given shape
+
+    :param region: If the model analyzed a crop of the image, the start_x, start_y, end_x, end_y
+    pixel coordinates of the crop
+    """
+    h, w = shape[:2]
+    scaled = numpy.asarray(boxes, dtype=numpy.float64).reshape(-1, 4)[:, (1, 0, 3, 2)]
+    if region is None:
+        scaled *= numpy.array((w, h, w, h), dtype=numpy.float64)
+    else:
+        start_x, start_y, end_x, end_y = region
+        scaled *= numpy.array((end_x - start_x, end_y - start_y) * 2, dtype=numpy.float64)
+        scaled += numpy.array((start_x, start_y) * 2, dtype=numpy.float64)
+    numpy.maximum(scaled[:, :2], 1.0, out=scaled[:, :2])
+    numpy.minimum(scaled[:, 2:], numpy.array((w, h), dtype=numpy.float64), out=scaled[:, 2:])
+    return scaled.astype(int)
 
 
-def create_detector(model, label, input_width=300, input_height=300):
+def create_detector(
+    model, label, input_width=INPUT_SIZE[0], input_height=INPUT_SIZE[1], num_threads=None
+):
     try:
         delegate = [tflite.load_delegate(EDGETPU_SHARED_LIB)]
         logger.info("Initialized EdgeTPU device.  (Sweet!)")
@@ -42,34 +74,149 @@ def create_detector(model, label, input_width=300, input_height=300):
         logger.info(f"Unable to initialize EdgeTPU, using CPU: {str(e)}")
         delegate = None
 
-    interpreter = tflite.Interpreter(model_path=model, experimental_delegates=delegate)
+    options = {"num_threads": num_threads} if num_threads else {}
+    interpreter = tflite.Interpreter(
+        model_path=model, experimental_delegates=delegate, **options
+    )
     interpreter.allocate_tensors()
-    input_details = interpreter.get_input_details()
-    output_details = interpreter.get_output_details()
-    labels = load_labels(label)
-
-    def detect_function(frame):
-        input_frame = frame
-        if frame.shape[1] != input_width and frame.shape[0] != input_height:
-            input_frame = cv2.resize(frame, (input_width, input_height))
-
-        interpreter.set_tensor(
-            input_details[0]["index"], numpy.expand_dims(input_frame, axis=0)
-        )
-
-        interpreter.invoke()
+    return Detector(interpreter, load_labels(label), input_width, input_height)
+
+
+def create_detector_pool(model, label, size=1, num_threads=None, **kwargs):
+    """
+    Creates size Detectors, each with its own interpreter, so that several frames can be
+    analyzed in parallel.  Any additional arguments are passed to create_detector.
+
+    :param num_threads: Threads each interpreter may use, defaults to TensorFlow's choice
+    """
+    return [
+        create_detector(model, label, num_threads=num_threads, **kwargs)
+        for _ in range(size)
+    ]
+
+
+def create_cascade(
+    model, label, input_width=INPUT_SIZE[0], input_height=INPUT_SIZE[1], num_threads=None, **kwargs
+):
+    """
+    Creates the second stage of a detector cascade, a Cascade that checks the objects the
+    detector analyzing every frame is unsure of with the more accurate model.  Any additional
+    arguments, such as the margins around each interest's confidence, are passed to Cascade.
+
+    :param label: Label map, which must be the same as the first stage's
+    :param input_width: Width of the images the model analyzes
+    :param input_height: Height of the images the model analyzes
+    """
+    detector = create_detector(model, label, input_width, input_height, num_threads)
+    return Cascade(detector, input_size=detector.input_size, **kwargs)
+
+
+class Detector:
+    """
+    Detects objects in images using an initialized TensorFlow Lite interpreter.  Call it
+    with an nd_array image to receive the Detections found in it.
+    """
+
+    def __init__(self, interpreter, labels, input_width=INPUT_SIZE[0], input_height=INPUT_SIZE[1]):
+        self.labels = labels
+        self.input_size = (input_width, input_height)
+        self._interpreter = interpreter
+        self._input_details = interpreter.get_input_details()
+        self._output_details = interpreter.get_output_details()
+        self._batch_size = 1
+
+        # Models converted with a dynamic batch dimension report it as -1
+        shape_signature = self._input_details[0].get("shape_signature", [1])
+        self.supports_batches = len(shape_signature) > 0 and shape_signature[0] == -1
+
+    def __call__(self, frame, shape=None, region=None):
+        """
+        :param frame: RGB nd_array to analyze, resized to the model input size if required.
+        :param shape: Shape of the full resolution image the bounding boxes of detected objects
+        should be scaled to.  Defaults to the shape of frame.
+        :param region: If frame was cropped from the full resolution image, the start_x, start_y,
+        end_x, end_y pixel coordinates it was cropped from
+        """
+        return self.detect_batch([frame], [shape], [region])[0]
+
+    def detect_batch(self, frames, shapes=None, regions=None):
+        """
+        Detects objects in several images.  If the model supports it they're run through the
+        interpreter as a single batch, otherwise one after another.
+
+        :param frames: List of RGB nd_arrays
+        :param shapes: List of full resolution shapes, as for calling the Detector directly
+        :param regions: List of regions, as for calling the Detector directly
+        :return: List containing the Detections for each frame
+        """
+        shapes = shapes or [None] * len(frames)
+        regions = regions or [None] * len(frames)
+        input_frames = [self._prepare(frame) for frame in frames]
+
+        if self.supports_batches:
+            outputs = zip(*self._invoke(self._pad(input_frames)))
+        else:
+            outputs = [
+                [tensor[0] for tensor in self._invoke(numpy.expand_dims(input_frame, axis=0))]
+                for input_frame in input_frames
+            ]
 
         return [
-            DetectionResult(
-                name=labels[int(label_index)],
-                confidence=score,
-                coordinates=calc_bounding_box(frame, box),
-            )
-            for box, label_index, score in zip(
-                interpreter.get_tensor(output_details[0]["index"])[0],
-                interpreter.get_tensor(output_details[1]["index"])[0],
-                interpreter.get_tensor(output_details[2]["index"])[0],
-            )
+            self._parse_results(shape or frame.shape, region, *output)
+            for frame, shape, region, output in zip(frames, shapes, regions, outputs)
         ]
 
-    return detect_function
+    def warm_up(self):
+        """
+        Runs a blank image through the interpreter.  The first invoke of an interpreter is
+        much slower than the rest, so doing it before any frames arrive keeps it from
+        delaying the first detection.
+        """
+        input_width, input_height = self.input_size
+        blank = numpy.zeros((input_height, input_width, 3), self._input_details[0]["dtype"])
+        self.detect_batch([blank])
+
+    def _prepare(self, frame):
+        input_width, input_height = self.input_size
+        if frame.shape[1] != input_width or frame.shape[0] != input_height:
+            with _RESIZE_SECONDS.time():
+                return cv2.resize(frame, (input_width, input_height))
+        return frame
+
+    @staticmethod
+    def _pad(input_frames):
+        """
+        Stacks the frames into a batch padded with blank frames to the next power of two.
+        Resizing the interpreter's input reallocates its tensors, and batches cut short by
+        the batch timeout vary in size, so this keeps it to a handful of sizes.
+        """
+        size = 1 << (len(input_frames) - 1).bit_length()
+        batch = numpy.zeros((size, *input_frames[0].shape), input_frames[0].dtype)
+        numpy.stack(input_frames, out=batch[: len(input_frames)])
+        return batch
+
+    def _invoke(self, input_tensor):
+        interpreter = self._interpreter
+        input_index = self._input_details[0]["index"]
+
+        if input_tensor.shape[0] != self._batch_size:
+            interpreter.resize_tensor_input(input_index, input_tensor.shape)
+            interpreter.allocate_tensors()
+            self._batch_size = input_tensor.shape[0]
+
+        with _INVOKE_SECONDS.time():
+            interpreter.set_tensor(input_index, input_tensor)
+            interpreter.invoke()
+
+            return [
+                interpreter.get_tensor(self._output_details[i]["index"]) for i in range(3)
+            ]
+
+    def _parse_results(self, shape, region, boxes, label_indexes, scores):
+        with _POSTPROCESS_SECONDS.time():
+            return Detections(
+                self.labels,
+                numpy.asarray(label_indexes).astype(int),
+                numpy.asarray(scores),
+                calc_bounding_boxes(shape, boxes, region),
+            )
@@ -1,18 +1,114 @@
+import functools
 import logging
+import multiprocessing
+import os
+import queue
 import threading
 import time
-import collections
+from dataclasses import dataclass, replace
+from fractions import Fraction
 
-import av
-import cv2
-import fpstimer
+import numpy
+
+from visionalert import lazy_import, metrics
+
+av = lazy_import("av")
+cv2 = lazy_import("cv2")
+fpstimer = lazy_import("fpstimer")
 
 logger = logging.getLogger(__name__)
 
-Frame = collections.namedtuple("Frame", ["camera_name", "data"])
+DECODE_SECONDS = metrics.histogram(
+    "visionalert_decode_seconds",
+    "Time spent receiving and decoding each frame selected for analysis",
+    ["camera"],
+)
+CONVERT_SECONDS = metrics.histogram(
+    "visionalert_convert_seconds",
+    "Time spent converting each selected frame for the detector",
+    ["camera"],
+)
+FRAMES_CAPTURED = metrics.counter(
+    "visionalert_frames_captured", "Frames selected for analysis", ["camera"]
+)
+MOTION_SKIPPED = metrics.counter(
+    "visionalert_motion_skipped_frames",
+    "Frames that weren't analyzed because there was no motion",
+    ["camera"],
+)
+RECONNECTS = metrics.counter(
+    "visionalert_camera_reconnects", "Times the connection to a camera was retried", ["camera"]
+)
+DECODE_THREADS = metrics.gauge(
+    "visionalert_decode_threads", "Threads the codec decodes each camera with", ["camera"]
+)
+
+
+class Frame:
+    """
+    A frame captured from a camera.  model_input is a small copy of the image already scaled
+    for the detector.  The full resolution RGB image in data is only converted from the decoded
+    source frame the first time it's accessed, which for most frames is never.
+
+    :param camera_name: Name of the camera the frame was captured from
+    :param data: Full resolution RGB nd_array, if it has already been converted
+    :param model_input: RGB nd_array scaled for the detector, defaults to data
+    :param source: Decoded av.VideoFrame used to produce data on demand
+    :param crops: nd_array of shape (regions, height, width, 3) holding the crop of each region
+    of interest scaled for the detector, when the camera has them
+    :param regions: start_x, start_y, end_x, end_y pixel coordinates of each crop
+    :param time: Presentation time of the frame in seconds, if known
+    """
+
+    __slots__ = (
+        "camera_name", "model_input", "shape", "crops", "regions", "time", "_data", "_source"
+    )
+
+    def __init__(
+        self,
+        camera_name,
+        data=None,
+        model_input=None,
+        source=None,
+        crops=None,
+        regions=None,
+        time=None,
+    ):
+        self.camera_name = camera_name
+        self.model_input = data if model_input is None else model_input
+        self.shape = data.shape if data is not None else (source.height, source.width, 3)
+        self.crops = crops
+        self.regions = regions
+        self.time = time
+        self._data = data
+        self._source = source
 
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._source.to_ndarray(format="rgb24")
+            self._source = None  # Release the decoded frame, it's no longer needed
+        return self._data
 
-def get_frames(location, connection_timeout=None, read_timeout=None, fps=None, seek=0):
+
+# Maps the decode modes that may be configured for a camera to the libavcodec skip_frame
+# setting that implements them.  Frames skipped by the codec are never decoded at all.
+DECODE_MODES = {
+    "all": "DEFAULT",  # Decode every frame, drop the ones that aren't needed
+    "nonref": "NONREF",  # Skip frames no other frame depends on (i.e. B-frames)
+    "keyframes": "NONKEY",  # Only decode keyframes
+}
+
+
+def get_frames(
+    location,
+    connection_timeout=None,
+    read_timeout=None,
+    fps=None,
+    seek=0,
+    decode="all",
+    decode_threads=None,
+):
     """
     Generator that retrieves frames from a libavformat-compatible location.
 
@@ -22,36 +118,334 @@ def get_frames(location, connection_timeout=None, read_timeout=None, fps=None, s
     underlying library just isn't enough to handle an entire high resolution frame.
     :param connection_timeout: TCP connection timeout for remote hosts
     :param read_timeout: Socket read timeout for remote hosts
-    :param fps: Return this many frames per second, dropping the others.
+    :param fps: Return this many frames per second, dropping the others.  Frames are selected by
+    their timestamps so the requested rate is kept even if the codec skips frames.  This may be
+    a function, such as an AdaptiveFrameRate, that's called for each frame to change the rate
+    without reconnecting.  Rates it returns above the stream's are capped at the stream's.
     :param seek: Seek this many seconds ahead before returning frames, if possible.
+    :param decode: One of the DECODE_MODES.  Anything other than 'all' has the codec skip frames
+    before they are decoded rather than decoding and then dropping them.  Like fps, this may be
+    a function that's called for each frame to change the mode without reconnecting.
+    :param decode_threads: Function taking the opened video stream and returning the number of
+    threads and the thread type the codec decodes it with, such as DecodeThreadBudget.allocate.
+    Defaults to the AUTO thread type, with libavcodec choosing a thread for each core.
     """
 
+    decode_mode = decode if callable(decode) else None
+    if decode_mode:
+        decode = decode_mode()
+    _check_decode_mode(decode)
+
     container = av.open(
         location,
         options={"rtsp_flags": "prefer_tcp"},
         timeout=(connection_timeout, read_timeout),
     )
 
-    stream = container.streams.video[0]  # Only care about the first video stream
-    stream.thread_type = "AUTO"
+    try:
+        stream = container.streams.video[0]  # Only care about the first video stream
+        if decode_threads:
+            stream.thread_count, stream.thread_type = decode_threads(stream)
+        else:
+            stream.thread_type = "AUTO"
+        if decode != "all":
+            stream.codec_context.skip_frame = DECODE_MODES[decode]
+
+        if seek:
+            container.seek(int(seek / stream.time_base), stream=stream)
+
+        frame_rate = fps if callable(fps) else None
+        if frame_rate:
+            fps = frame_rate()
+        elif fps and fps > stream.guessed_rate:
+            raise ValueError(
+                f"Requested FPS {fps} is higher than stream supports "
+                f"{float(stream.guessed_rate)}"
+            )
+
+        interval = _interval(fps, stream)
+        next_time = None
+        frame_index = -1
+        for frame in container.decode(video=0):
+            frame_index += 1
+            if decode_mode:
+                requested = decode_mode()
+                if requested != decode:
+                    _check_decode_mode(requested)
+                    decode = requested
+                    stream.codec_context.skip_frame = DECODE_MODES[decode]
+
+            if frame_rate:
+                requested = frame_rate()
+                if requested != fps:
+                    # Take the next frame at the new rate right away, not after the old interval
+                    fps = requested
+                    interval = _interval(fps, stream)
+                    next_time = None
+
+            if interval:
+                frame_time = _frame_time(frame, frame_index, stream)
+                if next_time is not None and frame_time < next_time:
+                    continue
+
+                # Don't try to catch up after a gap in the stream, just carry on from here
+                if next_time is None or frame_time - next_time >= interval:
+                    next_time = frame_time
+                next_time += interval
 
-    if seek:
-        container.seek(int(seek / stream.time_base), stream=stream)
+            yield frame
+    finally:
+        # Also closes the connection when the generator is closed before the stream ends
+        container.close()
 
-    if fps and fps > stream.guessed_rate:
-        raise ValueError(
-            f"Requested FPS {fps} is higher than stream supports {float(stream.guessed_rate)}"
+
+class DecodeThreadBudget:
+    """
+    Shares a budget of decoding threads between cameras so that a codec per camera, each
+    starting a thread for every core, doesn't oversubscribe the machine.  Every camera gets a
+    thread and the rest are shared in proportion to the pixels each decodes per second.  A
+    camera's resolution and frame rate are only known once its stream is opened, until then
+    it's assumed to decode as much as the average camera.
+
+    Frame threading decodes several frames at once but holds each frame back until the frames
+    decoded alongside it are done.  Cameras that decode too few frames per second for that to
+    take less than max_latency seconds use slice threading instead.
+
+    :param threads: Total threads shared by the cameras, defaults to the number of cores
+    :param max_latency: Most seconds frame threading may hold frames back for
+    """
+
+    MAX_THREADS = 16  # libavcodec's limit for frame threading
+
+    def __init__(self, threads=None, max_latency=0.5):
+        self.threads = threads or os.cpu_count() or 1
+        self.max_latency = max_latency
+        self._cameras = {}
+        self._overrides = {}
+        self._rates = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Capture processes get a copy, so the lock isn't needed or picklable
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def register(self, name, fps=None, decode="all", threads=None):
+        """
+        Adds a camera to those sharing the budget, replacing how it was registered before.
+
+        :param fps: Frames per second the camera is configured to return
+        :param decode: The camera's decode mode, if it only decodes keyframes then fps is used
+        as the number of frames it decodes per second
+        :param threads: Decode the camera with this many threads rather than a share of the
+        budget.  They're taken out of the budget first.
+        """
+        with self._lock:
+            self._cameras[name] = fps if decode == "keyframes" else None
+            if threads:
+                self._overrides[name] = threads
+            else:
+                self._overrides.pop(name, None)
+
+    def unregister(self, name):
+        """Removes a camera from those sharing the budget"""
+        with self._lock:
+            self._cameras.pop(name, None)
+            self._overrides.pop(name, None)
+            self._rates.pop(name, None)
+        DECODE_THREADS.remove(name)
+
+    def update(self, name, width, height, rate):
+        """Records the resolution and frames per second of the stream a camera decodes"""
+        with self._lock:
+            fps = self._cameras.get(name)
+            self._rates[name] = width * height * float(min(fps or rate, rate))
+
+    def allocate(self, name, stream):
+        """
+        Records the resolution and frame rate of the camera's opened video stream and returns
+        the number of threads and thread type to decode it with.
+        """
+        rate = stream.guessed_rate or 25
+        self.update(name, stream.width, stream.height, rate)
+        count = self.allocation()[name]
+        fps = float(min(self._cameras.get(name) or rate, rate))
+        if count == 1:
+            thread_type = "NONE"
+        elif (count - 1) / fps <= self.max_latency:
+            thread_type = "AUTO"
+        else:
+            thread_type = "SLICE"
+
+        DECODE_THREADS.labels(name).set(count)
+        logger.info(
+            f"Decoding {name} at {stream.width}x{stream.height} and {fps:g} fps "
+            f"with {count} {thread_type.lower()} thread(s)"
         )
+        return count, thread_type
 
-    frame_index = -1
-    for frame in container.decode(video=0):
-        frame_index += 1
-        if fps and frame_index % (int(stream.guessed_rate / fps)) >= 1:
-            continue
+    def allocation(self):
+        """dict mapping the name of each camera to the number of threads it's decoded with"""
+        with self._lock:
+            shared = [name for name in self._cameras if name not in self._overrides]
+            known = [self._rates[name] for name in shared if name in self._rates]
+            average = sum(known) / len(known) if known else 1.0
+            rates = {name: self._rates.get(name, average) for name in shared}
+            total = sum(rates.values())
+            # Every camera gets a thread, the rest are shared out by largest remainder
+            extra = max(0, self.threads - sum(self._overrides.values()) - len(shared))
+            quotas = {name: extra * rate / total if total else 0.0 for name, rate in rates.items()}
+            shares = {name: int(quota) for name, quota in quotas.items()}
+            by_remainder = sorted(quotas, key=lambda name: shares[name] - quotas[name])
+            for name in by_remainder[: extra - sum(shares.values())]:
+                shares[name] += 1
 
-        yield frame
+            allocation = dict(self._overrides)
+            for name, share in shares.items():
+                allocation[name] = min(1 + share, self.MAX_THREADS)
+            return allocation
 
-    container.close()
+
+def _check_decode_mode(decode):
+    if decode not in DECODE_MODES:
+        raise ValueError(f"Unknown decode mode {decode}, expected one of {list(DECODE_MODES)}")
+
+
+def _interval(fps, stream):
+    """Seconds between the frames returned at fps, or None to return every frame"""
+    if not fps or (stream.guessed_rate and fps >= stream.guessed_rate):
+        return None
+    return Fraction(1) / Fraction(fps).limit_denominator(1000)
+
+
+class AdaptiveFrameRate:
+    """
+    Frame rate that rises to burst_fps as soon as activity, such as motion or a detected
+    object, is reported and falls back to idle_fps once there's been none for cooldown
+    seconds.  Call it to get the current rate.  It may be shared with a capture process, the
+    time of the last activity is kept in shared memory.
+
+    :param idle_fps: Frames per second while there's no activity
+    :param burst_fps: Frames per second after activity, or None for every frame
+    :param cooldown: Seconds without activity before falling back to idle_fps
+    """
+
+    def __init__(self, idle_fps, burst_fps=None, cooldown=30.0):
+        self.idle_fps = idle_fps
+        self.burst_fps = burst_fps
+        self.cooldown = cooldown
+        self._last_activity = multiprocessing.get_context("spawn").RawValue(
+            "d", float("-inf")
+        )
+
+    def __call__(self):
+        if time.monotonic() - self._last_activity.value < self.cooldown:
+            return self.burst_fps
+        return self.idle_fps
+
+    def activity(self):
+        """Reports activity, raising the rate to burst_fps until cooldown seconds from now"""
+        self._last_activity.value = time.monotonic()
+
+
+class FrameRateLimit:
+    """
+    A cap on a camera's frame rate that's lowered, such as by a BackpressureGovernor, when
+    object detection can't keep up.  It's applied inside get_frames so frames that wouldn't be
+    analyzed aren't converted, and when the cap is low enough the codec can be told to only
+    decode keyframes so most frames aren't even decoded.  It's kept in shared memory so
+    capture processes see it change.
+    """
+
+    def __init__(self):
+        context = multiprocessing.get_context("spawn")
+        self._fps = context.RawValue("d", 0.0)  # 0 means there's no limit
+        self._keyframes = context.RawValue("b", False)
+
+    @property
+    def fps(self):
+        """Most frames per second the camera may return, or None if it isn't limited"""
+        return self._fps.value or None
+
+    @property
+    def keyframes(self):
+        """If the camera should only decode keyframes"""
+        return bool(self._keyframes.value)
+
+    def set(self, fps=None, keyframes=False):
+        self._fps.value = fps or 0.0
+        self._keyframes.value = keyframes
+
+    def frame_rate(self, fps):
+        """Function for get_frames returning the lower of fps, which may be a function, and the cap"""
+        return functools.partial(_limited_frame_rate, self, fps)
+
+    def decode_mode(self, decode):
+        """Function for get_frames returning the decode mode, keyframes while they're forced"""
+        return functools.partial(_limited_decode_mode, self, decode)
+
+
+def _limited_frame_rate(limit, fps):
+    fps = fps() if callable(fps) else fps
+    if limit.fps is None:
+        return fps
+    return min(fps, limit.fps) if fps else limit.fps
+
+
+def _limited_decode_mode(limit, decode):
+    return "keyframes" if limit.keyframes else decode
+
+
+def _frame_time(frame, frame_index, stream):
+    """Exact presentation time of frame in seconds, estimated from its index if it has no pts"""
+    if frame.pts is not None and frame.time_base:
+        return frame.pts * frame.time_base
+    return frame_index / Fraction(stream.guessed_rate)
+
+
+def scale_frame(frame, input_size, regions=None):
+    """
+    Converts a decoded av.VideoFrame to RGB scaled to input_size for the detector.  If regions
+    are given, each is also cropped from the frame and scaled to input_size.  The regions must
+    all be the same size.  The frame is scaled once, so that the regions come out at
+    input_size, and the crops and whole frame input are cut and scaled down from that.
+
+    :param input_size: (width, height) the detector expects
+    :param regions: start_x, start_y, end_x, end_y pixel coordinates of each region
+    :return: Tuple of the model input and an nd_array of the crops, or None without regions
+    """
+    width, height = input_size
+    if not regions:
+        return frame.to_ndarray(width=width, height=height, format="rgb24"), None
+
+    start_x, start_y, end_x, end_y = regions[0]
+    scale_x, scale_y = width / (end_x - start_x), height / (end_y - start_y)
+    if scale_x > 1 or scale_y > 1:
+        # Regions smaller than the detector's input are scaled up from the full resolution
+        image = frame.to_ndarray(format="rgb24")
+        crops = numpy.stack(
+            [
+                cv2.resize(image[y0:y1, x0:x1], (width, height))
+                for x0, y0, x1, y1 in regions
+            ]
+        )
+    else:
+        scaled_width = max(width, round(frame.width * scale_x))
+        scaled_height = max(height, round(frame.height * scale_y))
+        image = frame.to_ndarray(width=scaled_width, height=scaled_height, format="rgb24")
+        crops = numpy.empty((len(regions), height, width, 3), dtype=numpy.uint8)
+        for crop, (x0, y0, _, _) in zip(crops, regions):
+            x = min(round(x0 * scale_x), scaled_width - width)
+            y = min(round(y0 * scale_y), scaled_height - height)
+            crop[:] = image[y : y + height, x : x + width]
+
+    model_input = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    return model_input, crops
 
 
 def view_frames(frames, fps):
@@ -63,17 +457,79 @@ def view_frames(frames, fps):
         timer.sleep()
 
 
+@dataclass(frozen=True)
+class CameraSettings:
+    """
+    The settings of a Camera that may be changed while it's running.  They're only ever
+    replaced as a whole, so threads that take a camera's settings once see a consistent set
+    even while they're being changed.
+    """
+
+    mask: object = None
+    interests: dict = None
+    motion_detector: object = None  # Frames it rejects aren't analyzed
+    send_delay: float = None  # Overrides the Notifier's, if set
+    detection_timeout: float = None  # Overrides the Notifier's, if set
+    tracker: object = None  # Follows objects between the frames that are analyzed
+    region_of_interest: object = None  # Only analyzed with an input_size
+
+
+def _setting(name):
+    """Property reading a setting from the camera's CameraSettings, replacing them to set it"""
+
+    def set_setting(camera, value):
+        camera.settings = replace(camera.settings, **{name: value})
+
+    return property(lambda camera: getattr(camera.settings, name), set_setting)
+
+
 class Camera:
-    def __init__(self, name, url, frame_action, fps=None, mask=None, interests=None):
+    mask = _setting("mask")
+    interests = _setting("interests")
+    motion_detector = _setting("motion_detector")
+    send_delay = _setting("send_delay")
+    detection_timeout = _setting("detection_timeout")
+    tracker = _setting("tracker")
+    region_of_interest = _setting("region_of_interest")
+
+    def __init__(
+        self,
+        name,
+        url,
+        frame_action,
+        fps=None,
+        mask=None,
+        interests=None,
+        decode="all",
+        input_size=None,
+        motion_detector=None,
+        send_delay=None,
+        detection_timeout=None,
+        tracker=None,
+        region_of_interest=None,
+        decode_budget=None,
+    ):
         self.name = name
         self.url = url
-        self.fps = fps
-        self.mask = mask
-        self.interests = interests or {}
+        self.fps = fps  # A number, or an AdaptiveFrameRate
+        self.decode = decode
+        self.input_size = input_size  # (width, height) the detector expects, if known
+        self.settings = CameraSettings(
+            mask=mask,
+            interests=interests or {},
+            motion_detector=motion_detector,
+            send_delay=send_delay,
+            detection_timeout=detection_timeout,
+            tracker=tracker,
+            region_of_interest=region_of_interest,
+        )
+        self.decode_budget = decode_budget  # DecodeThreadBudget the camera shares, if any
+        self.fps_limit = FrameRateLimit()  # Lowered when object detection can't keep up
         self.retry_wait = 1
         self.connection_timeout = 3.0
         self.read_timeout = 3.0
         self._frame_action = frame_action
+        self._stopped = threading.Event()
 
         self._capture_thread = threading.Thread(
             name=f"Camera-{self.name}", daemon=True, target=self._capture_loop
@@ -82,21 +538,408 @@ class Camera:
     def start(self):
         self._capture_thread.start()
 
+    def stop(self, timeout=None):
+        """
+        Disconnects from the camera and stops submitting its frames.  A camera that's been
+        stopped can't be started again.
+
+        :param timeout: Most seconds to wait for the capture thread to finish, which may take
+        up to read_timeout seconds.  Waits as long as it takes by default.
+        """
+        self._stopped.set()
+        thread = self._capture_thread
+        if thread.is_alive() and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    @property
+    def stopped(self):
+        return self._stopped.is_set()
+
     def _capture_loop(self):
-        while True:
+        decode_seconds = DECODE_SECONDS.labels(self.name)
+        convert_seconds = CONVERT_SECONDS.labels(self.name)
+
+        while not self._stopped.is_set():
             try:
                 logger.info(f"Connecting to camera {self.name}")
+                start = time.perf_counter()
                 for frame in get_frames(
                     self.url,
                     connection_timeout=self.connection_timeout,
                     read_timeout=self.read_timeout,
-                    fps=self.fps,
+                    fps=self.fps_limit.frame_rate(self.fps),
+                    decode=self.fps_limit.decode_mode(self.decode),
+                    decode_threads=self._decode_threads(),
                 ):
-                    self._frame_action(Frame(self.name, frame.to_ndarray(format="rgb24")))
+                    if self._stopped.is_set():
+                        break
+                    decode_seconds.observe(time.perf_counter() - start)
+                    with convert_seconds.time():
+                        frame = self._create_frame(frame)
+                    self._submit(frame)
+                    start = time.perf_counter()
 
             except Exception as e:
                 logger.error(
                     f"Error encountered reading frames from {self.name}: {e}.  "
                     f"Trying again in {self.retry_wait} second(s)."
                 )
-                time.sleep(self.retry_wait)
+                RECONNECTS.labels(self.name).inc()
+                self._stopped.wait(self.retry_wait)
+
+    def activity(self):
+        """Reports motion or a detected object to the camera's AdaptiveFrameRate, if it has one"""
+        if isinstance(self.fps, AdaptiveFrameRate):
+            self.fps.activity()
+
+    def feed(self, source):
+        """
+        Handles a frame decoded from the camera's video elsewhere than the capture thread, such
+        as from a recording, as if the camera had captured it
+
+        :param source: PyAV VideoFrame
+        """
+        self._submit(self._create_frame(source))
+
+    def _submit(self, frame):
+        if self._stopped.is_set():
+            return
+        FRAMES_CAPTURED.labels(self.name).inc()
+        motion_detector = self.motion_detector
+        if motion_detector is None or motion_detector(frame.model_input, frame.time):
+            if motion_detector is not None and motion_detector.moving:
+                self.activity()
+            self._frame_action(frame)
+        else:
+            MOTION_SKIPPED.labels(self.name).inc()
+
+    def _create_frame(self, frame):
+        if not self.input_size:
+            return Frame(self.name, frame.to_ndarray(format="rgb24"), time=frame.time)
+
+        # Let libswscale scale straight to the detector's input size while converting to RGB
+        regions = self._regions((frame.height, frame.width))
+        model_input, crops = scale_frame(frame, self.input_size, regions)
+        return Frame(
+            self.name,
+            model_input=model_input,
+            source=frame,
+            crops=crops,
+            regions=regions,
+            time=frame.time,
+        )
+
+    def _decode_threads(self):
+        if self.decode_budget is None:
+            return None
+        return functools.partial(self.decode_budget.allocate, self.name)
+
+    def _regions(self, shape):
+        region_of_interest = self.region_of_interest
+        if region_of_interest is None:
+            return None
+        return region_of_interest.regions(shape)
+
+
+class StaleFrameError(Exception):
+    """Raised when reading a frame from a FrameRing slot that has since been overwritten"""
+
+
+class FrameRing:
+    """
+    Slots in shared memory that a capture process writes decoded frames into so that the
+    main process can read them without pickling them or sending them through a pipe.  Each
+    slot holds the full resolution RGB image of a frame, the model input scaled from it and a
+    sequence number that tells readers whether the slot was overwritten since the frame was
+    announced.
+
+    :param shape: Shape of the full resolution RGB frames
+    :param input_shape: Shape of the model inputs, or None if they aren't needed.  Several
+    inputs, such as crops of regions of interest, may be held in each slot by giving a shape
+    with a leading dimension of their number.
+    :param slots: Number of frames held before the oldest is overwritten
+    :param name: Name of the shared memory of an existing ring to attach to.  If None, the
+    shared memory is created.
+    """
+
+    def __init__(self, shape, input_shape, slots, name=None):
+        from multiprocessing import shared_memory
+
+        self.shape = tuple(shape)
+        self.input_shape = tuple(input_shape) if input_shape else None
+        self.slots = slots
+
+        header_size = 8 * slots
+        frame_size = int(numpy.prod(self.shape))
+        input_size = int(numpy.prod(self.input_shape)) if self.input_shape else 0
+        self._memory = shared_memory.SharedMemory(
+            name=name,
+            create=name is None,
+            size=header_size + (frame_size + input_size) * slots,
+        )
+
+        buffer = self._memory.buf
+        self._sequences = numpy.ndarray((slots,), numpy.int64, buffer)
+        self._frames = numpy.ndarray((slots, *self.shape), numpy.uint8, buffer, header_size)
+        self._inputs = None
+        if self.input_shape:
+            self._inputs = numpy.ndarray(
+                (slots, *self.input_shape),
+                numpy.uint8,
+                buffer,
+                header_size + frame_size * slots,
+            )
+
+        if name is None:
+            self._sequences[:] = -1
+        self._written = 0
+
+    @property
+    def name(self):
+        return self._memory.name
+
+    def write(self, frame, model_input=None):
+        """
+        Converts the decoded av.VideoFrame into the oldest slot
+
+        :param model_input: nd_array of the input_shape to store with the frame, if the frame
+        should not simply be scaled to it
+        :return: Tuple of the slot and sequence number readers need to read the frame
+        """
+        sequence = self._written
+        slot = sequence % self.slots
+        self._sequences[slot] = -1  # Readers treat the slot as overwritten until we're done
+        self._frames[slot] = frame.to_ndarray(format="rgb24")
+        if model_input is not None:
+            self._inputs[slot] = model_input
+        elif self._inputs is not None:
+            height, width = self.input_shape[:2]
+            self._inputs[slot] = frame.to_ndarray(width=width, height=height, format="rgb24")
+        self._sequences[slot] = sequence
+        self._written += 1
+        return slot, sequence
+
+    def read_frame(self, slot, sequence):
+        """Copy of the full resolution frame, raising StaleFrameError if it's been overwritten"""
+        return self._read(self._frames, slot, sequence)
+
+    def read_input(self, slot, sequence):
+        """Copy of the model input, raising StaleFrameError if it's been overwritten"""
+        return self._read(self._inputs, slot, sequence)
+
+    def _read(self, images, slot, sequence):
+        if self._sequences is None or images is None or self._sequences[slot] != sequence:
+            raise StaleFrameError(f"Frame {sequence} is no longer available")
+        image = images[slot].copy()
+        if self._sequences is None or self._sequences[slot] != sequence:
+            raise StaleFrameError(f"Frame {sequence} was overwritten while it was read")
+        return image
+
+    def close(self, unlink=False):
+        """Detaches from the shared memory, which is removed entirely if unlink is True"""
+        self._sequences = self._frames = self._inputs = None
+        self._memory.close()
+        if unlink:
+            self._memory.unlink()
+
+
+class _RingFrameSource:
+    """Stands in for a decoded av.VideoFrame as a Frame's source, reading it from a FrameRing"""
+
+    __slots__ = ("height", "width", "_ring", "_slot", "_sequence")
+
+    def __init__(self, ring, slot, sequence):
+        self.height, self.width = ring.shape[:2]
+        self._ring = ring
+        self._slot = slot
+        self._sequence = sequence
+
+    def to_ndarray(self, format="rgb24"):
+        return self._ring.read_frame(self._slot, self._sequence)
+
+
+def _capture_process(location, options, input_size, slots, messages, region_of_interest=None):
+    """
+    Body of a ProcessCamera's capture process.  Decodes frames from location into a FrameRing
+    and announces them, along with the ring itself, the stream's resolution and frame rate
+    when decode threads are allocated for it and any errors, by putting tuples on the
+    messages queue.  With a region_of_interest, each slot's inputs are the whole frame's model
+    input followed by the crop of each region.
+    """
+    ring = None
+    decode_threads = options.get("decode_threads")
+    if decode_threads:
+
+        def report_stream(stream):
+            messages.put(("stream", stream.width, stream.height, stream.guessed_rate or 25))
+            return decode_threads(stream)
+
+        options = {**options, "decode_threads": report_stream}
+
+    try:
+        for frame in get_frames(location, **options):
+            shape = (frame.height, frame.width, 3)
+            regions = region_of_interest.regions(shape) if region_of_interest else None
+            if ring is None or ring.shape != shape:
+                if ring:
+                    ring.close()  # The main process unlinks it once it's switched rings
+                input_shape = None
+                if input_size:
+                    input_shape = (input_size[1], input_size[0], 3)
+                    if regions:
+                        input_shape = (1 + len(regions), *input_shape)
+                ring = FrameRing(shape, input_shape, slots)
+                messages.put(("ring", ring.name, ring.shape, ring.input_shape, slots))
+
+            model_input = None
+            if input_size and regions:
+                model_input, crops = scale_frame(frame, input_size, regions)
+                model_input = numpy.concatenate([model_input[numpy.newaxis], crops])
+            messages.put(("frame", *ring.write(frame, model_input), frame.time))
+
+        messages.put(("error", "End of stream"))
+
+    except Exception as e:
+        messages.put(("error", str(e)))
+
+    finally:
+        if ring:
+            ring.close()
+
+
+class ProcessCamera(Camera):
+    """
+    Camera that receives and decodes its video in a separate process so that decoding and
+    converting frames doesn't compete for the GIL with the rest of the application.  Frames
+    are passed back through a FrameRing in shared memory; only slot numbers are sent between
+    the processes.  If the process exits, or doesn't send a frame for hang_timeout seconds,
+    it's restarted.
+
+    :param ring_slots: Number of frames in the ring.  Frames that were overwritten before
+    they were analyzed are skipped, so this should comfortably exceed the number of frames
+    that may be waiting for analysis.
+    :param hang_timeout: Seconds without a frame before the capture process is restarted
+    """
+
+    def __init__(self, *args, ring_slots=8, hang_timeout=30.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ring_slots = ring_slots
+        self.hang_timeout = hang_timeout
+
+    def _capture_loop(self):
+        while not self._stopped.is_set():
+            try:
+                self._run_capture_process()
+            except Exception as e:
+                logger.error(f"Error encountered receiving frames from {self.name}: {e}")
+            if self._stopped.is_set():
+                break
+            logger.error(
+                f"Capture process for {self.name} stopped.  "
+                f"Trying again in {self.retry_wait} second(s)."
+            )
+            RECONNECTS.labels(self.name).inc()
+            self._stopped.wait(self.retry_wait)
+
+    def _run_capture_process(self):
+        context = multiprocessing.get_context("spawn")
+        messages = context.Queue()
+        options = {
+            "connection_timeout": self.connection_timeout,
+            "read_timeout": self.read_timeout,
+            "fps": self.fps_limit.frame_rate(self.fps),
+            "decode": self.fps_limit.decode_mode(self.decode),
+            # The process allocates threads from a copy of the budget, so report the stream
+            "decode_threads": self._decode_threads(),
+        }
+        process = context.Process(
+            name=f"Camera-{self.name}",
+            daemon=True,
+            target=_capture_process,
+            args=(
+                self.url,
+                options,
+                self.input_size,
+                self.ring_slots,
+                messages,
+                self.region_of_interest,
+            ),
+        )
+
+        logger.info(f"Starting capture process for camera {self.name}")
+        process.start()
+        try:
+            self._receive_frames(process, messages)
+        finally:
+            process.terminate()
+            process.join(timeout=5)
+            messages.close()
+
+    def _receive_frames(self, process, messages):
+        decode_seconds = DECODE_SECONDS.labels(self.name)
+        convert_seconds = CONVERT_SECONDS.labels(self.name)
+        ring = None
+        last_message = time.monotonic()
+        start = time.perf_counter()
+        try:
+            while not self._stopped.is_set():
+                try:
+                    message = messages.get(timeout=1.0)
+                except queue.Empty:
+                    if not process.is_alive():
+                        logger.error(
+                            f"Capture process for {self.name} exited with code {process.exitcode}"
+                        )
+                        return
+                    if time.monotonic() - last_message > self.hang_timeout:
+                        logger.error(f"Capture process for {self.name} stopped responding")
+                        return
+                    continue
+
+                last_message = time.monotonic()
+                if message[0] == "stream":
+                    if self.decode_budget is not None:
+                        self.decode_budget.update(self.name, *message[1:])
+
+                elif message[0] == "ring":
+                    if ring:
+                        ring.close(unlink=True)
+                    _, name, shape, input_shape, slots = message
+                    ring = FrameRing(shape, input_shape, slots, name=name)
+
+                elif message[0] == "frame":
+                    decode_seconds.observe(time.perf_counter() - start)
+                    try:
+                        with convert_seconds.time():
+                            frame = self._read_frame(ring, *message[1:])
+                    except StaleFrameError:
+                        logger.debug(f"Skipping frame from {self.name} that was overwritten")
+                    else:
+                        self._submit(frame)
+                    start = time.perf_counter()
+
+                else:
+                    logger.error(f"Error encountered reading frames from {self.name}: {message[1]}")
+                    return
+
+        finally:
+            if ring:
+                ring.close(unlink=True)
+
+    def _read_frame(self, ring, slot, sequence, time=None):
+        source = _RingFrameSource(ring, slot, sequence)
+        if not ring.input_shape:
+            return Frame(self.name, source.to_ndarray(), time=time)
+
+        model_input = ring.read_input(slot, sequence)
+        regions = self._regions(ring.shape)
+        if not regions:
+            return Frame(self.name, model_input=model_input, source=source, time=time)
+        return Frame(
+            self.name,
+            model_input=model_input[0],
+            source=source,
+            crops=model_input[1:],
+            regions=regions,
+            time=time,
+        )
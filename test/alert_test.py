@@ -1,6 +1,10 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+import threading
 import time
 
 import numpy
+from PIL import Image
 import pytest
 
 from visionalert import config
@@ -41,6 +45,48 @@ def patched_send_alert(monkeypatch):
     return mock_args
 
 
+@pytest.fixture
+def http_server(monkeypatch):
+    """Local stand-in for the S3 and Gotify servers that records the requests it receives"""
+    requests_received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Keep-alive
+
+        def do_PUT(self):
+            self.do_POST()
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            requests_received.append((self.command, self.path, self.client_address, body))
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(daemon=True, target=server.serve_forever).start()
+
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    for key, value in {
+        "gotify_url": url,
+        "gotify_key": "key",
+        "aws_s3_url": url,
+        "aws_access_key": "access",
+        "aws_secret_key": "secret",
+        "aws_image_bucket": "bucket",
+    }.items():
+        monkeypatch.setitem(config, key, value)
+    alert.close_clients()
+    yield requests_received
+    alert.close_clients()
+    server.shutdown()
+    server.server_close()
+
+
 @pytest.fixture
 def alert_event(detections):
     return alert.Event(detections[1], detections[0][0])
@@ -87,3 +133,215 @@ def test_send_alert_notification_image_url(patched_send_alert, alert_event):
     notifier = alert.Notifier(send_delay=0)
     notifier._send_alert(alert_event)
     assert patched_send_alert[1][1] == "http://foo.com/31337.jpg"
+
+
+def test_alert_scheduler_runs_functions_in_order_they_are_due():
+    scheduler = alert.AlertScheduler(max_workers=1)
+    calls = []
+    done = threading.Event()
+
+    scheduler.schedule(0.2, lambda: (calls.append("late"), done.set()))
+    scheduler.schedule(0.05, calls.append, "early")
+
+    assert done.wait(2)
+    assert calls == ["early", "late"]
+    assert scheduler.pending == 0
+
+
+def test_enqueue_alert_does_not_block(monkeypatch, alert_event):
+    scheduled = []
+    notifier = alert.Notifier(send_delay=60)
+    monkeypatch.setattr(notifier.scheduler, "schedule", lambda *x: scheduled.append(x))
+
+    notifier._enqueue_alert(alert_event)
+
+    assert scheduled == [(60, notifier._send_alert, alert_event)]
+
+
+def test_settings_come_from_interest_then_camera_then_notifier():
+    camera = video.Camera(
+        "camera",
+        "test.com",
+        None,
+        interests={
+            "person": detection.Interest("person", 0.5, 0, 100, send_delay=1),
+            "car": detection.Interest("car", 0.5, 0, 100),
+        },
+        send_delay=2,
+        detection_timeout=20,
+    )
+    notifier = alert.Notifier(detection_timeout=30, send_delay=5, cameras={"camera": camera})
+
+    assert notifier._setting("camera", "person", "send_delay") == 1
+    assert notifier._setting("camera", "car", "send_delay") == 2
+    assert notifier._setting("camera", "car", "detection_timeout") == 20
+    assert notifier._setting("other", "car", "send_delay") == 5
+
+
+def test_push_notifications_reuse_connection(http_server):
+    alert.send_push_notification("Front Door", "http://foo.com/1.jpg")
+    alert.send_push_notification("Front Door", "http://foo.com/2.jpg")
+
+    assert [request[:2] for request in http_server] == [("POST", "/message")] * 2
+    assert http_server[0][2] == http_server[1][2]  # Same client port, same connection
+
+
+def test_s3_uploads_reuse_client(http_server):
+    alert.s3_upload(BytesIO(b"jpeg"), "image/jpg", "1.jpg")
+    alert.s3_upload(BytesIO(b"jpeg"), "image/jpg", "2.jpg")
+
+    assert [request[:2] for request in http_server] == [
+        ("PUT", "/bucket/1.jpg"),
+        ("PUT", "/bucket/2.jpg"),
+    ]
+    assert http_server[0][3] == b"jpeg"
+    assert alert.s3_client() is alert.s3_client()
+
+
+def test_frame_to_jpeg_fits_within_max_size():
+    frame = numpy.zeros((1080, 1920, 3), dtype=numpy.uint8)
+    image = Image.open(alert.frame_to_jpeg(frame, max_size=1024))
+    assert image.format == "JPEG"
+    assert image.size == (1024, 576)
+
+
+def test_frame_to_jpegs_encodes_each_rendition():
+    frame = numpy.zeros((100, 200, 3), dtype=numpy.uint8)
+    frame[:, :, 0] = 255  # Red, so swapped channels would show
+
+    thumbnail, full = alert.frame_to_jpegs(frame, [50, None])
+
+    assert Image.open(thumbnail).size == (50, 25)
+    full_image = numpy.asarray(Image.open(full))
+    assert full_image.shape == (100, 200, 3)
+    assert full_image[50, 100, 0] > 200 and full_image[50, 100, 2] < 50
+
+
+def test_send_alert_uploads_full_image_and_links_to_it(patched_send_alert, alert_event):
+    notifier = alert.Notifier(send_delay=0, full_image=True)
+    notifier._send_alert(alert_event)
+    assert [args[2] for args in patched_send_alert[:2]] == ["31337.jpg", "31337-full.jpg"]
+    assert patched_send_alert[2][1:] == (
+        "http://foo.com/31337.jpg",
+        "http://foo.com/31337-full.jpg",
+    )
+
+
+def test_event_keeps_frame_scaled_to_max_size(detections):
+    detected_objects, frame = detections
+    event = alert.Event(frame, detected_objects[0], max_size=100)
+    assert event.frame.shape == (100, 100, 3)
+    assert event.nbytes == 100 * 100 * 3
+
+
+def test_event_copies_frame_that_is_small_enough(detections):
+    detected_objects, frame = detections
+    event = alert.Event(frame, detected_objects[0], max_size=1024)
+
+    assert not numpy.shares_memory(event.frame, frame.data)
+
+
+def test_event_keeps_current_frame_if_new_frame_exceeds_max_bytes(detections):
+    detected_objects, frame = detections
+    event = alert.Event(frame, detected_objects[0])
+    kept = event.frame
+
+    event.update(0.99, numpy.ones((400, 400, 3), dtype=numpy.uint8), max_bytes=kept.nbytes)
+
+    assert event.frame is kept
+
+
+def test_sent_event_releases_frame(patched_send_alert, alert_event):
+    notifier = alert.Notifier()
+    notifier._send_alert(alert_event)
+    alert_event.update(0.99, numpy.ones((10, 10, 3), dtype=numpy.uint8))
+    assert alert_event.frame is None
+    assert alert_event.nbytes == 0
+
+
+def test_finished_events_are_forgotten(enqueuer_args, detections, monkeypatch):
+    notifier = alert.Notifier(detection_timeout=30)
+    notifier.submit_detections(detections)
+
+    monkeypatch.setattr(time, "time", lambda: enqueuer_args[0][1].last_frame_time + 31)
+    notifier.submit_detections(([], detections[1]))
+
+    assert notifier.current_events == {}
+
+
+def test_new_event_drops_least_recent_event_over_memory_limit(enqueuer_args, detections):
+    detected_objects, frame = detections
+    car = detection.DetectionResult("car", 0.8, detection.Rectangle(0, 0, 20, 20))
+    notifier = alert.Notifier(max_event_bytes=frame.data.nbytes * 1.5)
+
+    notifier.submit_detections((detected_objects[:1], frame))
+    notifier.submit_detections(([car], frame))
+
+    person_event, car_event = [args[1] for args in enqueuer_args]
+    assert person_event.frame is None
+    assert car_event.frame is not None
+    assert notifier.event_bytes <= notifier.max_event_bytes
+
+
+def test_tracked_objects_get_their_own_events(enqueuer_args, detections):
+    _, frame = detections
+    people = [
+        detection.DetectionResult("person", 0.8, detection.Rectangle(0, 0, 20, 20), 1),
+        detection.DetectionResult("person", 0.8, detection.Rectangle(50, 50, 70, 70), 2),
+    ]
+    notifier = alert.Notifier()
+    notifier.submit_detections((people, frame))
+    notifier.submit_detections((people, frame))
+    assert len(enqueuer_args) == 2
+
+
+def test_unsent_alerts_of_finished_events_count_towards_memory_limit(
+    enqueuer_args, detections, monkeypatch
+):
+    detected_objects, frame = detections
+    car = detection.DetectionResult("car", 0.8, detection.Rectangle(0, 0, 20, 20))
+    notifier = alert.Notifier(detection_timeout=30, max_event_bytes=frame.data.nbytes * 1.5)
+    notifier.submit_detections((detected_objects[:1], frame))
+    person_event = enqueuer_args[0][1]
+
+    monkeypatch.setattr(time, "time", lambda: person_event.last_frame_time + 31)
+    notifier.submit_detections(([car], frame))
+
+    assert ("person", None) not in notifier.current_events["camera"]
+    assert person_event.frame is None  # Dropped to make room, although its event was over
+    assert notifier.event_bytes <= notifier.max_event_bytes
+
+
+
+class CountingSource:
+    """Stands in for a decoded video frame, counting how often it's converted"""
+
+    height, width = 20, 30
+
+    def __init__(self):
+        self.conversions = 0
+
+    def to_ndarray(self, format="rgb24"):
+        self.conversions += 1
+        return numpy.zeros((self.height, self.width, 3), dtype=numpy.uint8)
+
+
+def test_lower_confidence_detection_should_not_convert_frame(enqueuer_args):
+    person = detection.DetectionResult("person", 0.9, detection.Rectangle(0, 0, 20, 20))
+    model_input = numpy.zeros((10, 10, 3), dtype=numpy.uint8)
+    notifier = alert.Notifier()
+    notifier.submit_detections(
+        ([person], video.Frame("camera", model_input=model_input, source=CountingSource()))
+    )
+    event = enqueuer_args[0][1]
+    last_frame_time = event.last_frame_time
+
+    source = CountingSource()
+    less_sure = person._replace(confidence=0.7)
+    notifier.submit_detections(
+        ([less_sure], video.Frame("camera", model_input=model_input, source=source))
+    )
+
+    assert source.conversions == 0
+    assert event.confidence == 0.9
+    assert event.last_frame_time >= last_frame_time
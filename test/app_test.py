@@ -1,10 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
 import sys
+import threading
+import time
+from unittest import mock
 
 import numpy
+from PIL import Image
 import pytest
+import yaml
 
 import visionalert.app as app
 from visionalert.detection import Interest
+from visionalert.video import ProcessCamera
 
 
 @pytest.fixture
@@ -23,7 +30,7 @@ def camera_dict():
 def test_init_camera_with_all_values(camera_dict, monkeypatch):
     mask = numpy.zeros((200, 200))
 
-    def init_mask(file):
+    def init_mask(file, zones=None):
         if file != "mask.jpg":
             raise ValueError
         return mask
@@ -36,6 +43,7 @@ def test_init_camera_with_all_values(camera_dict, monkeypatch):
     assert camera.name == "Test Camera"
     assert camera.url == "test.com"
     assert camera.fps == 5
+    assert camera.decode == "all"
     assert camera.mask is mask
     assert camera.interests["person"] == Interest("person", 0.6, 10000, 20000)
     assert camera._frame_action is frame_action
@@ -51,3 +59,295 @@ def test_init_camera_with_missing_optional_values(camera_dict):
     assert camera.fps is None
     assert camera.mask is None
     assert camera.interests["person"] == Interest("person", 0.6, 0, sys.maxsize)
+
+
+def test_init_camera_with_alert_settings(camera_dict, monkeypatch):
+    monkeypatch.setattr(app, "init_mask", value=lambda file, zones: None)
+    camera_dict["send_delay_seconds"] = 2
+    camera_dict["interests"]["person"]["detection_timeout_seconds"] = 60
+
+    camera = app.init_camera(camera_dict, None)
+
+    assert camera.send_delay == 2
+    assert camera.detection_timeout is None
+    assert camera.interests["person"].detection_timeout == 60
+    assert camera.interests["person"].send_delay is None
+
+
+def test_init_camera_with_motion_detector(camera_dict, monkeypatch):
+    mask = numpy.zeros((200, 200))
+    monkeypatch.setattr(app, "init_mask", value=lambda file, zones: mask)
+    camera_dict["motion"] = {"threshold": 0.1, "check_interval_seconds": 5}
+
+    camera = app.init_camera(camera_dict, None)
+
+    assert camera.motion_detector.threshold == 0.1
+    assert camera.motion_detector.check_interval == 5
+    assert camera.motion_detector.mask is mask
+
+
+def test_init_camera_without_motion_detector(camera_dict, monkeypatch):
+    monkeypatch.setattr(app, "init_mask", value=lambda file, zones: None)
+    assert app.init_camera(camera_dict, None).motion_detector is None
+
+
+def test_init_camera_with_tracker(camera_dict, monkeypatch):
+    monkeypatch.setattr(app, "init_mask", value=lambda file, zones: None)
+    camera_dict["tracking"] = {"detect_every_frames": 3, "optical_flow": True}
+
+    camera = app.init_camera(camera_dict, None)
+
+    assert camera.tracker.detect_interval == 3
+    assert camera.tracker.optical_flow
+    assert camera.tracker.iou_threshold == 0.3
+
+
+def test_init_camera_with_region_of_interest(camera_dict, monkeypatch):
+    mask = object()
+    monkeypatch.setattr(app, "init_mask", value=lambda file, zones: mask)
+    camera_dict["region_of_interest"] = {"tiles": [2, 1]}
+
+    camera = app.init_camera(camera_dict, None)
+
+    assert camera.region_of_interest.area is None
+    assert camera.region_of_interest.mask is mask
+    assert camera.region_of_interest.tiles == (2, 1)
+
+
+def test_init_camera_with_zones(camera_dict):
+    del camera_dict["mask"]
+    camera_dict["zones"] = [[[0.0, 0.0], [0.5, 0.0], [0.5, 1.0], [0.0, 1.0]]]
+
+    camera = app.init_camera(camera_dict, None)
+
+    assert camera.mask.image is None
+    assert camera.mask.region((10, 10))[:, :5].all()
+    assert not camera.mask.region((10, 10))[:, 6:].any()
+
+
+def test_init_mask_should_load_grayscale_image(tmpdir):
+    filename = str(tmpdir.join("mask.png"))
+    Image.fromarray(numpy.full((20, 30, 3), 255, dtype=numpy.uint8)).save(filename)
+
+    mask = app.init_mask(filename)
+
+    assert mask.image.shape == (20, 30)
+
+
+def test_init_camera_should_load_masks_concurrently(camera_dict, tmpdir):
+    configs = []
+    for i in range(8):
+        filename = str(tmpdir.join(f"mask{i}.png"))
+        Image.fromarray(numpy.full((20, 30 + i, 3), 255, dtype=numpy.uint8)).save(filename)
+        configs.append({**camera_dict, "name": f"Camera {i}", "mask": filename})
+
+    with ThreadPoolExecutor(8) as executor:
+        cameras = list(executor.map(lambda params: app.init_camera(params, None), configs))
+
+    assert [camera.mask.image.shape for camera in cameras] == [(20, 30 + i) for i in range(8)]
+
+
+def test_init_camera_with_capture_process(camera_dict, monkeypatch):
+    monkeypatch.setattr(app, "init_mask", value=lambda file, zones: None)
+    camera_dict["capture_process"] = True
+    camera_dict["capture_ring_frames"] = 12
+
+    camera = app.init_camera(camera_dict, None)
+
+    assert isinstance(camera, ProcessCamera)
+    assert camera.ring_slots == 12
+
+
+def test_init_camera_with_decode_budget(camera_dict, monkeypatch):
+    monkeypatch.setattr(app, "init_mask", value=lambda file, zones: None)
+    budget = app.init_decode_budget({"decode_thread_budget": 6})
+    camera_dict["decode_threads"] = 2
+
+    camera = app.init_camera(camera_dict, None, decode_budget=budget)
+
+    assert camera.decode_budget is budget
+    assert budget.allocation() == {"Test Camera": 2}
+
+
+def test_init_decode_budget_should_leave_detector_threads(monkeypatch):
+    monkeypatch.setattr(app.os, "cpu_count", lambda: 8)
+
+    assert app.init_decode_budget({}).threads == 8
+    assert app.init_decode_budget({"detector_threads": 2, "detector_pool_size": 3}).threads == 2
+
+
+def test_init_input_queue_should_fall_back_to_old_setting():
+    cameras = [{"name": "front"}, {"name": "back"}]
+
+    assert app.init_input_queue({"cameras": cameras})._slots == 1
+    config = {"cameras": cameras, "input_queue_frames_per_camera": 3}
+    assert app.init_input_queue(config)._slots == 3
+    assert app.init_input_queue({"cameras": cameras, "input_queue_maximum_frames": 20})._slots == 10
+
+
+def test_init_camera_with_adaptive_fps(camera_dict, monkeypatch):
+    monkeypatch.setattr(app, "init_mask", value=lambda file, zones: None)
+    camera_dict["adaptive_fps"] = {"idle_fps": 0.5, "cooldown_seconds": 10}
+
+    camera = app.init_camera(camera_dict, None)
+
+    assert camera.fps() == 0.5
+    assert camera.fps.burst_fps == 5
+    assert camera.fps.cooldown == 10
+
+
+def test_startup_timer_should_report_phases(monkeypatch):
+    times = iter([10.0, 11.0, 13.5, 14.0])
+    monkeypatch.setattr(app.time, "monotonic", lambda: next(times))
+    timer = app.StartupTimer()
+
+    assert timer.timed("detectors", lambda x: x * 2, 21) == 42
+    timer.record("ready")
+
+    assert app.STARTUP_SECONDS.labels("detectors").value == 2.5
+    assert app.STARTUP_SECONDS.labels("ready").value == 4.0
+
+
+def test_startup_timer_should_record_event():
+    timer = app.StartupTimer()
+    event = threading.Event()
+    app.STARTUP_SECONDS.remove("first_detection")
+
+    timer.record_event("first_detection", event)
+    event.set()
+
+    for _ in range(100):
+        if ("first_detection",) in app.STARTUP_SECONDS._children:
+            break
+        time.sleep(0.01)
+    assert app.STARTUP_SECONDS.labels("first_detection").value > 0
+
+
+FRONT = {"name": "Front", "url": "rtsp://front", "interests": {"car": {"confidence": 0.5}}}
+BACK = {"name": "Back", "url": "rtsp://back", "interests": {"person": {"confidence": 0.6}}}
+
+
+def create_camera(params):
+    camera = app.init_camera(params, None)
+    camera.start = mock.Mock()
+    camera.stop = mock.Mock()
+    return camera
+
+
+def write_config(filename, cameras, **settings):
+    with open(filename, "w") as file:
+        yaml.safe_dump(
+            {
+                "connection_timeout_seconds": 3,
+                "read_timeout_seconds": 3,
+                "tensorflow_model_file": "detect.tflite",
+                "cameras": cameras,
+                **settings,
+            },
+            file,
+        )
+
+
+@pytest.fixture
+def reloader(tmp_path, monkeypatch):
+    filename = tmp_path / "config.yml"
+    write_config(filename, [FRONT, BACK])
+    for key, value in app.read_config(filename).items():
+        monkeypatch.setitem(app.config, key, value)
+
+    cameras = {params["name"]: create_camera(params) for params in app.config["cameras"]}
+    return app.ConfigReloader(str(filename), cameras, create_camera, app.FrameScheduler())
+
+
+def test_config_reloader_should_add_and_remove_cameras(reloader):
+    front, back = reloader.cameras["Front"], reloader.cameras["Back"]
+    side = {"name": "Side", "url": "rtsp://side", "interests": {"dog": {"confidence": 0.7}}}
+    write_config(reloader.filename, [FRONT, side])
+
+    assert reloader.reload()
+
+    assert list(reloader.cameras) == ["Front", "Side"]
+    assert reloader.cameras["Front"] is front
+    front.stop.assert_not_called()
+    back.stop.assert_called_once()
+    reloader.cameras["Side"].start.assert_called_once()
+    assert app.config["cameras"] == [FRONT, side]
+
+
+def test_config_reloader_should_swap_interests_without_reconnecting(reloader):
+    front = reloader.cameras["Front"]
+    interests = front.interests
+    write_config(reloader.filename, [{**FRONT, "interests": {"car": {"confidence": 0.8}}}, BACK])
+
+    reloader.reload()
+
+    assert reloader.cameras["Front"] is front
+    assert front.interests is not interests
+    assert front.interests["car"].confidence == 0.8
+    front.stop.assert_not_called()
+
+
+def test_config_reloader_should_swap_live_settings_together(reloader, monkeypatch):
+    front = reloader.cameras["Front"]
+    settings = front.settings
+    monkeypatch.setattr(reloader, "create_camera", mock.Mock())
+    changed = {**FRONT, "zones": [[[0.0, 0.0], [1.0, 0.0], [1.0, 1.0]]], "tracking": {}}
+    write_config(reloader.filename, [changed, BACK])
+
+    reloader.reload()
+
+    reloader.create_camera.assert_not_called()
+    assert front.settings is not settings
+    assert front.mask is not None and front.tracker is not None
+    assert front.interests is settings.interests
+
+
+def test_config_reloader_should_reconnect_when_url_changes(reloader):
+    front = reloader.cameras["Front"]
+    write_config(reloader.filename, [{**FRONT, "url": "rtsp://new"}, BACK])
+
+    reloader.reload()
+
+    front.stop.assert_called_once()
+    assert reloader.cameras["Front"].url == "rtsp://new"
+    reloader.cameras["Front"].start.assert_called_once()
+
+
+def test_config_reloader_should_only_warn_about_settings_needing_restart(reloader, caplog):
+    write_config(reloader.filename, [FRONT, BACK], tensorflow_model_file="other.tflite")
+
+    reloader.reload()
+
+    assert app.config["tensorflow_model_file"] == "detect.tflite"
+    assert "tensorflow_model_file take effect after restarting" in caplog.text
+
+
+def test_config_reloader_should_keep_running_config_when_file_invalid(reloader):
+    with open(reloader.filename, "w") as file:
+        file.write("cameras: [")
+
+    assert not reloader.reload()
+
+    assert list(reloader.cameras) == ["Front", "Back"]
+    assert app.config["cameras"] == [FRONT, BACK]
+
+
+def test_config_reloader_should_keep_camera_whose_config_is_invalid(reloader):
+    front = reloader.cameras["Front"]
+    write_config(reloader.filename, [{"name": "Front", "url": "rtsp://front"}, BACK])
+
+    assert reloader.reload()
+
+    assert reloader.cameras["Front"] is front
+    assert app.config["cameras"] == [FRONT, BACK]
+
+
+def test_config_reloader_should_reload_when_requested(reloader, monkeypatch):
+    reloaded = threading.Event()
+    monkeypatch.setattr(reloader, "reload", reloaded.set)
+    reloader.start()
+
+    reloader.request()
+
+    assert reloaded.wait(5)
+
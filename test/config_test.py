@@ -1,8 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
 import os
+import sys
+import types
 
 import pytest
 
-from visionalert import load_config, config
+from visionalert import lazy_import, load_config, config
 
 
 @pytest.fixture
@@ -22,3 +25,36 @@ def test_load_config_with_variables(config_file):
     assert config['line1'] == 'line1value'
     assert config['line2'] == 'line2BARvalue'
     assert config['line3'] == 'line3BARvalueline3BARvalue'
+
+
+def test_lazy_import_should_load_module_on_first_use(tmpdir, monkeypatch):
+    tmpdir.join('lazy_example.py').write("loaded = True\nvalue = 42\n")
+    monkeypatch.syspath_prepend(str(tmpdir))
+    monkeypatch.delitem(sys.modules, 'lazy_example', raising=False)
+
+    module = lazy_import('lazy_example')
+
+    assert type(module) is not types.ModuleType  # Not loaded yet
+    assert module.value == 42
+    assert type(module) is types.ModuleType
+
+
+def test_lazy_import_should_load_module_once_when_used_by_several_threads(tmpdir, monkeypatch):
+    tmpdir.join('lazy_slow.py').write("import time\ntime.sleep(0.2)\nvalue = 42\n")
+    monkeypatch.syspath_prepend(str(tmpdir))
+    monkeypatch.delitem(sys.modules, 'lazy_slow', raising=False)
+    module = lazy_import('lazy_slow')
+
+    with ThreadPoolExecutor(16) as executor:
+        values = list(executor.map(lambda _: module.value, range(16)))
+
+    assert values == [42] * 16
+
+
+def test_lazy_import_should_return_imported_module():
+    assert lazy_import('os') is os
+
+
+def test_lazy_import_should_raise_for_missing_module():
+    with pytest.raises(ModuleNotFoundError):
+        lazy_import('visionalert_no_such_module')
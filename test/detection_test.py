@@ -1,6 +1,11 @@
+from dataclasses import astuple
+import threading
+import time
+
 import numpy as np
 import pytest
 
+from visionalert.app import FrameScheduler
 import visionalert.video as video
 import visionalert.detection as detection
 from visionalert.detection import Rectangle, DetectionResult, Interest, Dispatcher
@@ -20,6 +25,48 @@ def test_is_masked(rectangle, expected):
     assert detection.is_masked(mask, rectangle) == expected
 
 
+@pytest.mark.parametrize(
+    "rectangle, expected",
+    [
+        (Rectangle(4, 1, 9, 9), False),
+        (Rectangle(4, 1, 9, 5), True),
+        (Rectangle(0, 0, 100, 100), False),
+        (Rectangle(5, 5, 5, 9), True),  # Empty
+    ],
+)
+def test_mask_is_masked(rectangle, expected):
+    image = np.zeros((10, 10), dtype=np.uint8)
+    image[5:, :] = 255  # unmask the bottom half
+    assert detection.is_masked(detection.Mask(image), rectangle) == expected
+
+
+def test_mask_should_scale_to_frame():
+    image = np.zeros((10, 10), dtype=np.uint8)
+    image[5:, :] = 255  # unmask the bottom half
+    mask = detection.Mask(image)
+
+    assert mask.is_masked(Rectangle(0, 0, 100, 90), (200, 100)) is True
+    assert mask.is_masked(Rectangle(0, 0, 100, 110), (200, 100)) is False
+
+
+def test_mask_with_zones():
+    zones = [[[0.5, 0.5], [1.0, 0.5], [1.0, 1.0], [0.5, 1.0]]]  # Bottom right quarter
+    mask = detection.Mask(zones=zones)
+
+    assert mask.is_masked(Rectangle(0, 0, 90, 90), (200, 200)) is True
+    assert mask.is_masked(Rectangle(0, 0, 110, 110), (200, 200)) is False
+
+
+def test_mask_combines_image_and_zones():
+    image = np.zeros((10, 10), dtype=np.uint8)
+    image[:, :2] = 255  # unmask the left edge
+    mask = detection.Mask(image, zones=[[[0.5, 0.5], [1.0, 0.5], [1.0, 1.0], [0.5, 1.0]]])
+
+    assert mask.is_masked(Rectangle(0, 0, 2, 2)) is False
+    assert mask.is_masked(Rectangle(8, 8, 10, 10)) is False
+    assert mask.is_masked(Rectangle(3, 0, 10, 4)) is True
+
+
 def test_is_masked_when_mask_is_none():
     assert detection.is_masked(None, Rectangle(0, 0, 100, 100)) is False
 
@@ -47,6 +94,42 @@ def test_matches_interest(detection_result, expected):
     assert detection.matches_interest(interests, detection_result) == expected
 
 
+def test_interest_filter_should_match_matches_interest():
+    interests = {
+        "person": Interest("person", 0.6, minimum_area=0, maximum_area=1000000),
+        "car": Interest("car", 0.5, minimum_area=5000, maximum_area=10000),
+    }
+    labels = ["person", "car", "truck"]
+    results = [
+        DetectionResult("person", 0.1, MEDIUM_RECTANGLE),
+        DetectionResult("person", 0.8, MEDIUM_RECTANGLE),
+        DetectionResult("car", 0.8, SMALL_RECTANGLE),
+        DetectionResult("car", 0.8, MEDIUM_RECTANGLE),
+        DetectionResult("car", 0.8, LARGE_RECTANGLE),
+        DetectionResult("truck", 0.8, MEDIUM_RECTANGLE),
+    ]
+    detections = detection.Detections(
+        labels,
+        np.array([labels.index(r.name) for r in results]),
+        np.array([r.confidence for r in results]),
+        np.array([astuple(r.coordinates) for r in results]),
+    )
+
+    matched = detection.InterestFilter(interests, labels)(detections)
+
+    assert list(matched) == [r for r in results if detection.matches_interest(interests, r)]
+
+
+def test_detections_should_produce_detection_results():
+    detections = detection.Detections(
+        ["cat", "person"], np.array([1]), np.array([0.75]), np.array([[10, 20, 30, 60]])
+    )
+
+    assert len(detections) == 1
+    assert detections[0] == DetectionResult("person", 0.75, Rectangle(10, 20, 30, 60))
+    assert detections[0].coordinates.area == 800
+
+
 def test_dispatcher_process_frame(mocker, mock_camera, mock_detection_results):
     alert_function = mocker.Mock()
 
@@ -61,13 +144,450 @@ def test_dispatcher_process_frame(mocker, mock_camera, mock_detection_results):
     d = Dispatcher(None, detection_function, alert_function, camera_dict)
     d._process_frame(frame)
 
-    detection_function.assert_called_once_with(frame.data)
+    detection_function.assert_called_once_with(frame.model_input, frame.shape)
     alert_function.assert_called_once_with(([mock_detection_results[0]], frame))
     detection.annotate_frame.assert_called_once_with(
         frame.data, mock_detection_results[0]
     )
 
 
+def test_dispatcher_process_frames_in_batch(mocker, mock_camera, mock_detection_results):
+    alert_function = mocker.Mock()
+    detection_function = mocker.Mock()
+    detection_function.detect_batch.return_value = [mock_detection_results, []]
+    mocker.patch("visionalert.detection.annotate_frame")
+
+    frames = [
+        video.Frame(mock_camera.name, np.zeros((200, 200, 3))),
+        video.Frame(mock_camera.name, np.zeros((200, 200, 3))),
+    ]
+
+    d = Dispatcher(None, detection_function, alert_function, {mock_camera.name: mock_camera})
+    d._process_frames(frames)
+
+    detection_function.detect_batch.assert_called_once_with(
+        [frame.model_input for frame in frames], [frame.shape for frame in frames]
+    )
+    alert_function.assert_called_once_with(([mock_detection_results[0]], frames[0]))
+
+
+def test_dispatcher_sets_first_analyzed(mocker, mock_camera, mock_detection_results):
+    detection_function = mocker.Mock(return_value=mock_detection_results)
+    mocker.patch("visionalert.detection.annotate_frame")
+    d = Dispatcher(None, detection_function, mocker.Mock(), {mock_camera.name: mock_camera})
+    assert not d.first_analyzed.is_set()
+
+    d._process_frame(video.Frame(mock_camera.name, np.zeros((200, 200, 3))))
+
+    assert d.first_analyzed.is_set()
+
+
+def test_dispatcher_get_batch_should_stop_when_queue_empty():
+    q = FrameScheduler(5)
+    frames = [video.Frame("camera", np.zeros((1, 1, 3))) for _ in range(3)]
+    for frame in frames:
+        q.put(frame)
+
+    d = Dispatcher(q.get, None, None, None, batch_size=4, batch_timeout=0.01)
+
+    assert d._get_batch() == frames
+
+
+def test_sequencer_should_take_turns_in_ticket_order():
+    sequencer = detection.Sequencer()
+    tickets = [sequencer.ticket("camera") for _ in range(3)]
+    order = []
+
+    def take_turn(ticket):
+        with sequencer.turn("camera", ticket):
+            order.append(ticket)
+
+    threads = [threading.Thread(target=take_turn, args=(t,)) for t in reversed(tickets)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert order == tickets
+
+
+def test_dispatcher_pool_should_alert_in_camera_order(mocker, mock_camera):
+    alert_function = mocker.Mock()
+    mocker.patch("visionalert.detection.annotate_frame")
+    frames = [video.Frame(mock_camera.name, np.zeros((200, 200, 3))) for _ in range(2)]
+    q = FrameScheduler(5)
+    for frame in frames:
+        q.put(frame)
+
+    slow_started = threading.Event()
+
+    def slow_detection(image, shape):
+        slow_started.set()
+        time.sleep(0.2)
+        return [DetectionResult("person", 0.8, Rectangle(10, 10, 50, 50))]
+
+    def fast_detection(image, shape):
+        slow_started.wait(timeout=5)
+        return [DetectionResult("person", 0.9, Rectangle(10, 10, 50, 50))]
+
+    d = Dispatcher(
+        q.get, [slow_detection, fast_detection], alert_function, {mock_camera.name: mock_camera}
+    )
+    d.start()
+    deadline = time.monotonic() + 5
+    while alert_function.call_count < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert [c[0][0][1] for c in alert_function.call_args_list] == frames
+
+
+def test_dispatcher_pool_should_count_tracked_frames_in_camera_order(mock_camera):
+    mock_camera.tracker = detection.Tracker(detect_interval=2)
+    frames = [
+        video.Frame(mock_camera.name, np.full((200, 200, 3), i, dtype=np.uint8)) for i in range(2)
+    ]
+    analyzed = []
+
+    def detect(image, shape):
+        analyzed.append(int(image[0, 0, 0]))
+        return []
+
+    d = Dispatcher(None, [detect, detect], lambda data: None, {mock_camera.name: mock_camera})
+    tickets = [d._sequencer.ticket(mock_camera.name) for _ in frames]
+    # The second frame's thread gets going first
+    later = threading.Thread(target=d._process_frames, args=([frames[1]], detect, tickets[1:]))
+    later.start()
+    time.sleep(0.1)
+    d._process_frames([frames[0]], detect, tickets[:1])
+    later.join(timeout=5)
+
+    assert analyzed == [0]
+
+
+def test_motion_detector_should_skip_static_frames():
+    motion = detection.MotionDetector(check_interval=60)
+    frame = np.zeros((90, 160, 3), dtype=np.uint8)
+
+    assert motion(frame) is True  # First frame always has to be analyzed
+    assert motion(frame) is False
+    assert (motion.checked, motion.skipped) == (1, 1)
+
+
+def test_motion_detector_should_detect_motion():
+    motion = detection.MotionDetector(check_interval=60)
+    frame = np.zeros((90, 160, 3), dtype=np.uint8)
+    moved = frame.copy()
+    moved[20:60, 40:80] = 255
+
+    motion(frame)
+    assert motion(moved) is True
+
+
+def test_motion_detector_should_ignore_masked_motion():
+    mask = np.zeros((180, 320), dtype=np.uint8)
+    mask[:, 160:] = 255  # Only the right half is of interest
+    motion = detection.MotionDetector(check_interval=60, mask=detection.Mask(mask))
+    frame = np.zeros((90, 160, 3), dtype=np.uint8)
+    moved = frame.copy()
+    moved[20:60, 10:50] = 255
+
+    motion(frame)
+    assert motion(moved) is False
+
+
+def test_motion_detector_should_force_periodic_check():
+    motion = detection.MotionDetector(check_interval=0)
+    frame = np.zeros((90, 160, 3), dtype=np.uint8)
+
+    motion(frame)
+    assert motion(frame) is True
+
+
+def test_motion_detector_should_force_periodic_check_by_frame_time():
+    motion = detection.MotionDetector(check_interval=10)
+    frame = np.zeros((90, 160, 3), dtype=np.uint8)
+
+    motion(frame, 0.0)
+    assert [motion(frame, frame_time) for frame_time in (5.0, 10.0, 15.0)] == [False, True, False]
+    assert motion(frame, 1.0) is True  # Timestamps start again when the camera reconnects
+
+
+def test_dispatcher_process_frame_with_detections(mocker, mock_camera):
+    alert_function = mocker.Mock()
+    mocker.patch("visionalert.detection.annotate_frame")
+    detections = detection.Detections(
+        ["cat", "person"],
+        np.array([1, 1, 0]),
+        np.array([0.8, 0.2, 0.8]),
+        np.array([[10, 10, 50, 50], [10, 10, 50, 50], [20, 20, 50, 50]]),
+    )
+    frame = video.Frame(mock_camera.name, np.zeros((200, 200, 3)))
+
+    d = Dispatcher(
+        None, lambda *_: detections, alert_function, {mock_camera.name: mock_camera}
+    )
+    d._process_frame(frame)
+
+    alert_function.assert_called_once_with(([detections[0]], frame))
+
+
+def person_detections(*boxes):
+    return detection.Detections(
+        ["person"],
+        np.zeros(len(boxes), dtype=np.int64),
+        np.full(len(boxes), 0.9, dtype=np.float32),
+        np.array(boxes, dtype=np.int64).reshape(-1, 4),
+    )
+
+
+def test_tracker_keeps_track_ids_across_detections():
+    tracker = detection.Tracker()
+    frame = video.Frame("camera", np.zeros((200, 200, 3), dtype=np.uint8))
+
+    first = tracker.update(person_detections([10, 10, 50, 50], [100, 100, 150, 150]), frame)
+    second = tracker.update(person_detections([105, 102, 155, 152], [12, 10, 52, 50]), frame)
+
+    assert first.track_ids.tolist() == [1, 2]
+    assert second.track_ids.tolist() == [2, 1]
+    assert second[0].track_id == 2
+
+
+def test_tracker_predicts_boxes_between_detections():
+    tracker = detection.Tracker(detect_interval=3)
+    frame = video.Frame("camera", np.zeros((200, 200, 3), dtype=np.uint8))
+
+    assert tracker.needs_detection()
+    tracker.update(person_detections([10, 10, 50, 50]), frame)
+    assert not tracker.needs_detection()
+    tracker.predict(frame)
+    assert not tracker.needs_detection()
+    tracker.predict(frame)
+    assert tracker.needs_detection()
+    tracker.update(person_detections([25, 10, 65, 50]), frame)  # Moved 5 pixels a frame
+
+    assert not tracker.needs_detection()
+    predicted = tracker.predict(frame)
+    assert predicted.boxes.tolist() == [[30, 10, 70, 50]]
+    assert predicted.track_ids.tolist() == [1]
+
+
+def test_tracker_detects_again_when_object_is_lost():
+    tracker = detection.Tracker(detect_interval=10)
+    frame = video.Frame("camera", np.zeros((100, 100, 3), dtype=np.uint8))
+
+    tracker.needs_detection()
+    tracker.update(person_detections([0, 0, 20, 20]), frame)
+    tracker.update(person_detections([80, 0, 100, 20]), frame)  # New object at the edge
+    tracker._velocities[1] = [30, 0, 30, 0]
+
+    assert len(tracker.predict(frame)) == 1
+    assert tracker.needs_detection()
+
+
+def test_tracker_forgets_missed_objects():
+    tracker = detection.Tracker(max_missed=1)
+    frame = video.Frame("camera", np.zeros((100, 100, 3), dtype=np.uint8))
+
+    tracker.update(person_detections([0, 0, 20, 20]), frame)
+    tracker.update(person_detections(), frame)
+    assert len(tracker) == 1
+    tracker.update(person_detections(), frame)
+    assert len(tracker) == 0
+
+
+def test_tracker_follows_optical_flow():
+    tracker = detection.Tracker(optical_flow=True)
+    image = np.zeros((100, 100, 3), dtype=np.uint8)
+    image[20:60, 20:60] = np.random.default_rng(0).integers(0, 255, (40, 40, 1))
+    moved = np.roll(image, 6, axis=1)
+
+    full_size = np.zeros((200, 200, 3), dtype=np.uint8)  # Twice the size of model_input
+
+    tracker.update(
+        person_detections([40, 40, 120, 120]),
+        video.Frame("camera", full_size, model_input=image),
+    )
+    predicted = tracker.predict(video.Frame("camera", full_size, model_input=moved))
+
+    assert np.allclose(predicted.boxes, [[52, 40, 132, 120]], atol=2)
+
+
+def test_region_of_interest_from_area():
+    region_of_interest = detection.RegionOfInterest(area=(0.25, 0.5, 0.75, 1.0))
+    assert region_of_interest.regions((100, 200)) == ((50, 50, 150, 100),)
+
+
+def test_region_of_interest_from_mask():
+    image = np.zeros((100, 200), dtype=np.uint8)
+    image[20:40, 30:90] = 255
+    region_of_interest = detection.RegionOfInterest(mask=detection.Mask(image))
+    assert region_of_interest.regions((100, 200)) == ((30, 20, 90, 40),)
+    assert region_of_interest.regions((50, 100)) == ((15, 10, 45, 20),)
+
+
+def test_region_of_interest_without_area_or_mask_is_whole_frame():
+    assert detection.RegionOfInterest().regions((100, 200)) == ((0, 0, 200, 100),)
+
+
+def test_region_of_interest_tiles_overlap():
+    region_of_interest = detection.RegionOfInterest(tiles=(2, 1), overlap=0.2)
+    assert region_of_interest.regions((100, 180)) == ((0, 0, 100, 100), (80, 0, 180, 100))
+
+
+def test_merge_detections_should_drop_duplicates_from_overlapping_tiles():
+    tiles = [
+        person_detections([80, 10, 100, 50], [10, 10, 30, 30]),  # Cut off by the seam
+        person_detections([80, 10, 120, 50]),
+    ]
+    tiles[1].scores[:] = 0.95
+
+    merged = detection.merge_detections(tiles)
+
+    assert merged.boxes.tolist() == [[80, 10, 120, 50], [10, 10, 30, 30]]
+
+
+def test_dispatcher_detects_each_region_of_interest(mocker, mock_camera):
+    alert_function = mocker.Mock()
+    mocker.patch("visionalert.detection.annotate_frame")
+    regions = []
+
+    def detection_function(model_input, shape, region):
+        regions.append(region)
+        return person_detections([region[0], 0, region[0] + 10, 10])
+
+    frame = video.Frame(
+        mock_camera.name,
+        np.zeros((100, 200, 3)),
+        crops=np.zeros((2, 10, 10, 3)),
+        regions=((0, 0, 100, 100), (100, 0, 200, 100)),
+    )
+
+    d = Dispatcher(None, detection_function, alert_function, {mock_camera.name: mock_camera})
+    d._process_frame(frame)
+
+    assert regions == list(frame.regions)
+    detections, _ = alert_function.call_args[0][0]
+    assert [d.coordinates.start_x for d in detections] == [0, 100]
+
+
+def test_box_iou():
+    boxes = np.array([[0, 0, 10, 10], [5, 0, 15, 10]])
+    assert np.allclose(detection.box_iou(boxes, boxes), [[1, 1 / 3], [1 / 3, 1]])
+
+
+def test_dispatcher_skips_detection_for_tracked_frames(mocker, mock_camera):
+    alert_function = mocker.Mock()
+    mocker.patch("visionalert.detection.annotate_frame")
+    detection_function = mocker.Mock(return_value=person_detections([10, 10, 50, 50]))
+    mock_camera.tracker = detection.Tracker(detect_interval=2)
+    frames = [video.Frame(mock_camera.name, np.zeros((200, 200, 3))) for _ in range(4)]
+
+    d = Dispatcher(None, detection_function, alert_function, {mock_camera.name: mock_camera})
+    for frame in frames:
+        d._process_frame(frame)
+
+    assert detection_function.call_count == 2
+    assert alert_function.call_count == 4
+    assert {args[0][0][0].track_id for args, _ in alert_function.call_args_list} == {1}
+
+
+def test_cascade_should_check_uncertain_objects_with_second_stage(mock_camera):
+    boxes = [[10, 10, 50, 90], [100, 10, 140, 90], [150, 10, 190, 90], [10, 100, 50, 190]]
+    first_stage = person_detections(*boxes)
+    first_stage.scores[:] = [0.9, 0.65, 0.5, 0.3]
+    checked = []
+
+    def second_stage(crop, shape, region):
+        checked.append(region)
+        if region[0] < 100 <= region[2]:  # Only confirms the object at 100
+            return person_detections([98, 12, 141, 88])
+        return person_detections()
+
+    cascade = detection.Cascade(second_stage, padding=0.25)
+    frame = video.Frame(mock_camera.name, np.zeros((200, 200, 3), dtype=np.uint8))
+
+    result = cascade(mock_camera, first_stage, frame)
+
+    assert checked == [(90, 0, 150, 120), (140, 0, 200, 120)]
+    assert result.boxes.tolist() == [[10, 10, 50, 90], [98, 12, 141, 88]]
+
+
+def test_cascade_should_skip_second_stage_when_certain(mocker, mock_camera):
+    second_stage = mocker.Mock()
+    first_stage = person_detections([10, 10, 50, 50], [60, 60, 90, 90])
+    first_stage.scores[:] = [0.9, 0.1]
+    frame = video.Frame(mock_camera.name, np.zeros((200, 200, 3), dtype=np.uint8))
+
+    result = detection.Cascade(second_stage)(mock_camera, first_stage, frame)
+
+    second_stage.assert_not_called()
+    assert result.boxes.tolist() == [[10, 10, 50, 50]]
+
+
+@pytest.mark.parametrize(
+    "box, input_size, expected",
+    [
+        ([40, 40, 60, 80], None, (35, 30, 65, 90)),
+        ([40, 40, 60, 80], (300, 300), (20, 30, 80, 90)),
+        ([0, 0, 20, 40], (300, 300), (0, 0, 60, 60)),
+        ([150, 150, 200, 200], None, (125, 125, 200, 200)),
+    ],
+)
+def test_cascade_crop_region(box, input_size, expected):
+    cascade = detection.Cascade(None, padding=0.25, input_size=input_size)
+    assert cascade._crop_region(box, (200, 200, 3)) == expected
+
+
+def test_dispatcher_checks_detections_with_cascade(mocker, mock_camera):
+    alert_function = mocker.Mock()
+    mocker.patch("visionalert.detection.annotate_frame")
+    first_stage = person_detections([10, 10, 50, 50])
+    first_stage.scores[:] = 0.5
+    checked = []
+
+    def second_stage(crop, shape, region):
+        checked.append(region)
+        return person_detections([12, 12, 48, 48])
+
+    frame = video.Frame(mock_camera.name, np.zeros((200, 200, 3), dtype=np.uint8))
+
+    d = Dispatcher(
+        None,
+        lambda *_: first_stage,
+        alert_function,
+        {mock_camera.name: mock_camera},
+        cascade=detection.Cascade(second_stage),
+    )
+    d._process_frame(frame)
+
+    assert len(checked) == 1
+    detections, _ = alert_function.call_args[0][0]
+    assert [d.coordinates for d in detections] == [Rectangle(12, 12, 48, 48)]
+
+
+def test_dispatcher_does_not_check_masked_detections_with_cascade(mocker, mock_camera):
+    alert_function = mocker.Mock()
+    first_stage = person_detections([10, 10, 50, 50])
+    first_stage.scores[:] = 0.5
+    second_stage = mocker.Mock(spec=[])
+    mask = np.full((200, 200), 255, dtype=np.uint8)
+    mask[:100, :100] = 0  # The person is inside the masked area
+    mock_camera.mask = detection.Mask(mask)
+    frame = video.Frame(mock_camera.name, np.zeros((200, 200, 3), dtype=np.uint8))
+
+    d = Dispatcher(
+        None,
+        lambda *_: first_stage,
+        alert_function,
+        {mock_camera.name: mock_camera},
+        cascade=detection.Cascade(second_stage),
+    )
+    d._process_frame(frame)
+
+    second_stage.assert_not_called()
+    alert_function.assert_not_called()
+
+
 @pytest.fixture()
 def mock_camera():
     return video.Camera(
@@ -82,3 +602,18 @@ def mock_detection_results():
         DetectionResult("person", 0.2, Rectangle(10, 10, 50, 50)),
         DetectionResult("cat", 0.8, Rectangle(20, 20, 50, 50)),
     ]
+
+
+def test_dispatcher_reports_detections_to_adaptive_frame_rate(mocker, mock_camera):
+    mocker.patch("visionalert.detection.annotate_frame")
+    mock_camera.fps = video.AdaptiveFrameRate(0.5, burst_fps=5)
+    frame = video.Frame(mock_camera.name, np.zeros((200, 200, 3)))
+
+    cameras = {mock_camera.name: mock_camera}
+    d = Dispatcher(None, lambda *_: person_detections(), mocker.Mock(), cameras)
+    d._process_frame(frame)
+    assert mock_camera.fps() == 0.5
+
+    d = Dispatcher(None, lambda *_: person_detections([10, 10, 50, 50]), mocker.Mock(), cameras)
+    d._process_frame(frame)
+    assert mock_camera.fps() == 5
@@ -0,0 +1,107 @@
+import urllib.request
+
+import pytest
+
+import visionalert.metrics as metrics
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    monkeypatch.setattr(metrics, "_registry", {})
+    monkeypatch.setattr(metrics, "_routes", {})
+
+
+def test_counter_render():
+    counter = metrics.counter("test_frames", "Frames seen", ["camera"])
+    counter.labels("front").inc()
+    counter.labels("front").inc(2)
+
+    assert 'test_frames_total{camera="front"} 3.0' in metrics.render()
+    assert "# TYPE test_frames counter" in metrics.render()
+
+
+def test_metric_without_labels_is_updated_directly():
+    gauge = metrics.gauge("test_depth", "Depth")
+    gauge.set(4)
+    assert "test_depth 4.0" in metrics.render()
+
+
+def test_gauge_function():
+    gauge = metrics.gauge("test_depth", "Depth", ["camera"])
+    gauge.labels("front").set_function(lambda: 7)
+    assert 'test_depth{camera="front"} 7.0' in metrics.render()
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.histogram("test_seconds", "Seconds", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value)
+
+    lines = metrics.render().splitlines()
+
+    assert 'test_seconds_bucket{le="0.1"} 1.0' in lines
+    assert 'test_seconds_bucket{le="1.0"} 3.0' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 4.0' in lines
+    assert "test_seconds_count 4.0" in lines
+    assert "test_seconds_sum 6.05" in lines
+
+
+def test_histogram_quantile():
+    histogram = metrics.histogram("test_seconds", "Seconds", buckets=(0.1, 1.0))
+    for value in (0.05,) * 9 + (0.5,):
+        histogram.observe(value)
+
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(0.95) == 1.0
+
+
+def test_register_should_return_existing_metric():
+    counter = metrics.counter("test_frames", "Frames seen")
+    assert metrics.counter("test_frames", "Frames seen") is counter
+    with pytest.raises(ValueError):
+        metrics.gauge("test_frames", "Frames seen")
+
+
+def test_registered_is_sorted_by_name():
+    second = metrics.counter("test_b", "B")
+    first = metrics.gauge("test_a", "A")
+    assert metrics.registered() == [first, second]
+
+
+def test_label_values_are_escaped():
+    metrics.counter("test_frames", "Frames seen", ["camera"]).labels('Front "Door"').inc()
+    assert 'test_frames_total{camera="Front \\"Door\\""} 1.0' in metrics.render()
+
+
+def test_summarize():
+    metrics.counter("test_frames", "Frames seen", ["camera"]).labels("front").inc()
+    assert metrics.summarize() == ["test_frames camera=front value=1"]
+
+
+def test_http_server_serves_metrics():
+    metrics.counter("test_frames", "Frames seen").inc()
+    server = metrics.start_http_server(0, "127.0.0.1")
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url, timeout=5) as response:
+            assert "test_frames_total 1.0" in response.read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_http_server_serves_routes():
+    metrics.add_route("/hello", lambda: "Hello\n")
+    metrics.add_route("/hello", lambda: "Posted\n", "POST")
+    server = metrics.start_http_server(0, "127.0.0.1")
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/hello"
+        with urllib.request.urlopen(url, timeout=5) as response:
+            assert response.read() == b"Hello\n"
+        with urllib.request.urlopen(url, data=b"", timeout=5) as response:
+            assert response.read() == b"Posted\n"
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + "/missing", timeout=5)
+    finally:
+        server.shutdown()
+        server.server_close()
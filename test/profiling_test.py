@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+
+from visionalert.profiling import SamplingProfiler
+
+
+@pytest.fixture
+def busy_thread():
+    stopped = threading.Event()
+
+    def busy_loop():
+        while not stopped.wait(0.001):
+            pass
+
+    thread = threading.Thread(name="Camera-Test", daemon=True, target=busy_loop)
+    thread.start()
+    yield thread
+    stopped.set()
+    thread.join()
+
+
+def test_sample_should_collapse_stack_of_each_thread(busy_thread, tmp_path):
+    profiler = SamplingProfiler(directory=str(tmp_path))
+
+    profiler.sample()
+    profiler.sample()
+
+    stacks = dict(line.rsplit(" ", 1) for line in profiler.collapsed().splitlines())
+    busy_stacks = [stack for stack in stacks if stack.startswith("Camera-Test;")]
+    assert len(busy_stacks) == 1
+    assert "busy_loop (profiling_test.py:" in busy_stacks[0]
+    assert stacks[busy_stacks[0]] == "2"
+
+
+def test_write_should_save_and_reset_samples(busy_thread, tmp_path):
+    profiler = SamplingProfiler(directory=str(tmp_path / "profiles"))
+    profiler.sample()
+    collapsed = profiler.collapsed()
+
+    filename = profiler.write()
+
+    with open(filename) as file:
+        assert file.read() == collapsed
+    assert profiler.collapsed() == ""
+    assert profiler.write() is None
+
+
+def test_profiler_should_sample_until_stopped(busy_thread, tmp_path):
+    profiler = SamplingProfiler(interval=0.001, directory=str(tmp_path), write_interval=3600)
+
+    assert profiler.toggle()
+    threading.Event().wait(0.05)
+    assert not profiler.toggle()
+
+    profiles = list(tmp_path.iterdir())
+    assert len(profiles) == 1
+    assert "Camera-Test;" in profiles[0].read_text()
+    assert "SamplingProfiler" not in profiles[0].read_text()
+
+
+def test_profiler_should_write_each_interval(busy_thread, tmp_path):
+    profiler = SamplingProfiler(interval=0.001, directory=str(tmp_path), write_interval=0.01)
+    profiler.start()
+    try:
+        for _ in range(500):
+            if list(tmp_path.iterdir()):
+                break
+            threading.Event().wait(0.01)
+        assert list(tmp_path.iterdir())
+    finally:
+        profiler.stop()
@@ -1,21 +1,172 @@
-from visionalert.app import DiscardingQueue
+import collections
+import queue
 
+import numpy
+import pytest
 
-def test_queue_should_discard_oldest_items():
-    q = DiscardingQueue(3)
-    for i in range(5):
-        q.put(i)
-    assert q.get() == 2
+import visionalert.app as app
+from visionalert.app import FrameScheduler
+from visionalert.video import Camera, Frame
 
 
-def test_queue_should_invoke_overflow_action(mocker):
+def frames(camera_name, count):
+    return [Frame(camera_name, numpy.full((1, 1, 3), i)) for i in range(count)]
+
+
+def test_scheduler_should_discard_oldest_frames_per_camera(mocker):
     action = mocker.Mock()
-    q = DiscardingQueue(3, overflow_action=action)
-    for i in range(5):
-        q.put(i)
-    assert action.call_count == 2
+    scheduler = FrameScheduler(2, overflow_action=action)
+    for frame in frames("busy", 5):
+        scheduler.put(frame)
+
+    assert [scheduler.get().data[0, 0, 0] for _ in range(2)] == [3, 4]
+    assert scheduler.dropped["busy"] == 3
+    action.assert_called_with("busy")
+
+
+def test_scheduler_should_not_let_busy_camera_push_out_others():
+    scheduler = FrameScheduler(2)
+    scheduler.put(frames("quiet", 1)[0])
+    for frame in frames("busy", 10):
+        scheduler.put(frame)
+
+    assert {scheduler.get().camera_name for _ in range(2)} == {"quiet", "busy"}
+    assert scheduler.dropped["quiet"] == 0
+
+
+def test_scheduler_should_serve_cameras_by_weight():
+    scheduler = FrameScheduler(10, weights={"heavy": 2})
+    for frame in frames("heavy", 10) + frames("light", 10):
+        scheduler.put(frame)
+
+    served = [scheduler.get().camera_name for _ in range(6)]
+
+    assert served.count("heavy") == 4
+    assert served.count("light") == 2
+
+
+def test_scheduler_get_should_raise_empty_after_timeout():
+    with pytest.raises(queue.Empty):
+        FrameScheduler().get(timeout=0.01)
+
+
+def test_scheduler_should_report_queue_metrics():
+    scheduler = FrameScheduler(2)
+    for frame in frames("metrics_cam", 3):
+        scheduler.put(frame)
+    scheduler.get()
+
+    assert app.QUEUE_FRAMES.labels("metrics_cam").value == 1
+    assert app.FRAMES_DROPPED.labels("metrics_cam").value == 1
+    assert app.QUEUE_WAIT_SECONDS.labels("metrics_cam").count == 1
+
+
+def test_scheduler_should_discard_frames_of_removed_camera():
+    scheduler = FrameScheduler(2, weights={"removed": 2})
+    for frame in frames("removed", 2) + frames("kept", 1):
+        scheduler.put(frame)
+
+    scheduler.remove_camera("removed")
+
+    assert scheduler.occupancy == 0.5
+    assert "removed" not in scheduler.weights
+    assert scheduler.get().camera_name == "kept"
+    with pytest.raises(queue.Empty):
+        scheduler.get(timeout=0.01)
+
+
+def test_scheduler_should_drop_frames_from_removed_cameras_until_added_again():
+    scheduler = FrameScheduler(2)
+    scheduler.remove_camera("late")
+
+    scheduler.put(frames("late", 1)[0])
+
+    assert "late" not in scheduler._mailboxes
+    assert ("late",) not in app.QUEUE_FRAMES._children
+    with pytest.raises(queue.Empty):
+        scheduler.get(timeout=0.01)
+
+    scheduler.set_weight("late", 1)
+    scheduler.put(frames("late", 1)[0])
+
+    assert scheduler.get().camera_name == "late"
+
+
+@pytest.mark.parametrize(
+    "demands, weights, expected",
+    [
+        ({"a": 5, "b": 5}, {}, {"a": 5, "b": 5}),
+        ({"a": 10, "b": 10}, {}, {"a": 5, "b": 5}),
+        ({"a": 1, "b": 10, "c": 10}, {}, {"a": 1, "b": 4.5, "c": 4.5}),
+        ({"a": 10, "b": 10}, {"a": 4}, {"a": 8, "b": 2}),
+    ],
+)
+def test_fair_shares(demands, weights, expected):
+    assert app.fair_shares(demands, weights, 10) == pytest.approx(expected)
+
+
+class SchedulerStandIn:
+    """Reports the statistics a FrameScheduler would for the frames sent each second"""
+
+    weights = {}
+    occupancy = 0.0
+
+    def __init__(self):
+        self.served = 0
+        self.received = collections.Counter()
+        self.dropped = 0
+
+    def statistics(self):
+        return self.served, collections.Counter(self.received), self.dropped
+
+
+@pytest.fixture
+def governed(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: now[0])
+    scheduler = SchedulerStandIn()
+    cameras = {name: Camera(name, None, None) for name in ("busy", "quiet")}
+    governor = app.BackpressureGovernor(
+        scheduler, cameras, target_occupancy=0.5, headroom=0.9, keyframe_fps=1
+    )
+
+    def second(busy, quiet, served):
+        """A second in which the cameras send frames and served of them are analyzed"""
+        scheduler.received.update(busy=busy, quiet=quiet)
+        scheduler.served += served
+        scheduler.dropped += max(0, busy + quiet - served)
+        now[0] += 1
+        governor.adjust()
+
+    return cameras, second
+
+
+def test_governor_should_limit_cameras_to_their_share(governed):
+    cameras, second = governed
+
+    second(busy=20, quiet=2, served=12)
+
+    assert cameras["busy"].fps_limit.fps == pytest.approx(12 * 0.9 - 2)
+    assert not cameras["busy"].fps_limit.keyframes
+    assert cameras["quiet"].fps_limit.fps is None
+
+
+def test_governor_should_only_decode_keyframes_below_keyframe_fps(governed):
+    cameras, second = governed
+
+    second(busy=20, quiet=20, served=1)
+
+    assert cameras["busy"].fps_limit.fps == pytest.approx(0.45)
+    assert cameras["busy"].fps_limit.keyframes
+
+
+def test_governor_should_lift_limits_once_caught_up(governed):
+    cameras, second = governed
+    second(busy=20, quiet=2, served=12)
+    limit = cameras["busy"].fps_limit.fps
 
+    second(busy=round(limit), quiet=2, served=round(limit) + 2)
+    assert cameras["busy"].fps_limit.fps == pytest.approx(limit * 1.25)
 
-def test_queue_should_init_semaphore_to_zero():
-    q = DiscardingQueue(3)
-    assert q._semaphore._value == 0
+    second(busy=5, quiet=2, served=7)
+    assert cameras["busy"].fps_limit.fps is None
@@ -0,0 +1,163 @@
+import argparse
+import json
+import shutil
+from unittest import mock
+
+import numpy
+import pytest
+
+from visionalert import config, scan
+from visionalert.detection import DetectionResult, Detections, Rectangle
+
+
+class StubDetector:
+    input_size = (300, 300)
+
+    def __call__(self, frame, shape=None):
+        return [DetectionResult("person", 0.9, Rectangle(10, 20, 110, 220))]
+
+
+class TrackedStubDetector(StubDetector):
+    """Returns Detections, which trackers follow, of a person until found is cleared"""
+
+    found = True
+    calls = 0
+
+    def __call__(self, frame, shape=None):
+        self.calls += 1
+        count = 1 if self.found else 0
+        return Detections(
+            ["person"],
+            numpy.zeros(count, dtype=int),
+            numpy.full(count, 0.9),
+            numpy.array([[10, 20, 110, 220]] * count, dtype=int).reshape(-1, 4),
+        )
+
+
+@pytest.fixture
+def scan_config(monkeypatch):
+    monkeypatch.setitem(config, "tensorflow_model_file", "detect.tflite")
+    monkeypatch.setitem(config, "tensorflow_label_map", "labelmap.txt")
+    monkeypatch.setitem(
+        config,
+        "cameras",
+        [
+            {"name": "Front", "url": "rtsp://front", "interests": {"car": {"confidence": 0.5}}},
+            {"name": "Back", "url": "rtsp://back", "interests": {"person": {"confidence": 0.5}}},
+        ],
+    )
+    monkeypatch.setattr(scan.tensorflow, "create_detector", lambda *_, **__: StubDetector())
+
+
+def scan_args(tmp_path, **kwargs):
+    args = {
+        "files": ["fixtures/sample.mp4"],
+        "output": str(tmp_path / "detections.jsonl"),
+        "camera": "Back",
+        "fps": None,
+        "decode": None,
+        "workers": 1,
+        "segment_seconds": 300,
+        **kwargs,
+    }
+    return argparse.Namespace(**args)
+
+
+@pytest.mark.parametrize(
+    "duration, segment_seconds, expected",
+    [
+        (2.0, 300, [(0.0, float("inf"))]),
+        (2.0, 1.0, [(0.0, 1.0), (1.0, float("inf"))]),
+        (2.5, 1.0, [(0.0, 2.5 / 3), (2.5 / 3, 5 / 3), (5 / 3, float("inf"))]),
+    ],
+)
+def test_segments_should_split_duration_evenly(duration, segment_seconds, expected):
+    assert scan.segments(0.0, duration, segment_seconds) == pytest.approx(expected)
+
+
+def test_segments_should_start_at_stream_start():
+    assert scan.segments(10.0, 2.0, 1.0) == [(10.0, 11.0), (11.0, float("inf"))]
+
+
+def test_video_span():
+    start, duration = scan.video_span("fixtures/sample.mp4")
+
+    assert start == 0.0
+    assert duration == pytest.approx(5.0)
+
+
+def test_video_span_should_read_to_end_without_duration(monkeypatch):
+    container = mock.MagicMock(duration=None)
+    container.__enter__.return_value = container
+    stream = container.streams.video[0]
+    stream.start_time, stream.duration, stream.time_base = None, None, 0.5
+    container.demux.return_value = [mock.Mock(pts=pts, duration=1) for pts in (0, 1, None, 3)]
+    monkeypatch.setattr(scan.av, "open", lambda location: container)
+
+    assert scan.video_span("raw.h264") == (0.0, 2.0)
+
+
+def test_scan_should_write_detections_with_times(scan_config, tmp_path):
+    args = scan_args(tmp_path)
+
+    detections = scan.run(args)
+
+    with open(args.output) as file:
+        written = [json.loads(line) for line in file]
+    assert written == detections
+    assert len(detections) == 50
+    assert [detection["time"] for detection in detections] == pytest.approx(
+        [i / 10 for i in range(50)]
+    )
+    assert detections[10] == {
+        "file": "fixtures/sample.mp4",
+        "time": 1.0,
+        "timestamp": "00:00:01.000",
+        "camera": "Back",
+        "object": "person",
+        "confidence": 0.9,
+        "box": [10, 20, 110, 220],
+        "track_id": None,
+    }
+
+
+def test_scan_should_cover_every_frame_once_when_segmented(scan_config, tmp_path):
+    detections = scan.run(scan_args(tmp_path, segment_seconds=1.3))
+
+    assert [detection["time"] for detection in detections] == pytest.approx(
+        [i / 10 for i in range(50)]
+    )
+
+
+def test_scan_should_use_camera_interests(scan_config, tmp_path):
+    assert scan.run(scan_args(tmp_path, camera=None)) == []
+
+
+def test_scan_should_reject_unknown_camera(scan_config, tmp_path):
+    with pytest.raises(ValueError):
+        scan.run(scan_args(tmp_path, camera="Side"))
+
+
+def test_scan_should_not_follow_tracks_into_other_files(scan_config, monkeypatch, tmp_path):
+    other = str(tmp_path / "other.mp4")
+    shutil.copy("fixtures/sample.mp4", other)
+    detector = TrackedStubDetector()
+    monkeypatch.setattr(scan.tensorflow, "create_detector", lambda *_, **__: detector)
+    camera_config = {**scan._camera_config("Back"), "tracking": {"detect_every_frames": 5}}
+    scanner = scan._Scanner(camera_config, {"fps": None, "decode": "all"})
+
+    assert len(scanner.scan("fixtures/sample.mp4", 0.0, float("inf"))) == 50
+    detector.found = False
+    assert scanner.scan(other, 0.0, float("inf")) == []
+
+
+def test_scan_should_analyze_every_frame_of_tracked_camera(scan_config, monkeypatch):
+    detector = TrackedStubDetector()
+    monkeypatch.setattr(scan.tensorflow, "create_detector", lambda *_, **__: detector)
+    camera_config = {**scan._camera_config("Back"), "tracking": {"detect_every_frames": 5}}
+    scanner = scan._Scanner(camera_config, {"fps": None, "decode": "all"})
+
+    detections = scanner.scan("fixtures/sample.mp4", 0.0, float("inf"))
+
+    assert detector.calls == len(detections) == 50
+    assert {detection["track_id"] for detection in detections} == {1}
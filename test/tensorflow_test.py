@@ -3,6 +3,7 @@ import os
 import numpy
 import pytest
 
+from visionalert.detection import DetectionResult
 import visionalert.tensorflow as tf
 
 
@@ -33,14 +34,21 @@ def mock_interpreter(mocker):
 def test_calc_bounding_box(mock_input_image):
     input_box = [0.2, 0.1, 0.8, 0.9]
     expected = tf.Rectangle(64, 96, 576, 384)
-    result = tf.calc_bounding_box(mock_input_image, input_box)
+    result = tf.calc_bounding_box(mock_input_image.shape, input_box)
     assert result == expected
 
 
 def test_calc_bounding_box_with_overflows(mock_input_image):
     input_box = [-0.2, -0.1, 1.2, 1.2]
     expected = tf.Rectangle(1, 1, 640, 480)
-    result = tf.calc_bounding_box(mock_input_image, input_box)
+    result = tf.calc_bounding_box(mock_input_image.shape, input_box)
+    assert result == expected
+
+
+def test_calc_bounding_box_in_region(mock_input_image):
+    input_box = [0.0, 0.5, 1.0, 1.0]
+    expected = tf.Rectangle(150, 100, 200, 300)
+    result = tf.calc_bounding_box(mock_input_image.shape, input_box, region=(100, 100, 200, 300))
     assert result == expected
 
 
@@ -56,6 +64,33 @@ def test_objectdetector_init_tensorflow(label_file, mock_interpreter):
     mock_interpreter.allocate_tensors.assert_called_once()
 
 
+def test_create_cascade(label_file, mock_interpreter):
+    cascade = tf.create_cascade(
+        "heavy.tflite", label_file, input_width=640, input_height=480, candidate_margin=0.1
+    )
+    tf.tflite.Interpreter.assert_called_once_with(
+        model_path="heavy.tflite", experimental_delegates=None
+    )
+    assert cascade.detection_function.input_size == (640, 480)
+    assert cascade.input_size == (640, 480)
+    assert cascade.candidate_margin == 0.1
+
+
+def test_objectdetector_warm_up(label_file, mock_interpreter):
+    mock_interpreter.get_input_details.return_value = [
+        {"index": 0, "dtype": numpy.uint8, "shape_signature": [1, 300, 300, 3]}
+    ]
+    detect = tf.create_detector("", label_file)
+    mock_interpreter.get_tensor.side_effect = [[[]], [[]], [[]]]
+
+    detect.warm_up()
+
+    mock_interpreter.invoke.assert_called_once()
+    input_image = mock_interpreter.set_tensor.call_args[0][1]
+    assert input_image.shape == (1, 300, 300, 3)
+    assert input_image.dtype == numpy.uint8
+
+
 def test_objectdetector_pass_correct_size_image(
     label_file, mock_interpreter, mock_input_image
 ):
@@ -79,8 +114,87 @@ def test_objectdetector_parse_detected_objects(
         mock_interpreter_response[2],
     ]
 
-    expected = tf.DetectionResult("cat", 0.8, tf.Rectangle(64, 96, 576, 384))
+    expected = DetectionResult("cat", 0.8, tf.Rectangle(64, 96, 576, 384))
     result = detect(mock_input_image)
 
     mock_interpreter.invoke.assert_called_once()
     assert result[0] == expected
+
+
+def test_objectdetector_scale_detected_objects_to_full_frame(
+    label_file, mock_interpreter
+):
+    detect = tf.create_detector("", label_file)
+    tf.tflite.Interpreter.return_value.get_tensor.side_effect = [
+        ([[0.2, 0.1, 0.8, 0.9]],),
+        ([0],),
+        ([0.8],),
+    ]
+
+    result = detect(numpy.zeros((300, 300, 3), numpy.uint8), (480, 640, 3))
+
+    input_image = mock_interpreter.set_tensor.call_args[0][1]
+    assert input_image.shape == (1, 300, 300, 3)
+    assert result[0].coordinates == tf.Rectangle(64, 96, 576, 384)
+
+
+def test_objectdetector_detect_batch_with_dynamic_batch_size(
+    label_file, mock_interpreter, mock_input_image
+):
+    mock_interpreter.get_input_details.return_value = [
+        {"index": 0, "shape_signature": [-1, 300, 300, 3]}
+    ]
+    mock_interpreter.get_output_details.return_value = [{"index": i} for i in range(1, 4)]
+    mock_interpreter.get_tensor.side_effect = [
+        [[[0.2, 0.1, 0.8, 0.9]], [[0.0, 0.0, 0.5, 0.5]]],
+        [[0], [2]],
+        [[0.8], [0.4]],
+    ]
+    detect = tf.create_detector("", label_file)
+
+    result = detect.detect_batch([mock_input_image, mock_input_image])
+
+    mock_interpreter.resize_tensor_input.assert_called_once_with(0, (2, 300, 300, 3))
+    mock_interpreter.invoke.assert_called_once()
+    assert list(result[0]) == [DetectionResult("cat", 0.8, tf.Rectangle(64, 96, 576, 384))]
+    assert list(result[1]) == [DetectionResult("person", 0.4, tf.Rectangle(1, 1, 320, 240))]
+
+
+def test_objectdetector_detect_batch_should_pad_to_power_of_two(
+    label_file, mock_interpreter, mock_input_image
+):
+    mock_interpreter.get_input_details.return_value = [
+        {"index": 0, "shape_signature": [-1, 300, 300, 3]}
+    ]
+    mock_interpreter.get_output_details.return_value = [{"index": i} for i in range(1, 4)]
+    outputs = {1: numpy.zeros((4, 1, 4)), 2: numpy.zeros((4, 1)), 3: numpy.zeros((4, 1))}
+    mock_interpreter.get_tensor.side_effect = outputs.get
+    detect = tf.create_detector("", label_file)
+
+    results = [detect.detect_batch([mock_input_image] * size) for size in (3, 4, 3)]
+
+    mock_interpreter.resize_tensor_input.assert_called_once_with(0, (4, 300, 300, 3))
+    assert [len(result) for result in results] == [3, 4, 3]
+    assert not mock_interpreter.set_tensor.call_args[0][1][3].any()
+
+
+def test_objectdetector_detect_batch_without_dynamic_batch_size(
+    label_file, mock_interpreter, mock_input_image
+):
+    detect = tf.create_detector("", label_file)
+
+    result = detect.detect_batch([mock_input_image] * 3)
+
+    mock_interpreter.resize_tensor_input.assert_not_called()
+    assert mock_interpreter.invoke.call_count == 3
+    assert len(result) == 3
+
+
+def test_create_detector_pool(label_file, mock_interpreter):
+    detectors = tf.create_detector_pool("", label_file, size=3, num_threads=2)
+
+    assert len(detectors) == 3
+    assert len(set(map(id, detectors))) == 3
+    tf.tflite.Interpreter.assert_called_with(
+        model_path="", experimental_delegates=None, num_threads=2
+    )
@@ -1,8 +1,12 @@
 from fractions import Fraction
+import time
+from unittest import mock
 
 import av
+import numpy
 import pytest
 
+import visionalert.detection as detection
 import visionalert.video as video
 
 
@@ -26,11 +30,26 @@ def test_get_frames_should_set_thread_type(mock_av_open):
     ), "Thread type not set"
 
 
+def test_get_frames_should_set_allocated_decode_threads(mock_av_open):
+    stream = av.open.return_value.streams.video.__getitem__.return_value
+    _ = [_ for _ in video.get_frames("", decode_threads=lambda _: (3, "SLICE"))]
+    assert stream.thread_count == 3
+    assert stream.thread_type == "SLICE"
+
+
 def test_get_frames_should_close_container(mock_av_open):
     _ = [_ for _ in video.get_frames("")]
     av.open.return_value.close.assert_called_once()
 
 
+def test_get_frames_should_close_container_when_closed_early(mock_av_open):
+    av.open.return_value.decode.return_value = iter([mock.Mock(), mock.Mock()])
+    frames = video.get_frames("")
+    next(frames)
+    frames.close()
+    av.open.return_value.close.assert_called_once()
+
+
 @pytest.mark.parametrize("fps, expected_count", [(None, 50), (10, 50), (2, 10), (5, 25)])
 def test_get_frames_should_decode_mp4_at_requested_fps(fps, expected_count):
     count = 0
@@ -41,3 +60,334 @@ def test_get_frames_should_decode_mp4_at_requested_fps(fps, expected_count):
     assert count == expected_count
     assert frame.width == 640
     assert frame.height == 480
+
+
+def test_get_frames_should_skip_frames_in_codec(mock_av_open):
+    _ = [_ for _ in video.get_frames("", decode="keyframes")]
+    stream = av.open.return_value.streams.video.__getitem__.return_value
+    assert stream.codec_context.skip_frame == "NONKEY"
+
+
+def test_get_frames_should_reject_unknown_decode_mode(mock_av_open):
+    with pytest.raises(ValueError):
+        _ = [_ for _ in video.get_frames("", decode="bogus")]
+
+
+@pytest.mark.parametrize(
+    "decode, fps, expected_count",
+    [("keyframes", None, 1), ("nonref", None, 30), ("nonref", 2, 10), ("nonref", 5, 25)],
+)
+def test_get_frames_should_keep_fps_when_skipping_decode(decode, fps, expected_count):
+    frames = list(video.get_frames("fixtures/sample.mp4", fps=fps, decode=decode))
+    assert len(frames) == expected_count
+
+
+def test_get_frames_should_change_fps_without_reconnecting():
+    # Called once when the stream is opened and then for each of its 50 frames
+    rates = iter([2] * 20 + [None] * 31)
+    frames = list(video.get_frames("fixtures/sample.mp4", fps=lambda: next(rates)))
+    assert [round(frame.time, 1) for frame in frames] == [0.0, 0.5, 1.0, 1.5] + [
+        i / 10 for i in range(19, 50)
+    ]
+
+
+def test_get_frames_should_change_decode_mode_without_reconnecting():
+    modes = iter(["all"] * 11 + ["keyframes"] * 40)
+    frames = list(video.get_frames("fixtures/sample.mp4", decode=lambda: next(modes)))
+    assert 10 <= len(frames) < 20  # The sample's only keyframe is its first frame
+
+
+@pytest.mark.parametrize(
+    "fps, limit, expected", [(5, None, 5), (5, 2, 2), (1, 2, 1), (None, 2, 2), (None, None, None)]
+)
+def test_frame_rate_limit_should_cap_frame_rate(fps, limit, expected):
+    fps_limit = video.FrameRateLimit()
+    fps_limit.set(limit)
+    assert fps_limit.frame_rate(fps)() == expected
+    assert fps_limit.frame_rate(lambda: fps)() == expected
+
+
+def test_frame_rate_limit_should_force_keyframes():
+    fps_limit = video.FrameRateLimit()
+    decode_mode = fps_limit.decode_mode("nonref")
+    assert decode_mode() == "nonref"
+
+    fps_limit.set(0.5, keyframes=True)
+    assert decode_mode() == "keyframes"
+
+
+def test_adaptive_frame_rate_should_burst_after_activity(monkeypatch):
+    now = 100.0
+    monkeypatch.setattr(video.time, "monotonic", lambda: now)
+    frame_rate = video.AdaptiveFrameRate(0.5, burst_fps=5, cooldown=30)
+    assert frame_rate() == 0.5
+
+    frame_rate.activity()
+    now += 29
+    assert frame_rate() == 5
+    now += 1
+    assert frame_rate() == 0.5
+
+
+def test_camera_should_report_motion_to_adaptive_frame_rate(mocker):
+    frame_action = mocker.Mock()
+    frame_rate = video.AdaptiveFrameRate(0.5, burst_fps=5)
+    motion = detection.MotionDetector(check_interval=60)
+    camera = video.Camera("test_cam", None, frame_action, fps=frame_rate, motion_detector=motion)
+    still = video.Frame(camera.name, numpy.zeros((90, 160, 3), dtype=numpy.uint8))
+    moved = video.Frame(camera.name, numpy.zeros((90, 160, 3), dtype=numpy.uint8))
+    moved.model_input[20:60, 40:80] = 255
+
+    camera._submit(still)  # The first frame is compared to nothing, so counts as motion
+    frame_rate._last_activity.value = float("-inf")
+    camera._submit(still)
+    assert frame_rate() == 0.5
+
+    camera._submit(moved)
+    assert frame_rate() == 5
+
+
+def test_camera_should_create_frames_scaled_for_detector():
+    camera = video.Camera("test_cam", None, None, input_size=(300, 200))
+    source = next(video.get_frames("fixtures/sample.mp4"))
+
+    frame = camera._create_frame(source)
+
+    assert frame.model_input.shape == (200, 300, 3)
+    assert frame.shape == (480, 640, 3)
+    assert frame._data is None, "Full resolution frame converted before it was needed"
+    assert frame.data.shape == (480, 640, 3)
+
+
+def test_camera_should_crop_regions_of_interest_for_detector():
+    region_of_interest = detection.RegionOfInterest(area=(0.5, 0.5, 1.0, 1.0), tiles=(2, 1))
+    camera = video.Camera(
+        "test_cam", None, None, input_size=(100, 100), region_of_interest=region_of_interest
+    )
+    source = next(video.get_frames("fixtures/sample.mp4"))
+
+    frame = camera._create_frame(source)
+
+    assert frame.model_input.shape == (100, 100, 3)
+    assert frame.crops.shape == (2, 100, 100, 3)
+    assert frame.regions == ((320, 240, 489, 480), (471, 240, 640, 480))
+
+
+def test_scale_frame_crops_match_full_resolution():
+    source = next(video.get_frames("fixtures/sample.mp4"))
+    full = source.to_ndarray(format="rgb24").astype(int)
+
+    _, crops = video.scale_frame(source, (80, 60), [(0, 0, 320, 240), (320, 240, 640, 480)])
+
+    for crop, expected in zip(crops, (full[:240:4, :320:4], full[240::4, 320::4])):
+        assert numpy.abs(crop.astype(int).mean() - expected.mean()) < 2
+
+
+class FakeVideoFrame:
+    def __init__(self, value, shape=(48, 64, 3)):
+        self.height, self.width = shape[:2]
+        self.value = value
+
+    def to_ndarray(self, format, width=None, height=None):
+        shape = (height or self.height, width or self.width, 3)
+        return numpy.full(shape, self.value, dtype=numpy.uint8)
+
+
+@pytest.fixture
+def frame_ring():
+    ring = video.FrameRing((48, 64, 3), (30, 40, 3), 2)
+    yield ring
+    ring.close(unlink=True)
+
+
+def test_frame_ring_should_share_frames_between_attached_rings(frame_ring):
+    reader = video.FrameRing((48, 64, 3), (30, 40, 3), 2, name=frame_ring.name)
+    try:
+        slot, sequence = frame_ring.write(FakeVideoFrame(7))
+
+        assert reader.read_frame(slot, sequence).shape == (48, 64, 3)
+        assert (reader.read_input(slot, sequence) == 7).all()
+        assert reader.read_input(slot, sequence).shape == (30, 40, 3)
+    finally:
+        reader.close()
+
+
+def test_frame_ring_should_detect_overwritten_frames(frame_ring):
+    slot, sequence = frame_ring.write(FakeVideoFrame(1))
+    frame_ring.write(FakeVideoFrame(2))
+    frame_ring.write(FakeVideoFrame(3))  # Overwrites the first slot
+
+    with pytest.raises(video.StaleFrameError):
+        frame_ring.read_frame(slot, sequence)
+
+
+def test_frame_ring_should_treat_closed_ring_as_overwritten(frame_ring):
+    reader = video.FrameRing((48, 64, 3), (30, 40, 3), 2, name=frame_ring.name)
+    slot, sequence = frame_ring.write(FakeVideoFrame(1))
+    frames = reader._frames.copy()  # As held by a read that was under way when it closed
+    reader.close()
+
+    with pytest.raises(video.StaleFrameError):
+        reader._read(frames, slot, sequence)
+
+
+def stream(width, height, rate):
+    return mock.Mock(width=width, height=height, guessed_rate=Fraction(rate))
+
+
+def test_decode_budget_should_share_threads_by_pixel_rate():
+    budget = video.DecodeThreadBudget(12)
+    budget.register("4k")
+    budget.register("1080p")
+    budget.register("unknown")
+
+    assert budget.allocation() == {"4k": 4, "1080p": 4, "unknown": 4}
+    assert budget.allocate("4k", stream(3840, 2160, 20)) == (4, "AUTO")
+    assert budget.allocate("1080p", stream(1920, 1080, 20)) == (2, "AUTO")
+    assert budget.allocation() == {"4k": 6, "1080p": 2, "unknown": 4}
+
+
+def test_decode_budget_should_give_overrides_their_threads_first():
+    budget = video.DecodeThreadBudget(4)
+    budget.register("fixed", threads=3)
+    budget.register("a")
+    budget.register("b")
+
+    assert budget.allocation() == {"fixed": 3, "a": 1, "b": 1}
+
+
+def test_decode_budget_should_replace_registration():
+    budget = video.DecodeThreadBudget(4)
+    budget.register("a", threads=3)
+    budget.register("b")
+    budget.register("a")
+
+    assert budget.allocation() == {"a": 2, "b": 2}
+
+
+def test_decode_budget_should_unregister_cameras():
+    budget = video.DecodeThreadBudget(4)
+    budget.register("fixed", threads=3)
+    budget.register("a")
+    budget.allocate("fixed", stream(1920, 1080, 20))
+
+    budget.unregister("fixed")
+
+    assert budget.allocation() == {"a": 4}
+
+
+def test_decode_budget_should_count_keyframe_cameras_at_their_fps():
+    budget = video.DecodeThreadBudget(10)
+    budget.register("keyframes", fps=1, decode="keyframes")
+    budget.register("all", fps=1)
+    budget.update("keyframes", 1920, 1080, 25)
+
+    assert budget.allocate("all", stream(1920, 1080, 25)) == (9, "AUTO")
+    assert budget.allocation()["keyframes"] == 1
+
+
+@pytest.mark.parametrize(
+    "threads, rate, expected", [(1, 25, "NONE"), (4, 25, "AUTO"), (4, 2, "SLICE")]
+)
+def test_decode_budget_should_pick_thread_type_by_latency(threads, rate, expected):
+    budget = video.DecodeThreadBudget(threads, max_latency=0.5)
+    budget.register("camera")
+
+    assert budget.allocate("camera", stream(1920, 1080, rate)) == (threads, expected)
+
+
+def test_process_camera_should_receive_frames_from_capture_process():
+    shapes = []
+    camera = video.ProcessCamera(
+        "test_cam",
+        "fixtures/sample.mp4",
+        lambda frame: shapes.append((frame.model_input.shape, frame.data.shape)),
+        input_size=(300, 300),
+        ring_slots=64,
+    )
+
+    camera._run_capture_process()
+
+    assert shapes == [((300, 300, 3), (480, 640, 3))] * 50
+
+
+def test_process_camera_should_receive_frame_times_from_capture_process():
+    times = []
+    camera = video.ProcessCamera(
+        "test_cam", "fixtures/sample.mp4", lambda frame: times.append(frame.time), ring_slots=64
+    )
+
+    camera._run_capture_process()
+
+    assert len(times) == 50
+    assert None not in times
+    assert times == sorted(times)
+
+
+def test_process_camera_should_receive_crops_from_capture_process():
+    frames = []
+    camera = video.ProcessCamera(
+        "test_cam",
+        "fixtures/sample.mp4",
+        lambda frame: frames.append((frame.model_input.shape, frame.crops.shape, frame.regions)),
+        input_size=(100, 100),
+        region_of_interest=detection.RegionOfInterest(area=(0.0, 0.0, 0.5, 0.5), tiles=(2, 2)),
+        ring_slots=64,
+    )
+
+    camera._run_capture_process()
+
+    assert len(frames) == 50
+    model_input_shape, crops_shape, regions = frames[0]
+    assert model_input_shape == (100, 100, 3)
+    assert crops_shape == (4, 100, 100, 3)
+    assert regions[-1][2:] == (320, 240)
+
+
+def test_process_camera_should_report_stream_to_decode_budget():
+    budget = video.DecodeThreadBudget(4)
+    budget.register("test_cam")
+    budget.register("other")
+    camera = video.ProcessCamera(
+        "test_cam", "fixtures/sample.mp4", lambda frame: None, decode_budget=budget
+    )
+
+    camera._run_capture_process()
+
+    assert budget._rates == {"test_cam": 640 * 480 * 10}
+
+
+def test_process_camera_should_retry_after_errors(monkeypatch):
+    camera = video.ProcessCamera("retry_cam", "fixtures/sample.mp4", lambda frame: None)
+    camera.retry_wait = 0
+    attempts = []
+
+    def run_capture_process():
+        attempts.append(True)
+        if len(attempts) == 1:
+            raise BufferError("cannot close exported pointers exist")
+        camera._stopped.set()
+
+    monkeypatch.setattr(camera, "_run_capture_process", run_capture_process)
+    camera._capture_loop()
+
+    assert len(attempts) == 2
+    assert video.RECONNECTS.labels("retry_cam").value == 1
+
+
+def test_camera_should_stop_capturing():
+    frames = []
+    camera = video.Camera("test_cam", "fixtures/sample.mp4", frames.append)
+    camera.start()
+    for _ in range(500):
+        if frames:
+            break
+        time.sleep(0.01)
+
+    camera.stop(timeout=5)
+    captured = len(frames)
+    time.sleep(0.1)
+
+    assert camera.stopped
+    assert not camera._capture_thread.is_alive()
+    assert 0 < captured == len(frames)